@@ -0,0 +1,119 @@
+"""
+Evaluate the checkpoints of a run_vinmec_pytorch.py training in a separate process,
+the Lightning counterpart of tf/evaluator.py.
+
+Example:
+    python run_vinmec_pytorch.py --data_path=/u01/data/Vimmec_Data_small --async_eval
+    python evaluator.py --data_path=/u01/data/Vimmec_Data_small --run_dir=lightning_logs/version_0 --every=5
+
+The val_*/test_* metrics are written to the TensorBoard log of the run and to <run_dir>/async_eval.json.
+With --multitask, the best checkpoint of every head is copied to <run_dir>/checkpoints/best_<metric>.ckpt,
+as BestHeadCheckpoint does during a training with validation.
+"""
+import glob
+import json
+import os
+import re
+import shutil
+import time
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from run_vinmec_pytorch import ImageNetLightningModel, get_head_names, get_parser
+
+
+def list_checkpoints(run_dir):
+    """
+    Returns:
+        list of (epoch, path) of the complete checkpoints written by EpochCheckpoint, oldest first.
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(run_dir, 'checkpoints', 'epoch=*.ckpt')):
+        match = re.search(r'epoch=(\d+)\.ckpt$', path)
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def run_loop(model, dataloader, step, epoch_end):
+    device = next(model.parameters()).device
+    outputs = []
+    with torch.no_grad():
+        for batch_idx, (images, target) in enumerate(dataloader):
+            outputs.append(step([images.to(device), target.to(device)], batch_idx))
+    return epoch_end(outputs)['log']
+
+
+def save_best(run_dir, path, results, best):
+    """
+    Copy the checkpoint `path` to best_<metric>.ckpt for every metric of `best` it improves.
+    """
+    for metric, value in best.items():
+        if value is not None and results[metric] <= value:
+            continue
+        best[metric] = results[metric]
+        filepath = os.path.join(run_dir, 'checkpoints', 'best_{}.ckpt'.format(metric))
+        shutil.copyfile(path, filepath + '.part')
+        os.rename(filepath + '.part', filepath)
+
+
+def evaluate(model, checkpoint):
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    results = {}
+    results.update(run_loop(model, model.val_dataloader(), model.validation_step, model.validation_epoch_end))
+    results.update(run_loop(model, model.test_dataloader(), model.test_step, model.test_epoch_end))
+    return {k: float(v) for k, v in results.items()}
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--run_dir', required=True, help='log directory of the run, e.g. lightning_logs/version_0')
+    parser.add_argument('--every', type=int, default=1, help='evaluate the checkpoints of every N epochs')
+    parser.add_argument('--latest_only', action='store_true',
+                        help='only evaluate the newest checkpoint, skipping the older pending ones')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between two polls')
+    parser.add_argument('--once', action='store_true', help='evaluate what is pending and exit')
+    hparams = parser.parse_args()
+
+    model = ImageNetLightningModel(hparams)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    writer = SummaryWriter(hparams.run_dir, filename_suffix='.async_eval')
+    fname = os.path.join(hparams.run_dir, 'async_eval.json')
+    records = []
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            records = json.load(f)
+    best = {}
+    if hparams.multitask:
+        for name in get_head_names(hparams):
+            metric = 'val_{}_{}'.format(hparams.best_metric, name)
+            values = [r[metric] for r in records if metric in r]
+            best[metric] = max(values) if values else None
+
+    while True:
+        evaluated = set(r['epoch'] for r in records)
+        pending = [(epoch, path) for epoch, path in list_checkpoints(hparams.run_dir)
+                   if epoch not in evaluated and epoch % hparams.every == 0]
+        if hparams.latest_only:
+            pending = pending[-1:]
+        for epoch, path in pending:
+            start = time.time()
+            checkpoint = torch.load(path, map_location='cpu')
+            results = evaluate(model, checkpoint)
+            # Same x axis as the metrics logged by the trainer
+            for k, v in sorted(results.items()):
+                writer.add_scalar(k, v, checkpoint['global_step'])
+                print('{}: {}'.format(k, v))
+            writer.flush()
+            records.append(dict(results, epoch=epoch, global_step=checkpoint['global_step']))
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(records, f, indent=4)
+            os.rename(fname + '.tmp', fname)
+            save_best(hparams.run_dir, path, results, best)
+            print('Evaluated {} in {:.1f}s'.format(path, time.time() - start))
+        if hparams.once or any(r['epoch'] >= hparams.epochs - 1 for r in records):
+            break
+        time.sleep(hparams.interval)
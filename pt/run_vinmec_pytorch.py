@@ -4,6 +4,7 @@ This example is largely adapted from https://github.com/pytorch/examples/blob/ma
 import argparse
 import os
 import random
+import time
 from collections import OrderedDict
 
 import torch
@@ -33,7 +34,9 @@ import cv2
 import numpy as np
 
 import sklearn.metrics
-from vinmec import Vinmec
+from vinmec import Vinmec, get_pathologies
+from dataflow_stats import InstrumentedData
+import dataflow_stats
 # pull out resnet names from torchvision models
 MODEL_NAMES = sorted(
     name for name in models.__dict__
@@ -41,6 +44,170 @@ MODEL_NAMES = sorted(
 )
 
 
+def get_run_dir(logger):
+    return os.path.join(logger.save_dir, logger.name, 'version_{}'.format(logger.version))
+
+
+class EpochCheckpoint(pl.Callback):
+    """
+    Save a checkpoint at the end of every epoch into <log dir>/checkpoints/epoch=N.ckpt,
+    without waiting for a validation metric, for evaluator.py to pick up.
+    """
+
+    def on_epoch_end(self, trainer, pl_module):
+        run_dir = get_run_dir(trainer.logger)
+        os.makedirs(os.path.join(run_dir, 'checkpoints'), exist_ok=True)
+        filepath = os.path.join(run_dir, 'checkpoints', 'epoch={}.ckpt'.format(trainer.current_epoch))
+        # Rename once complete, the evaluator must never see a partial file
+        trainer.save_checkpoint(filepath + '.part')
+        os.rename(filepath + '.part', filepath)
+
+
+class BestHeadCheckpoint(pl.Callback):
+    """
+    Keep the checkpoint of the best validation epoch of every --multitask head,
+    <log dir>/checkpoints/best_<metric>.ckpt for each of the `metrics`.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.best = {}
+
+    def on_validation_end(self, trainer, pl_module):
+        run_dir = get_run_dir(trainer.logger)
+        for metric in self.metrics:
+            value = trainer.callback_metrics.get(metric)
+            if value is None or value <= self.best.get(metric, -np.inf):
+                continue
+            self.best[metric] = value
+            os.makedirs(os.path.join(run_dir, 'checkpoints'), exist_ok=True)
+            filepath = os.path.join(run_dir, 'checkpoints', 'best_{}.ckpt'.format(metric))
+            trainer.save_checkpoint(filepath + '.part')
+            os.rename(filepath + '.part', filepath)
+
+
+def get_head_names(hparams):
+    return [name.replace('/', '_') for name in get_pathologies(hparams.types, hparams.pathology)]
+
+
+def multitask_bce(output, target, weights):
+    """
+    The class-balanced binary cross entropy of every head (column) of the sigmoid `output`, each with
+    the beta of its own column in the batch, averaged with the head `weights`, as in the tf trainer.
+    """
+    count_neg = (1. - target).sum(dim=0)
+    count_pos = target.sum(dim=0)
+    beta = count_neg / (count_neg + count_pos + 1e-6)
+    weight = target * beta + (1. - target) * (1. - beta)
+    costs = F.binary_cross_entropy(output, target, weight=weight, reduction='none').mean(dim=0)
+    # A head without positive labels in the batch does not contribute
+    costs = torch.where(count_pos > 0, costs, torch.zeros_like(costs))
+    return (costs * weights).sum() / weights.sum()
+
+
+class DataflowStatsLogger(pl.Callback):
+    """
+    Log the per-stage statistics of dataflow_stats every epoch, and write them to
+    dataflow_stats.json in the log directory.
+    """
+
+    def on_epoch_end(self, trainer, pl_module):
+        report = dataflow_stats.collect()
+        if not report:
+            return
+        metrics = {}
+        for name, s in report.items():
+            metrics['dataflow/{}/items_per_sec'.format(name)] = s['items_per_sec']
+            metrics['dataflow/{}/latency_p50_ms'.format(name)] = s['latency_ms']['p50']
+            metrics['dataflow/{}/latency_p99_ms'.format(name)] = s['latency_ms']['p99']
+            if 'queue' in s:
+                metrics['dataflow/{}/queue'.format(name)] = s['queue']['mean']
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+        dataflow_stats.write_report(os.path.join(get_run_dir(trainer.logger), 'dataflow_stats.json'), report)
+        print('Slowest dataflow stage: {}'.format(dataflow_stats.get_bottleneck(report)))
+
+
+def get_progressive_stage(spec, epoch):
+    """
+    The (shape, batch) of the --progressive stage containing `epoch` (1-based), from
+    comma separated epoch:shape:batch stages given by their first epoch.
+    """
+    steps = sorted(tuple(int(v) for v in stage.split(':')) for stage in spec.split(','))
+    shape, batch = steps[0][1:]
+    for first_epoch, stage_shape, stage_batch in steps:
+        if epoch >= first_epoch:
+            shape, batch = stage_shape, stage_batch
+    return shape, batch
+
+
+class StepTimeLogger(pl.Callback):
+    """
+    Split the training time into waiting for the next batch and computing the step, the
+    counterpart of tf/callbacks.py StepTimeBreakdown, and warn when the input wait suggests
+    adding dataflow workers.
+
+    The trainer fetches the next batch between `on_batch_end` and the next `on_batch_start`, so
+    that gap (minus the validation runs in between) is the input wait, together with the trainer's
+    own logging. The step is from `on_batch_start` to `on_batch_end`.
+    """
+
+    def __init__(self, log_every=100, warn_threshold=0.2, decay=0.95):
+        self.log_every = log_every
+        self.warn_threshold = warn_threshold
+        self.decay = decay
+        self.ema = {}
+
+    def update(self, name, value):
+        self.ema[name] = value if name not in self.ema else \
+            self.decay * self.ema[name] + (1 - self.decay) * value
+
+    def on_epoch_start(self, trainer, pl_module):
+        self.epoch = {'compute': [], 'input_wait': []}
+        self.batch_end = None
+        self.validation = 0.0
+
+    def on_validation_start(self, trainer, pl_module):
+        self.validation_start = time.time()
+
+    def on_validation_end(self, trainer, pl_module):
+        self.validation += time.time() - self.validation_start
+
+    def on_batch_start(self, trainer, pl_module):
+        self.batch_start = time.time()
+        if self.batch_end is not None:
+            wait = self.batch_start - self.batch_end - self.validation
+            self.epoch['input_wait'].append(wait)
+            self.update('input_wait_ms', wait * 1000.0)
+        self.validation = 0.0
+
+    def on_batch_end(self, trainer, pl_module):
+        if torch.cuda.is_available():
+            # Otherwise the kernels still running would be counted as input wait
+            torch.cuda.synchronize()
+        self.batch_end = time.time()
+        compute = self.batch_end - self.batch_start
+        self.epoch['compute'].append(compute)
+        self.update('compute_ms', compute * 1000.0)
+        if trainer.global_step % self.log_every == 0 and 'input_wait_ms' in self.ema:
+            trainer.logger.log_metrics({'step_time/{}'.format(k): v for k, v in self.ema.items()},
+                                       step=trainer.global_step)
+
+    def on_epoch_end(self, trainer, pl_module):
+        if not self.epoch['input_wait']:
+            return
+        compute = np.mean(self.epoch['compute'])
+        wait = np.mean(self.epoch['input_wait'])
+        fraction = wait / (wait + compute)
+        trainer.logger.log_metrics({'step_time/epoch_step_ms': (wait + compute) * 1000.0,
+                                    'step_time/epoch_input_wait_fraction': fraction},
+                                   step=trainer.global_step)
+        print('Step time {:.1f}ms: compute {:.1f}ms, input wait {:.1f}ms ({:.0%})'.format(
+            (wait + compute) * 1000.0, compute * 1000.0, wait * 1000.0, fraction))
+        if fraction > self.warn_threshold:
+            print('WARNING: the training waits for its input {:.0%} of the time, '
+                  'more dataflow workers should help.'.format(fraction))
+
+
 class ImageNetLightningModel(LightningModule):
     def __init__(self, hparams):
         """
@@ -64,13 +231,26 @@ class ImageNetLightningModel(LightningModule):
         # self.criterion = nn.MultiLabelSoftMarginLoss(weight=None, reduction='mean')
         # self.criterion = nn.MultiLabelMarginLoss(reduction='mean')
         # self.criterion = nn.L1Loss()
-        if self.hparams.types==1:
+        if self.hparams.multitask:
+            self.head_names = get_head_names(self.hparams)
+            weights = [1.0] * self.hparams.types if self.hparams.head_weights is None else \
+                [float(w) for w in self.hparams.head_weights.split(',')]
+            self.thresholds = np.full(self.hparams.types, self.hparams.threshold) if self.hparams.thresholds is None \
+                else np.array([float(t) for t in self.hparams.thresholds.split(',')])
+            assert len(weights) == len(self.thresholds) == len(self.head_names) == self.hparams.types
+            self.register_buffer('head_weights', torch.tensor(weights))
+            self.criterion = lambda output, target: multitask_bce(output, target, self.head_weights)
+        elif self.hparams.types==1:
             self.criterion = nn.BCELoss()
         else:
             self.criterion = nn.CrossEntropyLoss()
         self.average_type = 'binary' if self.hparams.types==1 else 'weighted'
         self.val_output = np.array([])
         self.val_target = np.array([])  
+        # The training dataflow of the current (shape, batch), see train_dataloader
+        self.train_stage = None
+        self.train_dataflow = None
+        self.train_runner = None
         self.test_output = np.array([])
         self.test_target = np.array([])
 
@@ -100,7 +280,8 @@ class ImageNetLightningModel(LightningModule):
         loss = self.criterion(output, target)
 
         # in DP mode (default) make sure if result is scalar, there's another dim in the beginning
-        if self.trainer.use_dp or self.trainer.use_ddp2:
+        # (no trainer when called by evaluator.py)
+        if self.trainer is not None and (self.trainer.use_dp or self.trainer.use_ddp2):
             loss = loss.unsqueeze(0)
 
         target = target.detach().cpu().numpy()
@@ -113,7 +294,26 @@ class ImageNetLightningModel(LightningModule):
         })
         return result
 
+    def get_head_metrics(self, output, target, prefix):
+        """
+        The roc_auc (from the probabilities, -1 without both labels), f1 and f2 scores of every head.
+        """
+        metrics = {}
+        for k, name in enumerate(self.head_names):
+            label, estim = target[:, k] > 0.5, output[:, k] > self.thresholds[k]
+            metrics['{}roc_auc_{}'.format(prefix, name)] = -1 if label.min() == label.max() else \
+                sklearn.metrics.roc_auc_score(label, output[:, k])
+            metrics['{}f1_score_{}'.format(prefix, name)] = sklearn.metrics.f1_score(label, estim)
+            metrics['{}f2_score_{}'.format(prefix, name)] = sklearn.metrics.fbeta_score(label, estim, beta=2)
+        return metrics
+
     def validation_epoch_end(self, outputs, prefix='val_'):
+        if self.hparams.multitask:
+            metrics = self.get_head_metrics(self.val_output, self.val_target, prefix)
+            metrics['val_loss'] = torch.stack([x['val_loss'] for x in outputs]).mean()
+            self.val_output = np.array([])
+            self.val_target = np.array([])
+            return dict(metrics, progress_bar={'val_loss': metrics['val_loss']}, log=metrics)
         self.val_output = (self.val_output > self.hparams.threshold).astype(np.float32)
         self.val_target = (self.val_target > self.hparams.threshold).astype(np.float32)
         # print(self.val_output.shape, self.val_target.shape)
@@ -158,7 +358,8 @@ class ImageNetLightningModel(LightningModule):
         loss = self.criterion(output, target)
 
         # in DP mode (default) make sure if result is scalar, there's another dim in the beginning
-        if self.trainer.use_dp or self.trainer.use_ddp2:
+        # (no trainer when called by evaluator.py)
+        if self.trainer is not None and (self.trainer.use_dp or self.trainer.use_ddp2):
             loss = loss.unsqueeze(0)
 
         target = target.detach().cpu().numpy()
@@ -172,6 +373,12 @@ class ImageNetLightningModel(LightningModule):
         return result
 
     def test_epoch_end(self, outputs, prefix='test_'):
+        if self.hparams.multitask:
+            metrics = self.get_head_metrics(self.test_output, self.test_target, prefix)
+            metrics['test_loss'] = torch.stack([x['test_loss'] for x in outputs]).mean()
+            self.test_output = np.array([])
+            self.test_target = np.array([])
+            return dict(metrics, progress_bar={'test_loss': metrics['test_loss']}, log=metrics)
         self.test_output = (self.test_output > self.hparams.threshold).astype(np.float32)
         self.test_target = (self.test_target > self.hparams.threshold).astype(np.float32)
         # print(self.test_output.shape, self.test_target.shape)
@@ -216,16 +423,40 @@ class ImageNetLightningModel(LightningModule):
         return [optimizer], [scheduler]
 
     def train_dataloader(self):
+        shape, batch = self.hparams.shape, self.hparams.batch
+        if self.hparams.progressive:
+            # Called every epoch with reload_dataloaders_every_epoch, the torchvision backbones
+            # end in an adaptive average pooling and take any shape
+            shape, batch = get_progressive_stage(self.hparams.progressive, self.current_epoch + 1)
+        if self.train_stage == (shape, batch):
+            return self.train_dataflow
+        if self.train_runner is not None:
+            # A new stage, the workers of the previous one would block on their full queue forever
+            for proc in self.train_runner.procs:
+                proc.terminate()
+                proc.join()
+        if self.hparams.progressive:
+            print('Progressive resizing: epoch {} at shape {}, batch {}'.format(self.current_epoch + 1, shape, batch))
+        self.train_stage = (shape, batch)
+        self.train_dataflow, self.train_runner = self.get_train_dataflow(shape, batch)
+        return self.train_dataflow
+
+    def get_train_dataflow(self, shape, batch):
+        """
+        Returns:
+            the training dataflow at `shape` and `batch`, and its MultiProcessRunner.
+        """
         ds_train = Vinmec(folder=self.hparams.data_path,
                           is_train='train',
                           fname='train.csv',
                           types=self.hparams.types,
                           pathology=self.hparams.pathology,
-                          resize=int(self.hparams.shape))
+                          resize=int(shape),
+                          pyramid=self.hparams.pyramid)
 
         ds_train.reset_state()
         ag_train = [
-            imgaug.Albumentations(AB.SmallestMaxSize(self.hparams.shape, p=1.0)), 
+            imgaug.Albumentations(AB.SmallestMaxSize(shape, p=1.0)), 
             imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
             imgaug.RandomChooseAug([
                 imgaug.Albumentations(AB.Blur(blur_limit=4, p=0.25)),  
@@ -237,24 +468,36 @@ class ImageNetLightningModel(LightningModule):
             imgaug.GoogleNetRandomCropAndResize(crop_area_fraction=(0.8, 1.0), 
                     aspect_ratio_range=(0.8, 1.2),
                     interp=cv2.INTER_AREA, 
-                    target_shape=self.hparams.shape),
+                    target_shape=shape),
             imgaug.ToFloat32(),
         ]
-        ds_train = AugmentImageComponent(ds_train, ag_train, 0)
+        if self.hparams.dataflow_stats:
+            # One stage per augmentor, so that each of them is timed
+            ds_train = InstrumentedData(ds_train, 'vinmec')
+            for k, aug in enumerate(ag_train):
+                ds_train = InstrumentedData(AugmentImageComponent(ds_train, [aug], 0, copy=(k == 0)),
+                                            'aug{}_{}'.format(k, type(aug).__name__))
+        else:
+            ds_train = AugmentImageComponent(ds_train, ag_train, 0)
         # Label smoothing
         ag_label = [ 
             imgaug.BrightnessScale((0.8, 1.2), clip=False),
         ]
         # ds_train = AugmentImageComponent(ds_train, ag_label, 1)
-        ds_train = BatchData(ds_train, self.hparams.batch, remainder=True)
+        ds_train = BatchData(ds_train, batch, remainder=True)
+        if self.hparams.dataflow_stats:
+            ds_train = InstrumentedData(ds_train, 'batch')
         ds_train = PrintData(ds_train)
         if self.hparams.debug:
             ds_train = FixedSizeData(ds_train, 2)
-        ds_train = MultiProcessRunner(ds_train, num_proc=8, num_prefetch=16)
+        runner = MultiProcessRunner(ds_train, num_proc=self.hparams.num_proc, num_prefetch=16)
+        ds_train = runner
+        if self.hparams.dataflow_stats:
+            ds_train = InstrumentedData(runner, 'runner', queue_size=lambda: runner.queue.qsize())
         ds_train = MapData(ds_train,
                            lambda dp: [torch.tensor(np.transpose(dp[0], (0, 3, 1, 2)) ), 
                                        torch.tensor(dp[1]).float() ])
-        return ds_train
+        return ds_train, runner
 
     def val_dataloader(self):
         ds_valid = Vinmec(folder=self.hparams.data_path,
@@ -262,7 +505,8 @@ class ImageNetLightningModel(LightningModule):
                           fname='valid.csv',
                           types=self.hparams.types,
                           pathology=self.hparams.pathology,
-                          resize=int(self.hparams.shape))
+                          resize=int(self.hparams.shape),
+                          pyramid=self.hparams.pyramid)
 
         ds_valid.reset_state()
         ag_valid = [
@@ -286,7 +530,8 @@ class ImageNetLightningModel(LightningModule):
                           fname='test.csv',
                           types=self.hparams.types,
                           pathology=self.hparams.pathology,
-                          resize=int(self.hparams.shape))
+                          resize=int(self.hparams.shape),
+                          pyramid=self.hparams.pyramid)
 
         ds_test.reset_state()
         ag_test = [
@@ -334,7 +579,7 @@ class ImageNetLightningModel(LightningModule):
         return parser
 
 
-def get_args():
+def get_parser():
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument('--data_path', metavar='DIR', default=".", type=str,
                                help='path to dataset')
@@ -356,16 +601,46 @@ def get_args():
     parent_parser.add_argument('--threshold', type=float, default=0.5)
     parent_parser.add_argument('--pathology', default='Fracture')
     parent_parser.add_argument('--shape', type=int, default=320)
+    parent_parser.add_argument('--num_proc', type=int, default=8, help='processes of the training dataflow')
+    parent_parser.add_argument('--pyramid', action='store_true',
+                               help='read the images from the multi-resolution store written by pyramid.py')
+    parent_parser.add_argument('--progressive', default=None,
+                               help='progressive resizing, comma separated epoch:shape:batch stages from their '
+                                    'first epoch, e.g. 1:128:128,81:224:96,161:320:64')
+    parent_parser.add_argument('--multitask', action='store_true',
+                               help='one backbone for every pathology of --types: a class balance, a loss weight, '
+                                    'a threshold, metrics and a best checkpoint per head')
+    parent_parser.add_argument('--head_weights', default=None,
+                               help='comma separated loss weights of the heads, default 1')
+    parent_parser.add_argument('--thresholds', default=None,
+                               help='comma separated decision thresholds of the heads, default --threshold')
+    parent_parser.add_argument('--best_metric', default='roc_auc', choices=['roc_auc', 'f1_score', 'f2_score'],
+                               help='per-head validation metric whose best checkpoint --multitask keeps')
+    parent_parser.add_argument('--accum', type=int, default=1,
+                               help='micro-batches of --batch whose gradients are accumulated into one Adam update')
 
     # Inference purpose
     parent_parser.add_argument('--load', action='store_true', 
                                help='path to logging output')
     parent_parser.add_argument('--pred', action='store_true', help='run predict')
     parent_parser.add_argument('--eval', action='store_true', help='run offline evaluation instead of training')
+    parent_parser.add_argument('--async_eval', action='store_true',
+                               help='skip validation and only save a checkpoint every epoch, for evaluator.py')
+    parent_parser.add_argument('--dataflow_stats', action='store_true',
+                               help='time every stage of the training dataflow, see dataflow_stats.py')
+    parent_parser.add_argument('--step_breakdown', action='store_true',
+                               help='split the step time into input wait and compute')
+    parent_parser.add_argument('--trace_every', type=int, default=100,
+                               help='steps between two logs of --step_breakdown')
+    parent_parser.add_argument('--input_wait_warn', type=float, default=0.2,
+                               help='fraction of input wait over which --step_breakdown warns')
     
     
-    parser = ImageNetLightningModel.add_model_specific_args(parent_parser)
-    return parser.parse_args()
+    return ImageNetLightningModel.add_model_specific_args(parent_parser)
+
+
+def get_args():
+    return get_parser().parse_args()
 
 
 def main(hparams):
@@ -381,6 +656,28 @@ def main(hparams):
 
 
 
+    callbacks = []
+    trainer_kwargs = {}
+    if hparams.async_eval:
+        # The valid/test scores come from evaluator.py watching the checkpoints
+        callbacks.append(EpochCheckpoint())
+        trainer_kwargs['val_percent_check'] = 0.0
+    if hparams.dataflow_stats:
+        # Before the dataflow workers are forked
+        dataflow_stats.enable(os.path.join(hparams.save_path, 'dataflow_stats'))
+        callbacks.append(DataflowStatsLogger())
+    if hparams.step_breakdown:
+        callbacks.append(StepTimeLogger(hparams.trace_every, hparams.input_wait_warn))
+    if hparams.progressive:
+        trainer_kwargs['reload_dataloaders_every_epoch'] = True
+    if hparams.multitask and not hparams.async_eval:
+        callbacks.append(BestHeadCheckpoint(['val_{}_{}'.format(hparams.best_metric, name)
+                                             for name in get_head_names(hparams)]))
+    if hparams.accum > 1:
+        # multitask_bce balances every head on the labels of its own batch, not of the accumulated group
+        assert not hparams.multitask, "--multitask does not support --accum"
+        # Lightning divides every micro-batch loss by accum, the update is on their mean gradient
+        trainer_kwargs['accumulate_grad_batches'] = hparams.accum
     trainer = pl.Trainer(
         default_save_path=hparams.save_path,
         gpus=hparams.gpus,
@@ -389,12 +686,15 @@ def main(hparams):
         distributed_backend=hparams.distributed_backend,
         use_amp=hparams.use_16bit,
         fast_dev_run=hparams.fast_dev_run,
+        callbacks=callbacks,
+        **trainer_kwargs
     )
     if hparams.eval:
         trainer.run_evaluation()
     else:
         trainer.fit(model)
-        trainer.test()
+        if not hparams.async_eval:
+            trainer.test()
 
 if __name__ == '__main__':
     main(get_args())
\ No newline at end of file
@@ -0,0 +1,272 @@
+# coding=utf-8
+"""
+Benchmark the input pipelines of run_vinmec.py (tf, or tfdata for --input_mode=tfdata) and
+run_vinmec_pytorch.py (pt) on CPU:
+the exact train, valid and pred dataflows, over a matrix of worker counts, batch sizes and shapes.
+Reports the sustained batches/sec, images/sec, CPU utilization (in cores, workers included) and RSS.
+
+Example:
+    python synthetic.py --output=/tmp/synthetic --num=2000
+    python benchmark_input.py --data=/tmp/synthetic --workers=1,2,4,8 --batches=32,64 --shapes=256 \
+        --output=benchmark_input.json --save_baseline=baseline_input.json
+    # later, fail if the images/sec of a configuration dropped by more than 10%
+    python benchmark_input.py --data=/tmp/synthetic --workers=1,2,4,8 --batches=32,64 --shapes=256 \
+        --baseline=baseline_input.json --threshold=0.1
+
+The workers only apply to the train dataflows, valid and pred are single process in both scripts,
+and tf.data autotunes its own parallelism.
+Every configuration runs in its own process, so that its workers and memory do not leak into the next one.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+from datetime import datetime
+
+import psutil
+from tabulate import tabulate
+
+
+SPLITS = ['train', 'valid', 'pred']
+PT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pt')
+
+
+def get_tf_dataflow(data, split, workers, batch, shape):
+    from run_vinmec import get_parser, get_train_dataflow, get_eval_dataflow
+    args = get_parser().parse_args(['--data', data, '--batch', str(batch), '--shape', str(shape),
+                                    '--num_proc', str(workers)])
+    if split == 'train':
+        return get_train_dataflow(args)
+    if split == 'valid':
+        return get_eval_dataflow(args, 'valid_v2.csv', is_train='valid')
+    return get_eval_dataflow(args, 'test.csv', is_train='test')
+
+
+class DatasetIterator(object):
+    """
+    Iterate a tf.data.Dataset in its own session, like a DataFlow.
+    """
+
+    def __init__(self, dataset):
+        from run_vinmec import tf
+        self.tf = tf
+        self.iterator = dataset.make_initializable_iterator()
+        self.next = self.iterator.get_next()
+
+    def reset_state(self):
+        self.sess = self.tf.Session()
+
+    def __iter__(self):
+        self.sess.run(self.iterator.initializer)
+        while True:
+            try:
+                yield self.sess.run(self.next)
+            except self.tf.errors.OutOfRangeError:
+                return
+
+
+def get_tfdata_dataflow(data, split, workers, batch, shape):
+    import tfdata
+    from run_vinmec import get_parser, get_train_augmentors, get_eval_augmentors
+    args = get_parser().parse_args(['--data', data, '--batch', str(batch), '--shape', str(shape)])
+    if split == 'train':
+        dataset = tfdata.get_dataset(args, 'train_v2.csv', get_train_augmentors(args), batch, is_train='train')
+    elif split == 'valid':
+        dataset = tfdata.get_dataset(args, 'valid_v2.csv', get_eval_augmentors(), batch, is_train='valid')
+    else:
+        dataset = tfdata.get_dataset(args, 'test.csv', get_eval_augmentors(), batch, is_train='test')
+    return DatasetIterator(dataset)
+
+
+def get_pt_dataflow(data, split, workers, batch, shape):
+    # pt has its own vinmec.py and dataflow_stats.py, they must shadow the tf ones
+    sys.path.insert(0, PT_DIR)
+    from run_vinmec_pytorch import ImageNetLightningModel, get_parser
+    hparams = get_parser().parse_args(['--data_path', data, '--batch', str(batch), '--shape', str(shape),
+                                       '--num_proc', str(workers)])
+    model = ImageNetLightningModel(hparams)
+    if split == 'train':
+        return model.train_dataloader()
+    if split == 'valid':
+        return model.val_dataloader()
+    return model.test_dataloader()
+
+
+def process_tree(proc):
+    return [proc] + proc.children(recursive=True)
+
+
+def cpu_seconds(procs):
+    total = 0.0
+    for p in procs:
+        try:
+            times = p.cpu_times()
+            total += times.user + times.system
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def rss_mb(procs):
+    total = 0
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total / 1024.0 / 1024.0
+
+
+def batches_forever(ds):
+    while True:
+        for dp in ds:
+            yield dp
+
+
+def measure(framework, data, split, workers, batch, shape, num_batches=50, warmup=5):
+    """
+    Iterate `warmup` batches, then time `num_batches`. Expected to run in a fresh process.
+    Returns:
+        dict with 'batches_per_sec', 'images_per_sec', 'cpu_cores' (CPU seconds of this process
+        and its workers per second) and 'rss_mb' (of the same processes, at the end).
+    """
+    get_dataflow = {'tf': get_tf_dataflow, 'tfdata': get_tfdata_dataflow, 'pt': get_pt_dataflow}[framework]
+    ds = get_dataflow(data, split, workers, batch, shape)
+    ds.reset_state()
+    itr = batches_forever(ds)
+    for _ in range(warmup):
+        next(itr)
+
+    procs = process_tree(psutil.Process())
+    cpu_start = cpu_seconds(procs)
+    start = time.time()
+    images = 0
+    for _ in range(num_batches):
+        images += len(next(itr)[0])
+    elapsed = time.time() - start
+    return {
+        'batches_per_sec': num_batches / elapsed,
+        'images_per_sec': images / elapsed,
+        'cpu_cores': (cpu_seconds(procs) - cpu_start) / elapsed,
+        'rss_mb': rss_mb(procs),
+    }
+
+
+def _worker(config, num_batches, warmup, results):
+    try:
+        results.put(measure(num_batches=num_batches, warmup=warmup, **config))
+    except Exception as e:
+        results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+    # The dataflow workers are not always stopped at exit
+    for child in psutil.Process().children(recursive=True):
+        child.kill()
+
+
+def measure_in_subprocess(config, num_batches=50, warmup=5):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=_worker, args=(config, num_batches, warmup, results))
+    proc.start()
+    proc.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        # Killed, typically by the kernel when the host runs out of memory
+        return {'error': 'exit code {}'.format(proc.exitcode)}
+
+
+def get_key(r):
+    return '{framework}/{split}/w{workers}/b{batch}/s{shape}'.format(**r)
+
+
+def get_configs(args):
+    configs = []
+    for framework in args.frameworks.split(','):
+        for split in args.splits.split(','):
+            # Single process dataflows, whatever the number of workers, and autotuned tf.data
+            workers = [int(w) for w in args.workers.split(',')] if split == 'train' and framework != 'tfdata' else [0]
+            for w in workers:
+                for batch in [int(b) for b in args.batches.split(',')]:
+                    for shape in [int(s) for s in args.shapes.split(',')]:
+                        configs.append(dict(framework=framework, data=args.data, split=split,
+                                            workers=w, batch=batch, shape=shape))
+    return configs
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns:
+        the keys of the results whose images/sec is more than `threshold` (a fraction) below the baseline.
+    """
+    baseline = {get_key(r): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for r in results:
+        key = get_key(r)
+        if 'error' in r or key not in baseline:
+            continue
+        r['baseline_images_per_sec'] = baseline[key]['images_per_sec']
+        if r['images_per_sec'] < baseline[key]['images_per_sec'] * (1 - threshold):
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True, help='dataset folder, e.g. written by synthetic.py')
+    parser.add_argument('--frameworks', default='tf,pt',
+                        help='comma separated list of tf, tfdata (run_vinmec.py --input_mode=tfdata), pt')
+    parser.add_argument('--splits', default=','.join(SPLITS), help='comma separated list of train, valid, pred')
+    parser.add_argument('--workers', default='1,2,4,8', help='comma separated list of train dataflow processes')
+    parser.add_argument('--batches', default='32,64', help='comma separated list of batch sizes')
+    parser.add_argument('--shapes', default='256', help='comma separated list of image sizes')
+    parser.add_argument('--num_batches', type=int, default=50, help='timed batches per configuration')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--output', default='benchmark_input.json')
+    parser.add_argument('--baseline', help='json of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='images/sec drop from the baseline reported as a regression, as a fraction')
+    parser.add_argument('--save_baseline', help='also write the results to this baseline file')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    results = []
+    for config in get_configs(args):
+        result = measure_in_subprocess(config, args.num_batches, args.warmup)
+        result.update((k, v) for k, v in config.items() if k != 'data')
+        results.append(result)
+        print('{}: {}'.format(get_key(result), result.get('error', '{:.1f} images/s'.format(
+            result.get('images_per_sec', 0)))))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    rows = []
+    for r in results:
+        if 'error' in r:
+            rows.append([r['framework'], r['split'], r['workers'], r['batch'], r['shape'], r['error']])
+            continue
+        row = [r['framework'], r['split'], r['workers'], r['batch'], r['shape'],
+               '{:.2f}'.format(r['batches_per_sec']), '{:.1f}'.format(r['images_per_sec']),
+               '{:.2f}'.format(r['cpu_cores']), '{:.0f}'.format(r['rss_mb'])]
+        if 'baseline_images_per_sec' in r:
+            row.append('{:+.1%}{}'.format(r['images_per_sec'] / r['baseline_images_per_sec'] - 1,
+                                          ' REGRESSION' if get_key(r) in regressions else ''))
+        rows.append(row)
+    print(tabulate(rows, headers=['fw', 'split', 'workers', 'batch', 'shape', 'batches/s', 'images/s',
+                                  'cpu cores', 'rss MB', 'vs baseline']))
+
+    content = {'date': datetime.now().isoformat(), 'data': args.data, 'num_batches': args.num_batches,
+               'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(content, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(content, f, indent=2)
+    if regressions:
+        print('{} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
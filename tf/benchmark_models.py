@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+Benchmark the tf/models backbones on CPU: parameter count, FLOPs, forward and
+forward+backward latency and peak host memory, written to a json file.
+
+Example:
+    python benchmark_models.py --shape=256 --types=16 --batches=1,8 --output=benchmark.json
+    python benchmark_models.py --models=DenseNet121,ResNet101:se,CapsNet --shape=320
+
+Every (model, batch) is profiled in its own process so that the peak memory of one
+does not leak into the next one.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import time
+from datetime import datetime
+
+import numpy as np
+
+
+MODELS = ['VGG16', 'ShuffleNet',
+          'ResNet101:preact', 'ResNet101:resnet', 'ResNet101:se', 'ResNet101:resnext32x4d',
+          'DenseNet121', 'DenseNet169', 'DenseNet201',
+          'InceptionBN', 'CapsNet']
+
+
+def peak_memory_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def time_run(sess, fetches, feed_dict, iters, warmup):
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    latency = []
+    for _ in range(iters):
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        latency.append((time.time() - start) * 1000.0)
+    return {
+        'mean': float(np.mean(latency)),
+        'p50': float(np.percentile(latency, 50)),
+        'p90': float(np.percentile(latency, 90)),
+    }
+
+
+def build(args, batch, is_training):
+    """
+    Build the run_vinmec.py graph of `args.name` with a fixed batch size in the current graph.
+    Returns:
+        the image and label placeholders, the estim and cost tensors.
+    """
+    from tensorpack.tfutils.tower import TowerContext
+    from run_vinmec import Model, tf
+    image = tf.placeholder(tf.float32, [batch, args.shape, args.shape, 1], 'image')
+    label = tf.placeholder(tf.float32, [batch, args.types], 'label')
+    with TowerContext('', is_training=is_training):
+        cost = Model(args=args).build_graph(image, label)
+    estim = tf.get_default_graph().get_tensor_by_name('estim:0')
+    return image, label, estim, cost
+
+
+def profile_model(args, batch, iters=10, warmup=2):
+    """
+    Profile one backbone. Expected to run in a fresh process.
+    Args:
+        args: a run_vinmec.py argument namespace, `args.name`/`args.mode` select the backbone.
+        batch (int): batch size of the placeholders.
+    Returns:
+        dict with 'params', 'flops' (forward, multiply-adds counted as 2),
+        'forward_ms'/'forward_backward_ms' per batch and 'peak_memory_mb'.
+    """
+    from run_vinmec import tf
+    result = {'baseline_memory_mb': peak_memory_mb()}
+    feed = lambda image, label: {
+        image: np.random.uniform(0, 255, image.shape.as_list()).astype(np.float32),
+        label: np.random.randint(0, 2, label.shape.as_list()).astype(np.float32)}
+
+    with tf.Graph().as_default() as graph:
+        image, label, estim, _ = build(args, batch, is_training=False)
+        result['params'] = int(sum(np.prod(v.shape.as_list()) for v in tf.trainable_variables()))
+        flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation())
+        result['flops'] = int(flops.total_float_ops)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            result['forward_ms'] = time_run(sess, estim, feed(image, label), iters, warmup)
+
+    with tf.Graph().as_default():
+        image, label, _, cost = build(args, batch, is_training=True)
+        grads = tf.gradients(cost, tf.trainable_variables())
+        grads = [g for g in grads if g is not None]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            result['forward_backward_ms'] = time_run(sess, grads, feed(image, label), iters, warmup)
+
+    result['peak_memory_mb'] = peak_memory_mb()
+    return result
+
+
+def _worker(args, batch, iters, warmup, results):
+    try:
+        results.put(profile_model(args, batch, iters, warmup))
+    except Exception as e:
+        results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def profile_in_subprocess(args, batch, iters=10, warmup=2):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=_worker, args=(args, batch, iters, warmup, results))
+    proc.start()
+    proc.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        # Killed, typically by the kernel when the host runs out of memory
+        return {'error': 'exit code {}'.format(proc.exitcode)}
+
+
+def get_model_args(spec, shape, types):
+    """
+    Turn 'ResNet101:se' into a run_vinmec.py argument namespace on CPU defaults.
+    """
+    from run_vinmec import get_parser
+    name, _, mode = spec.partition(':')
+    argv = ['--name', name, '--shape', str(shape), '--types', str(types),
+            '--data_format', 'channels_last']
+    if mode:
+        argv += ['--mode', mode]
+    return get_parser().parse_args(argv)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default=','.join(MODELS),
+                        help='comma separated list, name[:resnet mode]')
+    parser.add_argument('--shape', type=int, default=256)
+    parser.add_argument('--types', type=int, default=16)
+    parser.add_argument('--batches', default='1,8', help='comma separated list of batch sizes')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', default='benchmark_models.json')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    batches = [int(b) for b in args.batches.split(',')]
+    results = []
+    for spec in args.models.split(','):
+        model_args = get_model_args(spec, args.shape, args.types)
+        for batch in batches:
+            result = profile_in_subprocess(model_args, batch, args.iters, args.warmup)
+            result.update(model=spec, batch=batch)
+            results.append(result)
+            if 'error' in result:
+                print('{:<24} batch {:>3}: {}'.format(spec, batch, result['error']))
+                continue
+            print('{:<24} batch {:>3}: {:>7.2f}M params {:>8.2f} GFLOPs '
+                  'fwd {:>9.1f}ms fwd+bwd {:>9.1f}ms peak {:>8.0f}MB'.format(
+                      spec, batch, result['params'] / 1e6, result['flops'] / 1e9,
+                      result['forward_ms']['mean'], result['forward_backward_ms']['mean'],
+                      result['peak_memory_mb']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.now().isoformat(), 'shape': args.shape, 'types': args.types,
+                   'iters': args.iters, 'results': results}, f, indent=2)
+    print('Results written to {}'.format(args.output))
@@ -0,0 +1,275 @@
+# coding=utf-8
+"""
+Training callbacks used by run_vinmec.py.
+"""
+import os
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+tf = tf.compat.v1
+
+from tensorpack.callbacks import Callback, MergeAllSummaries
+from tensorpack.utils import logger
+
+import dataflow_stats
+
+
+class HostPeakMemoryTracker(Callback):
+    """
+    Write the peak resident memory of the training process (the host counterpart of
+    tensorpack's GPUMemoryTracker) to the monitors every epoch.
+    """
+    _chief_only = False
+
+    def _trigger_epoch(self):
+        # ru_maxrss is in KB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        self.trainer.monitors.put_scalar('PeakHostMemory(MB)', peak)
+
+
+# Collections of the heavy summaries, merged by their own MergeAllSummaries
+# instead of the default one that also carries the scalars.
+IMAGE_SUMMARIES = 'image_summaries'
+HISTOGRAM_SUMMARIES = 'histogram_summaries'
+
+
+def get_summary_callbacks(args):
+    """
+    Returns:
+        the callbacks evaluating the image and histogram summaries every
+        `args.image_summary_period` / `args.histogram_summary_period` steps (0: end of epoch only),
+        and a :class:`SummaryOverheadTracker` for those periods.
+    """
+    if args.no_image_hist_summaries:
+        return []
+    periods = [args.image_summary_period, args.histogram_summary_period]
+    return [MergeAllSummaries(period=args.image_summary_period, key=IMAGE_SUMMARIES),
+            MergeAllSummaries(period=args.histogram_summary_period, key=HISTOGRAM_SUMMARIES),
+            SummaryOverheadTracker(periods)]
+
+
+class SummaryOverheadTracker(Callback):
+    """
+    Compare the duration of the steps which evaluate summaries with the other steps,
+    and write the extra time per summary step and its share of the epoch to the monitors.
+    """
+
+    def __init__(self, periods):
+        """
+        Args:
+            periods (list[int]): the periods of the MergeAllSummaries callbacks to account for.
+                Summaries always run at the last step of an epoch.
+        """
+        self._periods = [p for p in periods if p > 0]
+
+    def _is_summary_step(self):
+        if self.local_step == self.trainer.steps_per_epoch - 1:
+            return True
+        return any((self.local_step + 1) % p == 0 for p in self._periods)
+
+    def _before_epoch(self):
+        self._durations = {True: [], False: []}
+
+    def _before_run(self, _):
+        self._start = time.time()
+        return None
+
+    def _after_run(self, _, __):
+        self._durations[self._is_summary_step()].append(time.time() - self._start)
+
+    def _trigger_epoch(self):
+        summary, plain = self._durations[True], self._durations[False]
+        if not summary or not plain:
+            return
+        extra = np.mean(summary) - np.mean(plain)
+        total = np.sum(summary) + np.sum(plain)
+        self.trainer.monitors.put_scalar('SummaryOverhead/step(ms)', extra * 1000.0)
+        self.trainer.monitors.put_scalar('SummaryOverhead/fraction', extra * len(summary) / total)
+
+
+def get_dataflow_state_path(logdir, global_step):
+    return os.path.join(logdir, 'dataflow-{}.npz'.format(global_step))
+
+
+class DataflowStateSaver(Callback):
+    """
+    Save, next to the checkpoint of the same global step, the position of the next unseen
+    training sample: the seed and epoch which determine the order, the order itself and the offset in it.
+    Trigger it together with the ModelSaver, e.g. in the same PeriodicTrigger.
+    Every step is assumed to read a single batch, i.e. a single training tower.
+    """
+
+    def __init__(self, ds, batch, position=(0, 0), max_to_keep=10):
+        """
+        Args:
+            ds (Vinmec): the training dataset, with a seed.
+            batch (int): batch size, the remainder of every epoch is dropped by BatchData.
+            position: (epoch, offset) of `ds` at the start of the training.
+        """
+        assert ds.seed is not None, "The order of an unseeded dataset cannot be restored"
+        self.ds = ds
+        self.batch = batch
+        self.position = position
+        self.max_to_keep = max_to_keep
+
+    def _before_train(self):
+        self.start_step = self.global_step
+        self.saved = []
+
+    def get_position(self, global_step):
+        steps_per_epoch = len(self.ds) // self.batch
+        epoch, offset = self.position
+        steps = offset // self.batch + global_step - self.start_step
+        return epoch + steps // steps_per_epoch, (steps % steps_per_epoch) * self.batch
+
+    def _trigger(self):
+        epoch, offset = self.get_position(self.global_step)
+        path = get_dataflow_state_path(logger.get_logger_dir(), self.global_step)
+        np.savez(path, seed=self.ds.seed, epoch=epoch, offset=offset, batch=self.batch,
+                 indices=self.ds.get_indices(epoch))
+        self.saved.append(path)
+        while len(self.saved) > self.max_to_keep:
+            os.remove(self.saved.pop(0))
+
+
+def load_dataflow_state(logdir, global_step):
+    """
+    Returns:
+        dict with 'seed', 'epoch', 'offset', 'batch' and 'indices', or None if nothing was saved at this step.
+    """
+    path = get_dataflow_state_path(logdir, global_step)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as state:
+        return {k: state[k] if k == 'indices' else int(state[k]) for k in state.files}
+
+
+class ResumeEpoch(Callback):
+    """
+    Run only the remaining `steps` of the first epoch, so that the epochs of a training
+    resumed mid-epoch stay aligned with the epochs of the dataflow.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self._done = False
+
+    def _before_epoch(self):
+        if not self._done:
+            self._steps_per_epoch = self.trainer.loop.steps_per_epoch
+            self.trainer.loop.steps_per_epoch = self.steps
+
+    def _after_epoch(self):
+        if not self._done:
+            self.trainer.loop.steps_per_epoch = self._steps_per_epoch
+            self._done = True
+
+
+class DataflowStatsMonitor(Callback):
+    """
+    Write the per-stage statistics of dataflow_stats to the monitors every epoch
+    (or when triggered), and to dataflow_stats.json in the log directory.
+    """
+    _chief_only = False
+
+    def _trigger(self):
+        report = dataflow_stats.collect()
+        for name, s in report.items():
+            self.trainer.monitors.put_scalar('dataflow/{}/items_per_sec'.format(name), s['items_per_sec'])
+            self.trainer.monitors.put_scalar('dataflow/{}/latency_p50(ms)'.format(name), s['latency_ms']['p50'])
+            self.trainer.monitors.put_scalar('dataflow/{}/latency_p99(ms)'.format(name), s['latency_ms']['p99'])
+            if 'queue' in s:
+                self.trainer.monitors.put_scalar('dataflow/{}/queue'.format(name), s['queue']['mean'])
+        if report:
+            logger.info("Slowest dataflow stage: {}".format(dataflow_stats.get_bottleneck(report)))
+            dataflow_stats.write_report(os.path.join(logger.get_logger_dir(), 'dataflow_stats.json'), report)
+
+
+class StepTimeBreakdown(Callback):
+    """
+    Split the training time into waiting for the input queue, running the graph and running
+    the callbacks, and warn when the input wait suggests adding dataflow workers.
+
+    Register it first, so that its hooks wrap the session run as tightly as possible:
+    - run: from its `before_run` to its `after_run`, i.e. the session run.
+    - input wait: the time the QueueInput dequeue (or the tf.data IteratorGetNext) blocks inside the run,
+      measured on a full trace
+      every `trace_every` steps (the trace itself slows these steps down, they are excluded from the
+      run statistics).
+    - callbacks: the rest of each step (other `after_run` hooks, `trigger_step`) and the time between
+      two epochs (`trigger_epoch`, i.e. ModelSaver, InferenceRunner, summaries).
+    """
+
+    def __init__(self, trace_every=100, warn_threshold=0.2, decay=0.95):
+        self.trace_every = trace_every
+        self.warn_threshold = warn_threshold
+        self.decay = decay
+        self._ema = {}
+        self._last_end = None
+
+    def _setup_graph(self):
+        self._trace_args = tf.train.SessionRunArgs(
+            fetches=[], options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+
+    def _before_epoch(self):
+        now = time.time()
+        if self._last_end is not None:
+            # The epoch callbacks of the previous epoch
+            self.trainer.monitors.put_scalar('StepTime/epoch_callbacks(s)', now - self._last_end)
+        self._epoch = {'step': [], 'run': [], 'callbacks': [], 'input_wait': []}
+        self._prev_start = None
+
+    def _before_run(self, _):
+        now = time.time()
+        if self._prev_start is not None:
+            step = now - self._prev_start
+            self._epoch['step'].append(step)
+            self._epoch['callbacks'].append(step - self._run)
+            self._update('callbacks', step - self._run)
+        self._prev_start = now
+        self._traced = self.trace_every > 0 and self.global_step % self.trace_every == 0
+        return self._trace_args if self._traced else None
+
+    def _after_run(self, _, run_values):
+        self._last_end = time.time()
+        self._run = self._last_end - self._prev_start
+        if self._traced and run_values.run_metadata is not None:
+            wait = self._dequeue_time(run_values.run_metadata)
+            self._epoch['input_wait'].append(wait / self._run)
+            self._update('input_wait', wait / self._run)
+            for name, value in self._ema.items():
+                self.trainer.monitors.put_scalar('StepTime/{}'.format(name), value)
+        else:
+            self._epoch['run'].append(self._run)
+            self._update('run(ms)', self._run * 1000.0)
+
+    def _update(self, name, value):
+        self._ema[name] = value if name not in self._ema else \
+            self.decay * self._ema[name] + (1 - self.decay) * value
+
+    @staticmethod
+    def _dequeue_time(run_metadata):
+        wait = 0
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                if 'QueueDequeue' in node.timeline_label or node.node_name.endswith('input_deque') or \
+                        'IteratorGetNext' in node.timeline_label:
+                    wait += node.all_end_rel_micros
+        return wait / 1e6
+
+    def _trigger_epoch(self):
+        if not self._epoch['run']:
+            return
+        step = np.mean(self._epoch['step']) if self._epoch['step'] else np.mean(self._epoch['run'])
+        callbacks = np.mean(self._epoch['callbacks']) if self._epoch['callbacks'] else 0.0
+        input_wait = np.mean(self._epoch['input_wait']) if self._epoch['input_wait'] else float('nan')
+        self.trainer.monitors.put_scalar('StepTime/epoch_step(ms)', step * 1000.0)
+        self.trainer.monitors.put_scalar('StepTime/epoch_callbacks_fraction', callbacks / step)
+        self.trainer.monitors.put_scalar('StepTime/epoch_input_wait_fraction', input_wait)
+        logger.info("Step time {:.1f}ms: run {:.1f}ms ({:.0%} of it waiting for input), callbacks {:.1f}ms".format(
+            step * 1000.0, np.mean(self._epoch['run']) * 1000.0, input_wait, callbacks * 1000.0))
+        if input_wait > self.warn_threshold:
+            logger.warn("The training waits for its input {:.0%} of the session run time, "
+                        "more dataflow workers should help.".format(input_wait))
@@ -18,14 +18,18 @@ from tensorpack.tfutils.scope_utils import auto_reuse_variable_scope
 
 import tensorpack.tfutils.symbolic_functions as symbf
 
+from dataflow_stats import InstrumentedData, collect, enable, get_bottleneck, stage
+from pyramid import PyramidStore
+
 import tensorflow as tf
 
 class Chexpert(RNGDataFlow):
     # https://github.com/tensorpack/tensorpack/blob/master/tensorpack/dataflow/image.py
     """ Produce images read from a list of files as (h, w, c) arrays. """
-    def __init__(self, folder, group=14, train_or_valid='train', channel=1, resize=None, debug=False, shuffle=False, fname="train.csv"):
+    def __init__(self, folder, group=14, train_or_valid='train', channel=1, resize=None, debug=False, shuffle=False, fname="train.csv",
+                 pyramid=False):
         """
-        
+        pyramid: read the images from the pyramid.py store at the smallest level at or above resize.
         """
         self.version = "1.0.0"
         self.description = "CheXpert is a large dataset of chest X-rays and competition for automated chest \nx-ray interpretation, which features uncertainty labels and radiologist-labeled \nreference standard evaluation sets. It consists of 224,316 chest radiographs \nof 65,240 patients, where the chest radiographic examinations and the associated \nradiology reports were retrospectively collected from Stanford Hospital. Each \nreport was labeled for the presence of 14 observations as positive, negative, \nor uncertain. We decided on the 14 observations based on the prevalence in the \nreports and clinical relevance.\n",
@@ -39,6 +43,8 @@ class Chexpert(RNGDataFlow):
         if resize is not None:
             resize = shape2d(resize)
         self.resize = resize
+        self.store = PyramidStore(folder) if pyramid else None
+        self.level = self.store.get_level(resize) if pyramid and resize is not None else None
         self.debug = debug
         self.shuffle = shuffle
         self.small = True if "small" in self.folder else False
@@ -87,13 +93,19 @@ class Chexpert(RNGDataFlow):
         
         for idx in indices:
             f = os.path.join(os.path.dirname(self.folder), self.df.iloc[idx]['Path']) # Get parent directory
-            image = cv2.imread(f, self.imread_mode)
+            if self.level is not None:
+                f = self.store.get_path(self.df.iloc[idx]['Path'], self.level, f)
+            with stage('read'):
+                buf = np.fromfile(f, dtype=np.uint8)
+            with stage('decode'):
+                image = cv2.imdecode(buf, self.imread_mode)
             assert image is not None, f
 
             if self.channel == 3:
                 image = image[:, :, ::-1]
             if self.resize is not None:
-                image = cv2.resize(image, tuple(self.resize[::-1]))
+                with stage('resize'):
+                    image = cv2.resize(image, tuple(self.resize[::-1]))
             if self.channel == 1:
                 image = image[:, :, np.newaxis]
 
@@ -158,13 +170,28 @@ class Chexpert(RNGDataFlow):
             yield [image, group]
 
 if __name__ == '__main__':
-    ds = Chexpert(folder='/u01/data/CheXpert-v1.0-small', 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default='/u01/data/CheXpert-v1.0-small')
+    parser.add_argument('--shape', type=int, default=256)
+    parser.add_argument('--num_proc', type=int, default=8, help='MultiProcessRunnerZMQ workers, 0: none')
+    parser.add_argument('--size', type=int, default=100, help='number of batches to time')
+    parser.add_argument('--pyramid', action='store_true', help='read from the pyramid.py store')
+    args = parser.parse_args()
+
+    enable('dataflow_stats')
+    ds = Chexpert(folder=args.data, 
         train_or_valid='train',
-        resize=1024*3
+        resize=args.shape,
+        pyramid=args.pyramid
         )
     ds.reset_state()
-    ds = PrintData(ds)
-    ds = MultiProcessRunnerZMQ(ds, num_proc=8)
-    ds = BatchData(ds, 32)
-    TestDataSpeed(ds).start()
-    
\ No newline at end of file
+    ds = InstrumentedData(ds, 'chexpert')
+    ds = InstrumentedData(BatchData(ds, 32), 'batch')
+    if args.num_proc > 0:
+        ds = InstrumentedData(MultiProcessRunnerZMQ(ds, num_proc=args.num_proc), 'runner')
+    TestDataSpeed(ds, size=args.size).start()
+    report = collect()
+    for name, s in sorted(report.items()):
+        print('{:<12} {:>9.1f} items/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms'.format(
+            name, s['items_per_sec'], s['latency_ms']['p50'], s['latency_ms']['p99']))
+    print('Bottleneck: {}'.format(get_bottleneck(report)))
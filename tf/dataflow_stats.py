@@ -0,0 +1,254 @@
+# coding=utf-8
+"""
+Per-stage throughput, latency and queue occupancy of a dataflow.
+
+A stage is either a block of code timed with `stage(name)` (e.g. the read/decode/resize
+steps inside Vinmec) or a whole dataflow wrapped by `InstrumentedData(ds, name)`.
+Nested stages are subtracted, so the latency of a stage is its own time only.
+
+The stages of the worker processes of a MultiProcessRunner are written to per-pid
+snapshots in a directory, and `collect` merges them in the training process.
+Nothing is recorded until `enable` is called, before the workers are forked.
+"""
+import collections
+import glob
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from tensorpack.dataflow import MapData, ProxyDataFlow
+
+__all__ = ['enable', 'stage', 'InstrumentedData', 'PendingCount', 'collect', 'get_bottleneck', 'write_report']
+
+_DIR = None
+_INTERVAL = 5.0
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+_STATS = {}
+_LAST_SNAPSHOT = [0.0]
+
+
+class StageStats(object):
+    def __init__(self, window=2000):
+        self.count = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+        self.latency = collections.deque(maxlen=window)
+        self.queue = collections.deque(maxlen=window)
+
+    def add(self, latency, queue_size=None):
+        now = time.time()
+        if self.first is None:
+            self.first = now - latency
+        self.last = now
+        self.count += 1
+        self.busy += latency
+        self.latency.append(latency)
+        if queue_size is not None:
+            self.queue.append(queue_size)
+
+    def to_dict(self):
+        return {'count': self.count, 'busy': self.busy, 'first': self.first, 'last': self.last,
+                'latency': list(self.latency), 'queue': list(self.queue)}
+
+
+def enable(dirname, interval=5.0):
+    """
+    Start recording, with snapshots written to `dirname` at most every `interval` seconds per process.
+    """
+    global _DIR, _INTERVAL
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for fname in glob.glob(os.path.join(dirname, 'stats-*.json')):
+        os.remove(fname)
+    _DIR = dirname
+    _INTERVAL = interval
+
+
+def _record(name, latency, queue_size=None):
+    with _LOCK:
+        _STATS.setdefault(name, StageStats()).add(latency, queue_size)
+    if time.time() - _LAST_SNAPSHOT[0] > _INTERVAL:
+        snapshot()
+
+
+def snapshot():
+    """
+    Write the stages of this process to its snapshot file.
+    """
+    if _DIR is None:
+        return
+    _LAST_SNAPSHOT[0] = time.time()
+    with _LOCK:
+        content = {name: s.to_dict() for name, s in _STATS.items()}
+    fname = os.path.join(_DIR, 'stats-{}.json'.format(os.getpid()))
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(content, f)
+    os.rename(fname + '.tmp', fname)
+
+
+class _Timer(object):
+    """
+    Time spent between start and stop, minus the time of the stages nested in between.
+    """
+
+    def start(self):
+        stack = _LOCAL.__dict__.setdefault('stack', [])
+        stack.append(self)
+        self.nested = 0.0
+        self.begin = time.time()
+
+    def stop(self):
+        elapsed = time.time() - self.begin
+        stack = _LOCAL.stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        return elapsed - self.nested
+
+
+@contextmanager
+def stage(name):
+    if _DIR is None:
+        yield
+        return
+    timer = _Timer()
+    timer.start()
+    try:
+        yield
+    finally:
+        _record(name, timer.stop())
+
+
+class InstrumentedData(ProxyDataFlow):
+    """
+    Time how long each datapoint of `ds` takes to produce, as the stage `name`.
+    """
+
+    def __init__(self, ds, name, queue_size=None):
+        """
+        Args:
+            queue_size: optional callable returning the number of datapoints buffered by `ds`,
+                e.g. `lambda: runner.queue.qsize()` for a MultiProcessRunner, a PendingCount for a
+                MultiProcessRunnerZMQ.
+        """
+        super(InstrumentedData, self).__init__(ds)
+        self.name = name
+        self.queue_size = queue_size
+
+    def __iter__(self):
+        itr = self.ds.__iter__()
+        while True:
+            queue_size = self.queue_size() if self.queue_size is not None and _DIR is not None else None
+            timer = _Timer()
+            timer.start()
+            try:
+                dp = next(itr)
+            except StopIteration:
+                return
+            finally:
+                latency = timer.stop()
+            if _DIR is not None:
+                _record(self.name, latency, queue_size)
+            yield dp
+
+
+class PendingCount(object):
+    """
+    The number of datapoints produced by the workers of a runner and not consumed yet, for a
+    MultiProcessRunnerZMQ whose ZMQ queues cannot report their size. Create it before the workers are forked:
+
+        pending = PendingCount()
+        runner = MultiProcessRunnerZMQ(pending.producer(ds), num_proc=4)
+        ds = InstrumentedData(pending.consumer(runner), 'runner', queue_size=pending)
+    """
+
+    def __init__(self):
+        # Shared with the forked workers
+        self.produced = mp.Value('l', 0)
+        self.consumed = 0
+
+    def _produce(self, dp):
+        with self.produced.get_lock():
+            self.produced.value += 1
+        return dp
+
+    def _consume(self, dp):
+        self.consumed += 1
+        return dp
+
+    def producer(self, ds):
+        return MapData(ds, self._produce)
+
+    def consumer(self, ds):
+        return MapData(ds, self._consume)
+
+    def __call__(self):
+        return self.produced.value - self.consumed
+
+
+def collect(dirname=None):
+    """
+    Merge the snapshots of all processes.
+    Returns:
+        dict of stage -> {'items_per_sec': throughput of the stage over all its processes,
+        'capacity': items/sec it could sustain if never blocked (count / own time),
+        'latency_ms': {'p50', 'p90', 'p99'}, 'queue': {'mean', 'max'} when sampled, 'processes'}.
+    """
+    dirname = dirname or _DIR
+    snapshot()
+    merged = {}
+    for fname in glob.glob(os.path.join(dirname, 'stats-*.json')):
+        try:
+            with open(fname) as f:
+                content = json.load(f)
+        except ValueError:
+            continue
+        for name, s in content.items():
+            if not s['count']:
+                continue
+            m = merged.setdefault(name, {'count': 0, 'rate': 0.0, 'capacity': 0.0, 'latency': [], 'queue': [],
+                                         'processes': 0})
+            # The processes running a stage work in parallel, their rates add up
+            m['count'] += s['count']
+            m['rate'] += s['count'] / max(s['last'] - s['first'], 1e-6)
+            m['capacity'] += s['count'] / max(s['busy'], 1e-6)
+            m['latency'] += s['latency']
+            m['queue'] += s['queue']
+            m['processes'] += 1
+
+    report = {}
+    for name, m in merged.items():
+        latency = np.array(m['latency']) * 1000.0
+        report[name] = {
+            'count': m['count'],
+            'items_per_sec': m['rate'],
+            'capacity': m['capacity'],
+            'latency_ms': {'p50': float(np.percentile(latency, 50)),
+                           'p90': float(np.percentile(latency, 90)),
+                           'p99': float(np.percentile(latency, 99))},
+            'processes': m['processes'],
+        }
+        if m['queue']:
+            report[name]['queue'] = {'mean': float(np.mean(m['queue'])), 'max': int(np.max(m['queue']))}
+    return report
+
+
+def get_bottleneck(report):
+    """
+    The stage with the lowest capacity, i.e. the one which limits the throughput of the pipeline.
+    """
+    if not report:
+        return None
+    return min(report, key=lambda name: report[name]['capacity'])
+
+
+def write_report(filename, report):
+    with open(filename, 'w') as f:
+        json.dump({'stages': report, 'bottleneck': get_bottleneck(report)}, f, indent=2)
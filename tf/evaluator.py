@@ -0,0 +1,225 @@
+# coding=utf-8
+"""
+Evaluate the checkpoints of a run_vinmec.py training in a separate process, so that the
+training does not block on the valid/test2 InferenceRunners every epoch.
+
+Example:
+    python run_vinmec.py --gpus=0 --name=DenseNet121 --shape=256 --types=16 --async_eval
+    python evaluator.py --gpus=1 --name=DenseNet121 --shape=256 --types=16 --every=5
+
+The metrics have the same names as the synchronous evaluation (valid_f1_score, test2_cost, ...)
+and are written to the run directory: as TensorBoard events next to the training ones,
+appended to log.log, and to async_eval.json in the format of stats.json.
+With --multitask, the best checkpoint of every head is copied to max-valid_<metric>_<head>,
+as the MaxSavers of the synchronous evaluation do.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+import tensorflow as tf
+tf = tf.compat.v1
+
+from tensorpack import *
+from tensorpack.utils import logger
+
+from run_vinmec import (Model, CustomBinaryStatistics, get_parser, get_logdir, get_eval_dataflow,
+                        get_head_names, get_thresholds)
+
+
+SPLITS = [('valid', 'valid_v2.csv'), ('test2', 'test_v2.csv')]
+
+
+def get_epochs(logdir):
+    """
+    Returns:
+        dict of global_step -> epoch_num, from the stats.json written by the training monitors.
+    """
+    fname = os.path.join(logdir, 'stats.json')
+    if not os.path.isfile(fname):
+        return {}
+    try:
+        with open(fname) as f:
+            stats = json.load(f)
+    except ValueError:  # being rewritten by the trainer
+        return {}
+    return {s['global_step']: s['epoch_num'] for s in stats}
+
+
+def list_checkpoints(logdir):
+    """
+    Returns:
+        list of (global_step, path) of the checkpoints still on disk, oldest first.
+    """
+    ckpt = tf.train.get_checkpoint_state(logdir)
+    if ckpt is None:
+        return []
+    paths = [p for p in ckpt.all_model_checkpoint_paths if tf.train.checkpoint_exists(p)]
+    return sorted((int(p.rsplit('-', 1)[1]), p) for p in paths)
+
+
+class CheckpointEvaluator(object):
+    """
+    Build the inference graph once and restore every checkpoint into the same session.
+    """
+
+    def __init__(self, model, args):
+        self.args = args
+        self.predictor = OfflinePredictor(PredictConfig(
+            model=model,
+            # The eval dataflows carry every model input, e.g. label_counts with --accum
+            input_names=model.input_names,
+            output_names=['estim', 'loss_xent', 'cost']))
+        with self.predictor.graph.as_default():
+            self.saver = tf.train.Saver(tf.global_variables())
+        self.dataflows = [(prefix, get_eval_dataflow(args, fname, is_train='valid'))
+                          for prefix, fname in SPLITS]
+
+    def __call__(self, path):
+        """
+        Returns:
+            dict of metric name -> value, named as the training InferenceRunners would.
+        """
+        self.saver.restore(self.predictor.sess, path)
+        results = {}
+        for prefix, dataflow in self.dataflows:
+            stat = CustomBinaryStatistics(threshold=get_thresholds(self.args), types=self.args.types)
+            losses = {'loss_xent': [], 'cost': []}
+            dataflow.reset_state()
+            for dp in dataflow:
+                estim, loss_xent, cost = self.predictor(*dp)
+                stat.feed(estim, dp[1])
+                losses['loss_xent'].append(loss_xent)
+                losses['cost'].append(cost)
+            results.update({prefix + '_precision': stat.precision,
+                            prefix + '_recall': stat.recall,
+                            prefix + '_f1_score': stat.f1_score,
+                            prefix + '_f2_score': stat.f2_score,
+                            prefix + '_roc_auc': stat.roc_auc})
+            if self.args.multitask:
+                for metric, values in stat.per_class().items():
+                    for name, value in zip(get_head_names(self.args), values):
+                        results['{}_{}_{}'.format(prefix, metric, name)] = value
+            for name, values in losses.items():
+                results['{}_{}'.format(prefix, name)] = np.mean(values)
+        return {k: float(v) for k, v in results.items()}
+
+
+class RunWriter(object):
+    """
+    Write the evaluation results back into the run directory.
+    """
+
+    def __init__(self, logdir):
+        self.fname = os.path.join(logdir, 'async_eval.json')
+        self.records = []
+        if os.path.isfile(self.fname):
+            with open(self.fname) as f:
+                self.records = json.load(f)
+        # A separate event file in the same directory, TensorBoard merges it with the training one
+        self.summary_writer = tf.summary.FileWriter(logdir, filename_suffix='.async_eval')
+        handler = logging.FileHandler(os.path.join(logdir, 'log.log'), encoding='utf-8', mode='a')
+        handler.setFormatter(logging.Formatter(
+            '[%(asctime)s @evaluator] %(message)s', datefmt='%m%d %H:%M:%S'))
+        logging.getLogger('tensorpack').addHandler(handler)
+
+    @property
+    def evaluated(self):
+        return set(r['global_step'] for r in self.records)
+
+    def write(self, global_step, epoch_num, results):
+        summary = tf.Summary(value=[tf.Summary.Value(tag=k, simple_value=v) for k, v in sorted(results.items())])
+        self.summary_writer.add_summary(summary, global_step)
+        self.summary_writer.flush()
+        for k, v in sorted(results.items()):
+            logger.info('{}: {}'.format(k, v))
+
+        record = dict(results, global_step=global_step, epoch_num=epoch_num)
+        self.records.append(record)
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self.records, f, indent=4)
+        os.rename(self.fname + '.tmp', self.fname)
+
+
+class BestSaver(object):
+    """
+    Copy an evaluated checkpoint to max-<stat> in the run directory when it has the best <stat> so far.
+    """
+
+    def __init__(self, logdir, stats, records=()):
+        self.logdir = logdir
+        self.best = {}
+        for stat in stats:
+            values = [r[stat] for r in records if stat in r]
+            self.best[stat] = max(values) if values else None
+
+    def update(self, path, results):
+        for stat, best in self.best.items():
+            if best is not None and results[stat] <= best:
+                continue
+            self.best[stat] = results[stat]
+            newname = os.path.join(self.logdir, 'max-' + stat)
+            for fname in tf.gfile.Glob(path + '.*'):
+                tf.gfile.Copy(fname, fname.replace(path, newname), overwrite=True)
+            logger.info("New maximum {} {}, saved to {}".format(stat, results[stat], newname))
+
+
+def select(checkpoints, epochs, evaluated, every=1, latest_only=False):
+    """
+    Returns:
+        the (global_step, epoch_num, path) still to evaluate, oldest first.
+        Checkpoints whose epoch is not in stats.json yet are left for the next poll.
+    """
+    pending = []
+    for step, path in checkpoints:
+        if step in evaluated or step not in epochs:
+            continue
+        if epochs[step] % every == 0:
+            pending.append((step, epochs[step], path))
+    if latest_only:
+        pending = pending[-1:]
+    return pending
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--logdir', help='run directory to watch, default: the one of run_vinmec.py')
+    parser.add_argument('--every', type=int, default=1, help='evaluate the checkpoints of every N epochs')
+    parser.add_argument('--latest_only', action='store_true',
+                        help='only evaluate the newest checkpoint, skipping the older pending ones')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between two polls')
+    parser.add_argument('--once', action='store_true', help='evaluate what is pending and exit')
+    args = parser.parse_args()
+
+    if args.gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
+    logdir = args.logdir or get_logdir(args)
+    writer = RunWriter(logdir)
+    evaluator = CheckpointEvaluator(Model(args=args), args)
+    best_stats = ['valid_{}_{}'.format(args.best_metric, head) for head in get_head_names(args)] \
+        if args.multitask else []
+    saver = BestSaver(logdir, best_stats, writer.records)
+
+    done = False
+    while not done:
+        pending = select(list_checkpoints(logdir), get_epochs(logdir), writer.evaluated,
+                         every=args.every, latest_only=args.latest_only)
+        for step, epoch, path in pending:
+            logger.info("Evaluating {} (epoch {}) ...".format(path, epoch))
+            start = time.time()
+            try:
+                results = evaluator(path)
+            except tf.errors.NotFoundError:
+                logger.warn("{} was deleted before its evaluation, raise --max_to_keep.".format(path))
+                continue
+            writer.write(step, epoch, results)
+            saver.update(path, results)
+            logger.info("Evaluated epoch {} in {:.1f}s".format(epoch, time.time() - start))
+            done = epoch >= args.max_epoch
+        if args.once:
+            break
+        if not done:
+            time.sleep(args.interval)
@@ -0,0 +1,244 @@
+# coding=utf-8
+"""
+Run a trained backbone once over the csv files and cache its features, then train classifier heads
+on the cache in seconds, for a new label schema (--types/--pathology) or new thresholds.
+
+Example:
+    # the globally pooled features (or --spatial: the last feature maps) of every image
+    python feature_cache.py --extract --name=DenseNet121 --shape=256 --types=16 \
+        --load=train_log/DenseNet121/All/none/256/16/max-valid_roc_auc --fname=train_v2.csv,valid_v2.csv \
+        --cache=cache/densenet121_256
+    # a linear (or --head=mlp) head for the 6 pathologies, with the best-F1 threshold of each one
+    python feature_cache.py --train_head --cache=cache/densenet121_256 --types=6 --head=linear \
+        --head_epochs=100 --output=cache/densenet121_256/head6.npz
+    # the backbone checkpoint with the linear head in place of its own, for run_vinmec.py --types=6
+    python feature_cache.py --stitch --load=train_log/DenseNet121/All/none/256/16/max-valid_roc_auc \
+        --head_file=cache/densenet121_256/head6.npz --output=stitched/model
+
+The cache holds <csv name>.npy, a float32 memory-mapped array with a row per image of the csv, and
+meta.json. The images go through the deterministic evaluation augmentors, so a cache is only valid
+for the backbone, --shape and --precision it was extracted with. The labels are read from the csv when
+training, so any label schema of the same images can reuse the cache.
+Only a linear head on pooled features of a backbone ending in global average pooling (ResNet101,
+DenseNet*) can be stitched; the MLP heads stay in their own npz file.
+"""
+import json
+import os
+
+import numpy as np
+
+import pandas as pd
+
+import sklearn.metrics
+
+# The backbones whose logits are a linear layer on the global average of the latent
+STITCH_MODELS = ['ResNet101', 'DenseNet121', 'DenseNet169', 'DenseNet201']
+
+
+def get_cache_path(cache, fname):
+    return os.path.join(cache, os.path.splitext(os.path.basename(fname))[0] + '.npy')
+
+
+def extract(args, fname, model, session_init, spatial=False):
+    """
+    Write the features of every image of `fname` into the cache.
+    Returns:
+        the shape of the cached array.
+    """
+    from tensorpack.dataflow import AugmentImageComponent, BatchData
+    from tensorpack.predict import OfflinePredictor, PredictConfig
+    from run_vinmec import Vinmec, get_eval_augmentors
+    ds = Vinmec(folder=args.data, is_train='test', fname=fname, types=args.types, pathology=args.pathology,
+                resize=int(args.shape), pyramid=args.pyramid)
+    ds.reset_state()
+    size = len(ds)
+    ds = AugmentImageComponent(ds, get_eval_augmentors(), 0)
+    # Every image has its row, the last batch included
+    ds = BatchData(ds, args.batch, remainder=True)
+    predictor = OfflinePredictor(PredictConfig(
+        model=model,
+        session_init=session_init,
+        input_names=['image'],
+        output_names=['latent' if spatial else 'latent_pooled']))
+
+    features = None
+    start = 0
+    for dp in ds:
+        batch = predictor(dp[0])[0]
+        if features is None:
+            features = np.lib.format.open_memmap(get_cache_path(args.cache, fname), mode='w+', dtype=np.float32,
+                                                 shape=(size,) + batch.shape[1:])
+        features[start:start + len(batch)] = batch
+        start += len(batch)
+    features.flush()
+    return features.shape
+
+
+def read_labels(args, fname):
+    """
+    The labels of the csv in the --types/--pathology schema, NaN being 0, as Vinmec reads them.
+    """
+    from vinmec import get_pathologies
+    df = pd.read_csv(os.path.join(args.data, fname))
+    df.columns = df.columns.str.replace(' ', '_')
+    columns = get_pathologies(args.types, args.pathology)
+    return np.nan_to_num(df[columns].values.astype(np.float32), copy=True, nan=0)
+
+
+def pool(features, data_format):
+    """
+    Spatial features to the concatenation of their average and max, pooled features as they are.
+    """
+    if features.ndim == 2:
+        return features
+    axis = (2, 3) if data_format == 'channels_first' else (1, 2)
+    return np.concatenate([features.mean(axis=axis), features.max(axis=axis)], axis=1)
+
+
+def build_head(features, classes, head='linear', hidden=256):
+    """
+    The logits of a linear head named as the 'linear' layer of the backbones, or of a one hidden
+    layer MLP.
+    """
+    from run_vinmec import tf
+    if head == 'linear':
+        with tf.variable_scope('linear'):
+            W = tf.get_variable('W', [features.shape[1], classes], initializer=tf.random_normal_initializer(stddev=0.01))
+            b = tf.get_variable('b', [classes], initializer=tf.zeros_initializer())
+        return tf.matmul(features, W) + b
+    with tf.variable_scope('head_fc0'):
+        W = tf.get_variable('W', [features.shape[1], hidden], initializer=tf.variance_scaling_initializer(2.0))
+        b = tf.get_variable('b', [hidden], initializer=tf.zeros_initializer())
+    hidden_layer = tf.nn.relu(tf.matmul(features, W) + b)
+    with tf.variable_scope('head_fc1'):
+        W = tf.get_variable('W', [hidden, classes], initializer=tf.random_normal_initializer(stddev=0.01))
+        b = tf.get_variable('b', [classes], initializer=tf.zeros_initializer())
+    return tf.matmul(hidden_layer, W) + b
+
+
+def best_thresholds(label, proba):
+    """
+    The threshold of every class maximizing its F1 score.
+    """
+    thresholds = []
+    for k in range(label.shape[1]):
+        precision, recall, candidates = sklearn.metrics.precision_recall_curve(label[:, k], proba[:, k])
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-6)
+        thresholds.append(float(candidates[np.argmax(f1[:-1])]) if len(candidates) else 0.5)
+    return thresholds
+
+
+def train_head(args, train_x, train_y, valid_x, valid_y):
+    """
+    Train the head with Adam on the class-balanced cross entropy of run_vinmec.py.
+    Returns:
+        dict of variable name -> value, and the valid probabilities.
+    """
+    from run_vinmec import tf, class_balanced_sigmoid_cross_entropy, multitask_sigmoid_cross_entropy
+    rng = np.random.RandomState(args.seed)
+    with tf.Graph().as_default():
+        features = tf.placeholder(tf.float32, [None, train_x.shape[1]], 'features')
+        label = tf.placeholder(tf.float32, [None, args.types], 'label')
+        logit = build_head(features, args.types, args.head, args.hidden)
+        if args.multitask:
+            cost, _ = multitask_sigmoid_cross_entropy(logit, label, [1.0] * args.types)
+        else:
+            cost = class_balanced_sigmoid_cross_entropy(logit, label)
+        cost = cost + args.head_wd * tf.add_n([tf.nn.l2_loss(v) for v in tf.trainable_variables() if v.name.endswith('W:0')])
+        train_op = tf.train.AdamOptimizer(args.head_lr).minimize(cost)
+        proba = tf.sigmoid(logit)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for epoch in range(args.head_epochs):
+                indices = rng.permutation(len(train_x))
+                for k in range(0, len(indices) - args.batch + 1, args.batch):
+                    batch = indices[k:k + args.batch]
+                    sess.run(train_op, feed_dict={features: train_x[batch], label: train_y[batch]})
+            valid_proba = sess.run(proba, feed_dict={features: valid_x})
+            variables = {v.op.name: sess.run(v) for v in tf.trainable_variables()}
+    return variables, valid_proba
+
+
+def stitch(load, head_file, output):
+    """
+    Write the checkpoint `load` with the linear head of `head_file` in place of its 'linear' layer
+    (and without the optimizer slots of the replaced one).
+    """
+    from run_vinmec import tf
+    from tensorpack.tfutils.varmanip import get_checkpoint_path, save_chkpt_vars
+    with open(os.path.splitext(head_file)[0] + '.json') as f:
+        meta = json.load(f)
+    assert meta['head'] == 'linear' and not meta['spatial'] and meta['backbone']['name'] in STITCH_MODELS, \
+        "Only a linear head on the pooled features of {} can be stitched".format(STITCH_MODELS)
+    head = np.load(head_file)
+    reader = tf.train.NewCheckpointReader(get_checkpoint_path(load))
+    variables = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+                 if not name.startswith('linear/')}
+    variables['linear/W'] = head['linear/W']
+    variables['linear/b'] = head['linear/b']
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    save_chkpt_vars(variables, output)
+
+
+if __name__ == '__main__':
+    from run_vinmec import get_parser, get_thresholds
+    parser = get_parser()
+    parser.add_argument('--extract', action='store_true', help='cache the features of --fname')
+    parser.add_argument('--train_head', action='store_true', help='train a head on the cache')
+    parser.add_argument('--stitch', action='store_true', help='put a linear head into the --load checkpoint')
+    parser.add_argument('--cache', default='feature_cache', help='folder of the cached features')
+    parser.add_argument('--fname', default='train_v2.csv,valid_v2.csv', help='comma separated csv files to extract')
+    parser.add_argument('--spatial', action='store_true', help='cache the last feature maps instead of their average')
+    parser.add_argument('--train_fname', default='train_v2.csv')
+    parser.add_argument('--valid_fname', default='valid_v2.csv')
+    parser.add_argument('--head', default='linear', choices=['linear', 'mlp'])
+    parser.add_argument('--hidden', type=int, default=256, help='hidden units of the mlp head')
+    parser.add_argument('--head_epochs', type=int, default=50)
+    parser.add_argument('--head_lr', type=float, default=1e-3)
+    parser.add_argument('--head_wd', type=float, default=1e-4)
+    parser.add_argument('--head_file', default=None, help='npz of a head trained by --train_head')
+    parser.add_argument('--output', default=None, help='npz of the trained head, or prefix of the stitched checkpoint')
+    args = parser.parse_args()
+    if args.gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
+
+    if args.extract:
+        from run_vinmec import Model, LATENT_MODELS, SmartInit
+        assert args.name in LATENT_MODELS, "--extract needs one of {}".format(LATENT_MODELS)
+        if not os.path.isdir(args.cache):
+            os.makedirs(args.cache)
+        model = Model(args=args)
+        shapes = {}
+        for fname in args.fname.split(','):
+            shapes[fname] = extract(args, fname, model, SmartInit(args.load), args.spatial)
+            print('{}: features {}'.format(fname, shapes[fname]))
+        with open(os.path.join(args.cache, 'meta.json'), 'w') as f:
+            json.dump({'name': args.name, 'mode': args.mode, 'shape': args.shape, 'load': args.load,
+                       'precision': args.precision, 'data_format': model.data_format, 'spatial': args.spatial,
+                       'shapes': shapes}, f, indent=2)
+
+    elif args.train_head:
+        with open(os.path.join(args.cache, 'meta.json')) as f:
+            meta = json.load(f)
+        train_x = pool(np.load(get_cache_path(args.cache, args.train_fname), mmap_mode='r'), meta['data_format'])
+        valid_x = pool(np.load(get_cache_path(args.cache, args.valid_fname), mmap_mode='r'), meta['data_format'])
+        train_y = read_labels(args, args.train_fname)
+        valid_y = read_labels(args, args.valid_fname)
+        variables, valid_proba = train_head(args, np.asarray(train_x), train_y, np.asarray(valid_x), valid_y)
+
+        thresholds = best_thresholds(valid_y, valid_proba)
+        estim = valid_proba >= get_thresholds(args)
+        print('valid_roc_auc: \t{}'.format(sklearn.metrics.roc_auc_score(valid_y, valid_proba, average='weighted')))
+        print('valid_f1_score: \t{}'.format(sklearn.metrics.f1_score(valid_y, estim, average='weighted')))
+        print('best F1 thresholds: --thresholds={}'.format(','.join('{:.3f}'.format(t) for t in thresholds)))
+        output = args.output or os.path.join(args.cache, 'head_{}_{}.npz'.format(args.head, args.types))
+        np.savez(output, **variables)
+        with open(os.path.splitext(output)[0] + '.json', 'w') as f:
+            json.dump({'head': args.head, 'types': args.types, 'pathology': args.pathology,
+                       'spatial': meta['spatial'], 'thresholds': thresholds, 'backbone': meta}, f, indent=2)
+        print('Head written to {}'.format(output))
+
+    elif args.stitch:
+        stitch(args.load, args.head_file, args.output)
+        print('Checkpoint written to {}'.format(args.output))
@@ -0,0 +1,100 @@
+# coding=utf-8
+"""
+Data-parallel training of run_vinmec.py on the cores of one CPU node: horovodrun starts N workers,
+each one on its own shard of the training set with cores / N intra-op threads, the gradients being
+averaged by allreduce. Runs a short training for every N and reports the scaling efficiency,
+the throughput of N workers over N times the throughput of one.
+
+Example:
+    python launch_cpu.py --procs=1,2,4,8 --save=train_log/scaling -- \
+        --name=DenseNet121 --shape=256 --types=16 --batch=16 --async_eval
+    # then train with the best N
+    horovodrun -np 8 -H localhost:8 python run_vinmec.py --trainer=horovod --intra_op_threads=8 \
+        --name=DenseNet121 --shape=256 --types=16 --batch=16
+
+The arguments after -- are given to every run_vinmec.py; --batch is per worker.
+"""
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from tabulate import tabulate
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_vinmec.py')
+
+
+def get_command(procs, threads, save, max_epoch, steps_per_epoch, extra_args):
+    return ['horovodrun', '-np', str(procs), '-H', 'localhost:{}'.format(procs),
+            sys.executable, SCRIPT, '--trainer=horovod', '--gpus=',
+            '--intra_op_threads={}'.format(threads), '--save={}'.format(save),
+            '--max_epoch={}'.format(max_epoch), '--steps_per_epoch={}'.format(steps_per_epoch)] + extra_args
+
+
+def read_throughput(save, skip_epochs=1):
+    """
+    Returns:
+        the mean samples/sec of the chief over the epochs after `skip_epochs` (warmup),
+        None if the run wrote no stats.json.
+    """
+    fnames = glob.glob(os.path.join(save, '**', 'stats.json'), recursive=True)
+    if not fnames:
+        return None
+    with open(fnames[0]) as f:
+        stats = json.load(f)
+    values = [s['Throughput (samples/sec)'] for s in stats if 'Throughput (samples/sec)' in s]
+    values = values[skip_epochs:] or values
+    return sum(values) / len(values) if values else None
+
+
+def get_efficiencies(throughputs):
+    """
+    Args:
+        throughputs: dict of number of workers -> samples/sec, with the 1 worker baseline.
+    Returns:
+        dict of number of workers -> throughput / (workers * baseline).
+    """
+    baseline = throughputs.get(1)
+    if not baseline:
+        return {}
+    return {n: t / (n * baseline) for n, t in throughputs.items() if t is not None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--procs', default='1,2,4,8', help='comma separated numbers of workers')
+    parser.add_argument('--cores', type=int, default=mp.cpu_count(), help='cores shared by the workers')
+    parser.add_argument('--save', default='train_log/scaling', help='one log folder per number of workers')
+    parser.add_argument('--max_epoch', type=int, default=3, help='the first epoch is excluded as warmup')
+    parser.add_argument('--steps_per_epoch', type=int, default=50)
+    parser.add_argument('--output', default='scaling_cpu.json')
+    args, extra_args = parser.parse_known_args()
+    extra_args = [a for a in extra_args if a != '--']
+
+    procs = [int(n) for n in args.procs.split(',')]
+    if 1 not in procs:
+        procs = [1] + procs
+    throughputs = {}
+    for n in procs:
+        save = os.path.join(args.save, 'procs{}'.format(n))
+        command = get_command(n, max(1, args.cores // n), save, args.max_epoch, args.steps_per_epoch, extra_args)
+        print(' '.join(command))
+        code = subprocess.call(command, env=dict(os.environ, CUDA_VISIBLE_DEVICES=''))
+        throughputs[n] = read_throughput(save) if code == 0 else None
+        print('{} worker(s): {}'.format(n, 'failed with code {}'.format(code) if code else
+                                         '{:.1f} samples/s'.format(throughputs[n] or 0)))
+
+    efficiencies = get_efficiencies(throughputs)
+    rows = [[n, max(1, args.cores // n),
+             'failed' if throughputs[n] is None else '{:.1f}'.format(throughputs[n]),
+             '{:.2f}x'.format(throughputs[n] / throughputs[1]) if n in efficiencies else '',
+             '{:.0%}'.format(efficiencies[n]) if n in efficiencies else ''] for n in procs]
+    print(tabulate(rows, headers=['workers', 'threads/worker', 'samples/s', 'speedup', 'efficiency']))
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.now().isoformat(), 'cores': args.cores, 'args': extra_args,
+                   'throughputs': throughputs, 'efficiencies': efficiencies}, f, indent=2)
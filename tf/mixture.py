@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+Train on several datasets at once: every source keeps its own reader, augmentors and worker pool,
+its labels are mapped onto the Vinmec schema, and the samples are interleaved at fixed weights.
+
+Example:
+    python run_vinmec.py --name=DenseNet121 --shape=256 --types=16 \
+        --mix_chexpert=/u01/data/CXR/CheXpert-v1.0-small --mix_weights=0.7,0.3
+"""
+import time
+
+import numpy as np
+
+from tensorpack.dataflow import RNGDataFlow, MapDataComponent
+from tensorpack.utils import logger
+
+from chexpert import Chexpert
+from dataflow_stats import InstrumentedData
+from vinmec import get_pathologies
+
+# The label order of Chexpert(group=14)
+CHEXPERT_COLUMNS = ['No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Opacity',
+                    'Lung Lesion', 'Edema', 'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax',
+                    'Pleural Effusion', 'Pleural Other', 'Fracture', 'Support Devices']
+# Vinmec label column -> CheXpert label column
+CHEXPERT_TO_VINMEC = {
+    'Atelectasis': 'Atelectasis',
+    'Cardiomegaly': 'Cardiomegaly',
+    'Consolidation': 'Consolidation',
+    'Edema': 'Edema',
+    'Pleural_Effusion': 'Pleural Effusion',
+    'Pneumothorax': 'Pneumothorax',
+    'Pleural_Other': 'Pleural Other',
+    'Lung_Lesion': 'Lung Lesion',
+    'Airspace_Opacity': 'Lung Opacity',
+    'Pneumonia/infection': 'Pneumonia',
+    'Widening_Mediastinum': 'Enlarged Cardiomediastinum',
+    'Medical_device': 'Support Devices',
+    'Fracture': 'Fracture',
+    'No_Finding': 'No Finding',
+}
+
+
+def get_label_mapping(columns, source_columns, mapping):
+    """
+    Returns:
+        index of every target column in the source label vector, -1 when the source does not have it.
+    """
+    return np.array([source_columns.index(mapping[c]) if c in mapping else -1 for c in columns])
+
+
+def map_label(label, indices):
+    """
+    The source label in the target schema, the columns missing from the source being negative.
+    """
+    label = np.asarray(label, dtype=np.float32)
+    return np.where(indices >= 0, label[np.maximum(indices, 0)], 0.0).astype(np.float32)
+
+
+def get_chexpert_source(folder, types, pathology=None, shape=256, fname='train.csv'):
+    """
+    Chexpert with its own uncertainty policy (U-ones/U-zeros per column), yielding [image, label]
+    in the Vinmec schema of `types`.
+    """
+    columns = get_pathologies(types, pathology)
+    missing = [c for c in columns if c not in CHEXPERT_TO_VINMEC]
+    if missing:
+        logger.warn("CheXpert has no {}, they are negative in its samples".format(missing))
+    indices = get_label_mapping(columns, CHEXPERT_COLUMNS, CHEXPERT_TO_VINMEC)
+    ds = Chexpert(folder=folder, group=14, train_or_valid='train', resize=shape, shuffle=True, fname=fname)
+    return MapDataComponent(ds, lambda label: map_label(label, indices), index=1)
+
+
+class MixtureData(RNGDataFlow):
+    """
+    Interleave the datapoints of several infinite dataflows, each one drawn with its weight.
+    The samples and the time spent waiting for each source are logged every epoch, and every
+    source is an InstrumentedData stage 'mix_<name>', whose throughput dataflow_stats reports.
+    """
+
+    def __init__(self, sources, weights, size):
+        """
+        Args:
+            sources: dict of name -> dataflow, typically a MultiProcessRunnerZMQ of its own.
+            weights: dict of name -> relative weight.
+            size (int): datapoints per epoch.
+        """
+        self.names = sorted(sources)
+        self.sources = [InstrumentedData(sources[name], 'mix_{}'.format(name)) for name in self.names]
+        p = np.array([weights[name] for name in self.names], dtype=np.float64)
+        self.p = p / p.sum()
+        self.size = size
+
+    def reset_state(self):
+        super(MixtureData, self).reset_state()
+        for ds in self.sources:
+            ds.reset_state()
+        self.iterators = [ds.__iter__() for ds in self.sources]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        counts = np.zeros(len(self.sources), dtype=np.int64)
+        waits = np.zeros(len(self.sources))
+        for k in self.rng.choice(len(self.sources), size=self.size, p=self.p):
+            start = time.time()
+            dp = next(self.iterators[k])
+            waits[k] += time.time() - start
+            counts[k] += 1
+            yield dp
+        logger.info("Mixture: " + ", ".join(
+            "{} {} samples, {:.1f}s waiting".format(name, c, w) for name, c, w in zip(self.names, counts, waits)))
@@ -1,8 +1,13 @@
+import copy
+from contextlib import ExitStack
+
 import tensorflow as tf
 
 from tensorpack import *
 from tensorpack.dataflow import imgaug
 from tensorpack.tfutils import argscope, SmartInit, model_utils
+from tensorpack.tfutils.argscope import get_arg_scope
+from tensorpack.models.registry import get_registered_layer
 from tensorpack.tfutils.scope_utils import under_name_scope
 from tensorpack.utils import logger
 
@@ -11,6 +16,11 @@ import numpy as np
 
 # DenseNet net
 
+def get_channel_axis():
+    data_format = get_arg_scope()['Conv2D']['data_format']
+    return 1 if data_format in ['NCHW', 'channels_first'] else 3
+
+
 def composite_function(_input, out_features, kernel_size=3):
     """Function from paper H_l that performs:
     - batch normalization
@@ -44,15 +54,20 @@ def add_layer(_input, growth_rate, bc_mode):
         comp_out = composite_function(
             bottleneck_out, out_features=growth_rate, kernel_size=3)
     # concatenate _input with out from composite function
-    output = tf.concat([comp_out, _input], 3, name='concat')
+    output = tf.concat([comp_out, _input], get_channel_axis(), name='concat')
     return output
 
 
-def add_transition(_input, name, bc_mode, theta):
+def add_transition(_input, name, bc_mode, theta, out_features=None):
+    """
+    out_features: the output channels of a pruned transition, by default its input ones
+        (times theta in bc_mode).
+    """
     shape = _input.get_shape().as_list()
-    out_features = shape[3]
+    pruned = out_features is not None
+    out_features = out_features or shape[get_channel_axis()]
     with tf.variable_scope(name) as scope:
-        if bc_mode:
+        if bc_mode and not pruned:
             out_features = int(out_features * theta)
             print(out_features, theta)
         output = composite_function(
@@ -62,29 +77,94 @@ def add_transition(_input, name, bc_mode, theta):
     return output
 
 
-def densenet_block(_input, name, growth_rate, bc_mode, count):
+def restore_arg_scope(scope):
+    """Re-enter an argscope captured by `get_arg_scope()`."""
+    stack = ExitStack()
+    for name, kwargs in scope.items():
+        layer = get_registered_layer(name)
+        if layer is not None and kwargs:
+            stack.enter_context(argscope(layer, **kwargs))
+    return stack
+
+
+def recompute_layer(growth_rate, bc_mode):
+    """
+    Build the part of `add_layer` whose intermediates are recomputed during backprop:
+    concat -> BN-ReLU -> conv (or concat -> BN-ReLU -> bottleneck in bc_mode).
+    The gradient is built outside of the current argscope, so it is captured here.
+    recompute_grad is built on custom_gradient, which only accepts resource variables:
+    the layer has to be called in a variable scope with use_resource=True.
+    """
+    scope = copy.deepcopy(get_arg_scope())
+    channel_axis = get_channel_axis()
+    calls = []
+
+    def layer(*features):
+        # The first call builds the forward pass, any later call is the recomputation.
+        # Recomputed BatchNorms must not update the moving averages a second time.
+        ema_update = 'skip' if calls else 'default'
+        calls.append(True)
+        with restore_arg_scope(scope), argscope(BatchNorm, ema_update=ema_update):
+            _input = tf.concat(features[::-1], channel_axis, name='concat')
+            if bc_mode:
+                return densenet_bottleneck(_input, out_features=growth_rate)
+            return composite_function(_input, out_features=growth_rate, kernel_size=3)
+    return tf.contrib.layers.recompute_grad(layer)
+
+
+def densenet_block(_input, name, growth_rate, bc_mode, count, efficient=False):
+    """
+    efficient: keep only the `growth_rate` new features of every layer for backprop and
+        recompute the concatenation and BN-ReLU(-bottleneck) in the backward pass, as in
+        "Memory-Efficient Implementation of DenseNets" (https://arxiv.org/abs/1707.06990).
+        Activation memory then grows linearly with the block depth instead of quadratically.
+        Variables have the same names as in the default mode, as resource variables.
+    growth_rate: an int, or the new features of every layer of a pruned block.
+    """
+    growth_rates = growth_rate if isinstance(growth_rate, list) else [growth_rate] * count
     output = _input
-    with tf.variable_scope(name):
+    # Resource variables in efficient mode, as recompute_grad needs
+    with tf.variable_scope(name, use_resource=True if efficient else None):
+        if not efficient:
+            for i in range(count):
+                with tf.variable_scope('block{}'.format(i)):
+                    output = add_layer(output, growth_rates[i], bc_mode)
+            return output
+
+        features = [_input]
         for i in range(count):
             with tf.variable_scope('block{}'.format(i)):
-                output = add_layer(output, growth_rate, bc_mode)
-        return output
+                comp_out = recompute_layer(growth_rates[i], bc_mode)(*features)
+                if bc_mode:
+                    comp_out = composite_function(
+                        comp_out, out_features=growth_rates[i], kernel_size=3)
+                features.append(comp_out)
+        # Same channel order as add_layer: newest features first
+        return tf.concat(features[::-1], get_channel_axis(), name='concat')
 
 
-def densenet_backbone(image, num_blocks, classes=1000, growth_rate=32, bc_mode=False, theta=0.5):
-    with argscope(Conv2D, nl=tf.identity, use_bias=False,
+def densenet_backbone(image, num_blocks, classes=1000, growth_rate=32, bc_mode=False, theta=0.5,
+                      data_format='channels_last', efficient=False, widths=None):
+    """
+    widths: the channels of a pruned model as written by prune.py, a dict with the new features
+        of every layer per block ('growth') and the output channels of the transitions ('transition').
+    """
+    growth = widths['growth'] if widths else [growth_rate] * 4
+    transition = widths['transition'] if widths else [None] * 3
+    with argscope([Conv2D, MaxPooling, AvgPooling, GlobalAvgPooling, BatchNorm], data_format=data_format), \
+        argscope(Conv2D, nl=tf.identity, use_bias=False,
                   W_init=tf.contrib.layers.variance_scaling_initializer(mode='FAN_OUT')):
         print('backbone:', bc_mode, theta)
         latent = (LinearWrap(image)
                   .Conv2D('conv0', 64, 7, stride=2, nl=BNReLU)
                   .MaxPooling('pool0', shape=3, stride=2, padding='SAME')
-                  .apply(densenet_block, 'dense_group0', growth_rate, bc_mode, num_blocks[0])
-                  .apply(add_transition, 'trans_group0', bc_mode, theta)
-                  .apply(densenet_block, 'dense_group1', growth_rate, bc_mode, num_blocks[1])
-                  .apply(add_transition, 'trans_group1', bc_mode, theta)
-                  .apply(densenet_block, 'dense_group2', growth_rate, bc_mode, num_blocks[2])
-                  .apply(add_transition, 'trans_group2', bc_mode, theta)
-                  .apply(densenet_block, 'dense_group3', growth_rate, bc_mode, num_blocks[3])
+                  .apply(densenet_block, 'dense_group0', growth[0], bc_mode, num_blocks[0], efficient)
+                  .apply(add_transition, 'trans_group0', bc_mode, theta, transition[0])
+                  .apply(densenet_block, 'dense_group1', growth[1], bc_mode, num_blocks[1], efficient)
+                  .apply(add_transition, 'trans_group1', bc_mode, theta, transition[1])
+                  .apply(densenet_block, 'dense_group2', growth[2], bc_mode, num_blocks[2], efficient)
+                  .apply(add_transition, 'trans_group2', bc_mode, theta, transition[2])
+                  .apply(densenet_block, 'dense_group3', growth[3], bc_mode, num_blocks[3], efficient)
                   .BNReLU('bnlast')
                   # .GlobalAvgPooling('gap')
                   #. .FullyConnected('linear', classes, nl=tf.identity)
@@ -94,7 +174,6 @@ def densenet_backbone(image, num_blocks, classes=1000, growth_rate=32, bc_mode=F
                     .Dropout('dropout', 0.5)
                     .FullyConnected('linear', classes, nl=tf.identity)
                     ())
-        latent = tf.transpose(latent, [0, 3, 1, 2])
     return logits, latent
 
 DENSENET_CONFIG = {
@@ -104,17 +183,20 @@ DENSENET_CONFIG = {
   265: [6, 12, 64, 48]
 }
 
-def DenseNet121(image, classes=5):
-	return densenet_backbone(image, num_blocks=[6, 12, 24, 16], classes=classes, \
-							 growth_rate=32, bc_mode=False, theta=0.5)
+def DenseNet121(image, classes=5, data_format='channels_last', efficient=False, widths=None):
+    return densenet_backbone(image, num_blocks=[6, 12, 24, 16], classes=classes, \
+                             growth_rate=32, bc_mode=False, theta=0.5, data_format=data_format,
+                             efficient=efficient, widths=widths)
 
-def DenseNet169(image, classes=5):
+def DenseNet169(image, classes=5, data_format='channels_last', efficient=False, widths=None):
     return densenet_backbone(image, num_blocks=[6, 12, 32, 32], classes=classes, \
-                             growth_rate=32, bc_mode=False, theta=0.5)
+                             growth_rate=32, bc_mode=False, theta=0.5, data_format=data_format,
+                             efficient=efficient, widths=widths)
 
-def DenseNet201(image, classes=5):
+def DenseNet201(image, classes=5, data_format='channels_last', efficient=False, widths=None):
     return densenet_backbone(image, num_blocks=[6, 12, 48, 32], classes=classes, \
-                             growth_rate=32, bc_mode=False, theta=0.5)
+                             growth_rate=32, bc_mode=False, theta=0.5, data_format=data_format,
+                             efficient=efficient, widths=widths)
     # def DenseNet(image, classes=5):
     #     depth = 40
     #     N = int((depth - 4)  / 3)
@@ -142,3 +224,50 @@ def DenseNet201(image, classes=5):
     #     output = FullyConnected('linear', l, out_dim=classes, nl=tf.identity)
 
     #     return output
+
+
+def check_efficient(num_blocks=(2, 2, 2, 2), growth_rate=8, bc_mode=False, shape=64, batch=2):
+    """
+    Build a small DenseNet in the default and in the memory-efficient mode with the same weights,
+    and compare their loss and the gradient of every variable.
+    Returns:
+        dict of 'loss' or variable name -> largest absolute difference between the two modes.
+    """
+    from tensorpack.tfutils.tower import TowerContext
+    rng = np.random.RandomState(0)
+    image = rng.rand(batch, shape, shape, 1).astype(np.float32)
+    weights = None
+    results = []
+    for efficient in [False, True]:
+        with tf.Graph().as_default():
+            with TowerContext('', is_training=True):
+                _, latent = densenet_backbone(tf.constant(image), list(num_blocks), classes=2,
+                                              growth_rate=growth_rate, bc_mode=bc_mode, efficient=efficient)
+            # The logits go through a random dropout, the loss is on the last feature map
+            loss = tf.reduce_mean(tf.square(latent))
+            variables = tf.trainable_variables()
+            grads = tf.gradients(loss, variables)
+            fetches = {v.op.name: g for v, g in zip(variables, grads) if g is not None}
+            fetches['loss'] = loss
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                if weights is None:
+                    weights = {v.op.name: sess.run(v) for v in tf.global_variables()}
+                else:
+                    for v in tf.global_variables():
+                        v.load(weights[v.op.name], sess)
+                results.append(sess.run(fetches))
+    default, efficient = results
+    assert set(default) == set(efficient), \
+        "Gradients only in one mode: {}".format(sorted(set(default) ^ set(efficient)))
+    return {name: float(np.abs(default[name] - efficient[name]).max()) for name in default}
+
+
+if __name__ == '__main__':
+    # python models/densenet.py: the memory-efficient blocks against the default ones, on CPU
+    for bc_mode in [False, True]:
+        diffs = check_efficient(bc_mode=bc_mode)
+        worst = max(diffs, key=diffs.get)
+        print('bc_mode={}: loss difference {:.3g}, largest gradient difference {:.3g} ({}), {} gradients'.format(
+            bc_mode, diffs['loss'], diffs[worst], worst, len(diffs) - 1))
+        assert diffs['loss'] < 1e-5 and diffs[worst] < 1e-4, diffs
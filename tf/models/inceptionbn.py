@@ -98,7 +98,9 @@ def shufflenet_stage(input, channel, num_blocks, group):
     return l
 
 
-def InceptionBN(image, classes=5):
+def InceptionBN(image, classes=5, data_format='channels_last'):
+    channel_axis = 1 if data_format in ['NCHW', 'channels_first'] else 3
+
     def inception(name, x, nr1x1, nr3x3r, nr3x3, nr233r, nr233, nrpool, pooltype):
         stride = 2 if nr1x1 == 0 else 1
         with tf.variable_scope(name):
@@ -120,9 +122,10 @@ def InceptionBN(image, classes=5):
             if nrpool != 0:  # pool + passthrough if nrpool == 0
                 x4 = Conv2D('poolproj', x4, nrpool, 1)
             outs.append(x4)
-            return tf.concat(outs, 3, name='concat')
+            return tf.concat(outs, channel_axis, name='concat')
 
-    with argscope(Conv2D, activation=BNReLU, use_bias=False):
+    with argscope([Conv2D, MaxPooling, AvgPooling, GlobalAvgPooling, BatchNorm], data_format=data_format), \
+        argscope(Conv2D, activation=BNReLU, use_bias=False):
         l = (LinearWrap(image)
              .Conv2D('conv0', 64, 7, strides=2)
              .MaxPooling('pool0', 3, 2, padding='SAME')
@@ -43,23 +43,30 @@ def preact_basicblock(l, ch_out, stride, preact):
     return l + resnet_shortcut(shortcut, ch_out, stride)
 
 
-def preact_bottleneck(l, ch_out, stride, preact):
+def preact_bottleneck(l, ch_out, stride, preact, widths=None):
     # stride is applied on the second conv, following fb.resnet.torch
+    # widths: the (conv1, conv2) channels of a pruned block, ch_out by default
+    width1, width2 = widths or (ch_out, ch_out)
     l, shortcut = apply_preactivation(l, preact)
-    l = Conv2D('conv1', l, ch_out, 1, activation=BNReLU)
-    l = Conv2D('conv2', l, ch_out, 3, strides=stride, activation=BNReLU)
+    l = Conv2D('conv1', l, width1, 1, activation=BNReLU)
+    l = Conv2D('conv2', l, width2, 3, strides=stride, activation=BNReLU)
     l = Conv2D('conv3', l, ch_out * 4, 1)
     return l + resnet_shortcut(shortcut, ch_out * 4, stride)
 
 
-def preact_group(name, l, block_func, features, count, stride):
+def get_block_kwargs(widths, i):
+    # Only the bottlenecks take the widths of a pruned block
+    return {} if widths is None else {'widths': widths[i]}
+
+
+def preact_group(name, l, block_func, features, count, stride, widths=None):
     with tf.variable_scope(name):
         for i in range(0, count):
             with tf.variable_scope('block{}'.format(i)):
                 # first block doesn't need activation
                 l = block_func(l, features,
                                stride if i == 0 else 1,
-                               'no_preact' if i == 0 else 'bnrelu')
+                               'no_preact' if i == 0 else 'bnrelu', **get_block_kwargs(widths, i))
         # end of each group need an extra activation
         l = BNReLU('bnlast', l)
     return l
@@ -74,22 +81,25 @@ def resnet_basicblock(l, ch_out, stride):
     return tf.nn.relu(out)
 
 
-def resnet_bottleneck(l, ch_out, stride, stride_first=False):
+def resnet_bottleneck(l, ch_out, stride, stride_first=False, widths=None):
     """
     stride_first: original resnet put stride on first conv. fb.resnet.torch put stride on second conv.
+    widths: the (conv1, conv2) channels of a pruned block, ch_out by default.
     """
+    width1, width2 = widths or (ch_out, ch_out)
     shortcut = l
-    l = Conv2D('conv1', l, ch_out, 1, strides=stride if stride_first else 1, activation=BNReLU)
-    l = Conv2D('conv2', l, ch_out, 3, strides=1 if stride_first else stride, activation=BNReLU)
+    l = Conv2D('conv1', l, width1, 1, strides=stride if stride_first else 1, activation=BNReLU)
+    l = Conv2D('conv2', l, width2, 3, strides=1 if stride_first else stride, activation=BNReLU)
     l = Conv2D('conv3', l, ch_out * 4, 1, activation=get_bn(zero_init=True))
     out = l + resnet_shortcut(shortcut, ch_out * 4, stride, activation=get_bn(zero_init=False))
     return tf.nn.relu(out)
 
 
-def se_bottleneck(l, ch_out, stride):
+def se_bottleneck(l, ch_out, stride, widths=None):
+    width1, width2 = widths or (ch_out, ch_out)
     shortcut = l
-    l = Conv2D('conv1', l, ch_out, 1, activation=BNReLU)
-    l = Conv2D('conv2', l, ch_out, 3, strides=stride, activation=BNReLU)
+    l = Conv2D('conv1', l, width1, 1, activation=BNReLU)
+    l = Conv2D('conv2', l, width2, 3, strides=stride, activation=BNReLU)
     l = Conv2D('conv3', l, ch_out * 4, 1, activation=get_bn(zero_init=True))
 
     squeeze = GlobalAvgPooling('gap', l)
@@ -113,28 +123,33 @@ def resnext32x4d_bottleneck(l, ch_out, stride):
     return tf.nn.relu(out)
 
 
-def resnet_group(name, l, block_func, features, count, stride):
+def resnet_group(name, l, block_func, features, count, stride, widths=None):
     with tf.variable_scope(name):
         for i in range(0, count):
             with tf.variable_scope('block{}'.format(i)):
-                l = block_func(l, features, stride if i == 0 else 1)
+                l = block_func(l, features, stride if i == 0 else 1, **get_block_kwargs(widths, i))
     return l
 
 
-def resnet_backbone(image, num_blocks, group_func, block_func, classes=1000):
+def resnet_backbone(image, num_blocks, group_func, block_func, classes=1000, data_format='channels_first',
+                    widths=None):
+    """
+    widths: per group, the (conv1, conv2) channels of every block, as written by prune.py.
+    """
+    widths = widths or [None] * 4
     # with argscope(Conv2D, use_bias=False,
     #               kernel_initializer=tf.variance_scaling_initializer(scale=2.0, mode='fan_out')):
-    with argscope([Conv2D, MaxPooling, GlobalAvgPooling, BatchNorm], data_format='channels_first'), \
+    with argscope([Conv2D, MaxPooling, GlobalAvgPooling, BatchNorm], data_format=data_format), \
         argscope(Conv2D, kernel_initializer=tf.variance_scaling_initializer(scale=2.0, mode='fan_out'), 
             use_bias=False):
         # Note that TF pads the image by [2, 3] instead of [3, 2].
         # Similar things happen in later stride=2 layers as well.
         l = Conv2D('conv0', image, 64, 7, strides=2, activation=BNReLU)
         l = MaxPooling('pool0', l, pool_size=3, strides=2, padding='SAME')
-        l = group_func('group0', l, block_func, 64, num_blocks[0], 1)
-        l = group_func('group1', l, block_func, 128, num_blocks[1], 2)
-        l = group_func('group2', l, block_func, 256, num_blocks[2], 2)
-        l = group_func('group3', l, block_func, 512, num_blocks[3], 2)
+        l = group_func('group0', l, block_func, 64, num_blocks[0], 1, widths=widths[0])
+        l = group_func('group1', l, block_func, 128, num_blocks[1], 2, widths=widths[1])
+        l = group_func('group2', l, block_func, 256, num_blocks[2], 2, widths=widths[2])
+        l = group_func('group3', l, block_func, 512, num_blocks[3], 2, widths=widths[3])
         latent = l
         l = GlobalAvgPooling('gap', l)
         l = Dropout('dropout', l, 0.5)
@@ -142,12 +157,15 @@ def resnet_backbone(image, num_blocks, group_func, block_func, classes=1000):
                                 kernel_initializer=tf.random_normal_initializer(stddev=0.01))
     return logits, latent
 
-def ResNet101(image, num_blocks=[3, 4, 23, 3], mode='preact', classes=5):
+def ResNet101(image, num_blocks=[3, 4, 23, 3], mode='preact', classes=5, data_format='channels_first',
+              widths=None):
+    """
+    image is expected in `data_format` layout.
+    """
     block_func = getattr(sys.modules[__name__], mode + '_bottleneck', None)
-    image_channel_first = tf.transpose(image, [0, 3, 1, 2])
-    return resnet_backbone(image_channel_first, [3, 4, 23, 3], 
+    return resnet_backbone(image, [3, 4, 23, 3], 
                            preact_group if mode == 'preact' else resnet_group, 
-                           block_func, classes=classes)
+                           block_func, classes=classes, data_format=data_format, widths=widths)
 # self.num_blocks, self.block_func = {
 #             18: ([2, 2, 2, 2], basicblock),
 #             34: ([3, 4, 6, 3], basicblock),
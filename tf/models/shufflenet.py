@@ -3,17 +3,23 @@ import tensorflow as tf
 from tensorpack import *
 from tensorpack.dataflow import imgaug
 from tensorpack.tfutils import argscope, SmartInit, model_utils
+from tensorpack.tfutils.argscope import get_arg_scope
 from tensorpack.tfutils.scope_utils import under_name_scope
 from tensorpack.utils import logger
 
 # Shuffle net
 
+def get_channel_axis():
+    data_format = get_arg_scope()['Conv2D']['data_format']
+    return 1 if data_format in ['NCHW', 'channels_first'] else 3
+
 
 @layer_register(log_shape=True)
 def DepthConv(x, out_channel, kernel_shape, padding='SAME', stride=1,
-              W_init=None, activation=tf.identity):
+              W_init=None, activation=tf.identity, data_format='channels_first'):
     in_shape = x.get_shape().as_list()
-    in_channel = in_shape[1]
+    channel_first = data_format in ['NCHW', 'channels_first']
+    in_channel = in_shape[1] if channel_first else in_shape[3]
     assert out_channel % in_channel == 0, (out_channel, in_channel)
     channel_mult = out_channel // in_channel
 
@@ -23,25 +29,35 @@ def DepthConv(x, out_channel, kernel_shape, padding='SAME', stride=1,
     filter_shape = kernel_shape + [in_channel, channel_mult]
 
     W = tf.get_variable('W', filter_shape, initializer=W_init)
-    conv = tf.nn.depthwise_conv2d(x, W, [1, 1, stride, stride], padding=padding, data_format='NCHW')
+    if channel_first:
+        conv = tf.nn.depthwise_conv2d(x, W, [1, 1, stride, stride], padding=padding, data_format='NCHW')
+    else:
+        conv = tf.nn.depthwise_conv2d(x, W, [1, stride, stride, 1], padding=padding, data_format='NHWC')
     return activation(conv, name='output')
 
 
 @under_name_scope()
 def channel_shuffle(l, group):
     in_shape = l.get_shape().as_list()
-    in_channel = in_shape[1]
-    assert in_channel % group == 0, in_channel
-    l = tf.reshape(l, [-1, in_channel // group, group] + in_shape[-2:])
-    l = tf.transpose(l, [0, 2, 1, 3, 4])
-    l = tf.reshape(l, [-1, in_channel] + in_shape[-2:])
+    if get_channel_axis() == 1:
+        in_channel = in_shape[1]
+        assert in_channel % group == 0, in_channel
+        l = tf.reshape(l, [-1, in_channel // group, group] + in_shape[-2:])
+        l = tf.transpose(l, [0, 2, 1, 3, 4])
+        l = tf.reshape(l, [-1, in_channel] + in_shape[-2:])
+    else:
+        in_channel = in_shape[3]
+        assert in_channel % group == 0, in_channel
+        l = tf.reshape(l, [-1] + in_shape[1:3] + [in_channel // group, group])
+        l = tf.transpose(l, [0, 1, 2, 4, 3])
+        l = tf.reshape(l, [-1] + in_shape[1:3] + [in_channel])
     return l
 
 
 @layer_register()
 def shufflenet_unit(l, out_channel, group, stride):
     in_shape = l.get_shape().as_list()
-    in_channel = in_shape[1]
+    in_channel = in_shape[get_channel_axis()]
     shortcut = l
 
     # "We do not apply group convolution on the first pointwise layer
@@ -60,17 +76,18 @@ def shufflenet_unit(l, out_channel, group, stride):
         output = tf.nn.relu(shortcut + l)
     else:   # unit (c)
         shortcut = AvgPooling('avgpool', shortcut, 3, 2, padding='SAME')
-        output = tf.concat([shortcut, tf.nn.relu(l)], axis=1)
+        output = tf.concat([shortcut, tf.nn.relu(l)], axis=get_channel_axis())
     return output
 
 
 @layer_register()
 def shufflenet_unit_v2(l, out_channel, stride):
+    channel_axis = get_channel_axis()
     if stride == 1:
-        shortcut, l = tf.split(l, 2, axis=1)
+        shortcut, l = tf.split(l, 2, axis=channel_axis)
     else:
         shortcut, l = l, l
-    shortcut_channel = int(shortcut.shape[1])
+    shortcut_channel = int(shortcut.shape[channel_axis])
 
     l = Conv2D('conv1', l, out_channel // 2, 1, activation=BNReLU)
     l = DepthConv('dconv', l, out_channel // 2, 3, stride=stride)
@@ -81,7 +98,7 @@ def shufflenet_unit_v2(l, out_channel, stride):
         shortcut = DepthConv('shortcut_dconv', shortcut, shortcut_channel, 3, stride=2)
         shortcut = BatchNorm('shortcut_dconv_bn', shortcut)
         shortcut = Conv2D('shortcut_conv', shortcut, shortcut_channel, 1, activation=BNReLU)
-    output = tf.concat([shortcut, l], axis=1)
+    output = tf.concat([shortcut, l], axis=channel_axis)
     output = channel_shuffle(output, 2)
     return output
 
@@ -98,10 +115,12 @@ def shufflenet_stage(input, channel, num_blocks, group):
     return l
 
 
-def ShuffleNet(image, classes=5):
-    with argscope([Conv2D, MaxPooling, AvgPooling, GlobalAvgPooling, BatchNorm], data_format='channels_first'), \
+def ShuffleNet(image, classes=5, data_format='channels_first'):
+    """
+    image is expected in `data_format` layout.
+    """
+    with argscope([Conv2D, MaxPooling, AvgPooling, GlobalAvgPooling, BatchNorm, DepthConv], data_format=data_format), \
         argscope(Conv2D, use_bias=False):
-        image_channel_first = tf.transpose(image, [0, 3, 1, 2])
         group = 8 #args.group
         ratio = 0.5
         if not True: #args.v2:
@@ -126,7 +145,7 @@ def ShuffleNet(image, classes=5):
 
         logger.info("#Channels: " + str([first_chan] + channels))
 
-        l = Conv2D('conv1', image_channel_first, first_chan, 3, strides=2, activation=BNReLU)
+        l = Conv2D('conv1', image, first_chan, 3, strides=2, activation=BNReLU)
         l = MaxPooling('pool1', l, 3, 2, padding='SAME')
 
         l = shufflenet_stage('stage2', l, channels[0], 4, group)
@@ -3,13 +3,14 @@ import tensorflow as tf
 from tensorpack import *
 from tensorpack.dataflow import imgaug
 from tensorpack.tfutils import argscope, SmartInit, model_utils
+from tensorpack.tfutils.argscope import get_arg_scope
 from tensorpack.tfutils.scope_utils import under_name_scope
 from tensorpack.utils import logger
 
 import numpy as np
 
 
-def GroupNorm(x, group, gamma_initializer=tf.constant_initializer(1.)):
+def GroupNorm(x, group, gamma_initializer=tf.constant_initializer(1.), data_format='channels_first'):
     """
     https://arxiv.org/abs/1803.08494
     More code that reproduces the paper can be found at https://github.com/ppwwyyxx/GroupNorm-reproduce/.
@@ -17,18 +18,25 @@ def GroupNorm(x, group, gamma_initializer=tf.constant_initializer(1.)):
     shape = x.get_shape().as_list()
     ndims = len(shape)
     assert ndims == 4, shape
-    chan = shape[1]
+    channel_first = data_format in ['NCHW', 'channels_first']
+    chan = shape[1] if channel_first else shape[3]
     assert chan % group == 0, chan
     group_size = chan // group
 
     orig_shape = tf.shape(x)
-    h, w = orig_shape[2], orig_shape[3]
-
-    x = tf.reshape(x, tf.stack([-1, group, group_size, h, w]))
-
-    mean, var = tf.nn.moments(x, [2, 3, 4], keep_dims=True)
-
-    new_shape = [1, group, group_size, 1, 1]
+    # The moments and the normalization in float32 with --precision=fp16/bf16
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
+    if channel_first:
+        h, w = orig_shape[2], orig_shape[3]
+        x = tf.reshape(x, tf.stack([-1, group, group_size, h, w]))
+        mean, var = tf.nn.moments(x, [2, 3, 4], keep_dims=True)
+        new_shape = [1, group, group_size, 1, 1]
+    else:
+        h, w = orig_shape[1], orig_shape[2]
+        x = tf.reshape(x, tf.stack([-1, h, w, group, group_size]))
+        mean, var = tf.nn.moments(x, [1, 2, 4], keep_dims=True)
+        new_shape = [1, 1, 1, group, group_size]
 
     beta = tf.get_variable('beta', [chan], initializer=tf.constant_initializer())
     beta = tf.reshape(beta, new_shape)
@@ -37,7 +45,7 @@ def GroupNorm(x, group, gamma_initializer=tf.constant_initializer(1.)):
     gamma = tf.reshape(gamma, new_shape)
 
     out = tf.nn.batch_normalization(x, mean, var, beta, gamma, 1e-5, name='output')
-    return tf.reshape(out, orig_shape, name='output')
+    return tf.reshape(tf.cast(out, dtype), orig_shape, name='output')
 
 
 def convnormrelu(x, name, chan, norm='gn'):
@@ -46,16 +54,19 @@ def convnormrelu(x, name, chan, norm='gn'):
         x = BatchNorm(name + '_bn', x)
     elif norm == 'gn':
         with tf.variable_scope(name + '_gn'):
-            x = GroupNorm(x, 32)
+            x = GroupNorm(x, 32, data_format=get_arg_scope()['Conv2D']['data_format'])
     x = tf.nn.relu(x, name=name + '_relu')
     return x
 
 
-def VGG16(image, classes=5):
+def VGG16(image, classes=5, data_format='channels_first'):
+    """
+    image is expected in `data_format` layout. fc6 always flattens `latent` in
+    NCHW order, so a checkpoint loads in either layout.
+    """
     with argscope(Conv2D, kernel_initializer=tf.variance_scaling_initializer(scale=2.)), \
-        argscope([Conv2D, MaxPooling, BatchNorm], data_format='channels_first'):
-        image_channel_first = tf.transpose(image, [0, 3, 1, 2])
-        latent = (LinearWrap(image_channel_first)
+        argscope([Conv2D, MaxPooling, BatchNorm], data_format=data_format):
+        latent = (LinearWrap(image)
                   .apply(convnormrelu, 'conv1_1', 64)
                   .apply(convnormrelu, 'conv1_2', 64)
                   .MaxPooling('pool1', 2)
@@ -80,7 +91,9 @@ def VGG16(image, classes=5):
                   .MaxPooling('pool5', 2)
                   ())
                   # 7
-        logits = (LinearWrap(latent)
+        # The fc6 weights follow the NCHW flattening of the original channels_first graph
+        flat = latent if data_format in ['NCHW', 'channels_first'] else tf.transpose(latent, [0, 3, 1, 2])
+        logits = (LinearWrap(flat)
                   .FullyConnected('fc6', 4096,
                                   kernel_initializer=tf.random_normal_initializer(stddev=0.001))
                   .tf.nn.relu(name='fc6_relu')
@@ -0,0 +1,238 @@
+# coding=utf-8
+"""
+Find the training batch size of a run_vinmec.py configuration (--name/--mode/--shape/--types...):
+a few Adam steps of the real graph at growing batch sizes, doubling then bisecting up to the
+largest one fitting in the memory budget, and recommend the one with the best images/sec.
+The recommendation is merged into a lookup file, which run_vinmec.py --batch_lookup reads.
+
+Example:
+    python probe_batch.py --name=DenseNet201 --shape=512 --types=16 --batch_lookup=batch_lookup.json
+    python probe_batch.py --name=ResNet101 --mode=se --shape=512 --memory_budget=10000 --batch_lookup=batch_lookup.json
+    python run_vinmec.py --name=DenseNet201 --shape=512 --types=16 --batch_lookup=batch_lookup.json
+
+The peak memory is the one of the GPU allocator on GPU (from a traced step), of the
+process on CPU. A batch fits when its steps run without running out of memory and below the budget.
+Every batch is probed in its own process, so that an out of memory does not leak into the next one.
+"""
+import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+import psutil
+
+
+def get_lookup_key(args):
+    """
+    The configuration the peak memory depends on: the model, its input, the layout and the precision.
+    """
+    from run_vinmec import get_default_data_format
+    data_format = args.data_format or get_default_data_format()
+    key = '{}/{}/{}/{}/{}'.format(args.name, args.mode, args.shape, args.types, data_format)
+    if args.precision != 'fp32':
+        key = '{}/{}'.format(key, args.precision)
+    if args.memory_efficient:
+        key = '{}/memory_efficient'.format(key)
+    return key
+
+
+def lookup_batch(fname, args):
+    """
+    Returns:
+        the batch recommended for `args` in the lookup file, None if it was not probed.
+    """
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        entry = json.load(f).get(get_lookup_key(args))
+    return None if entry is None else entry['batch']
+
+
+def peak_device_mb(run_metadata):
+    """
+    The largest memory in use of the GPU allocators during a traced step, None without a GPU.
+    """
+    peaks = [m.allocator_bytes_in_use for dev in run_metadata.step_stats.dev_stats
+             for node in dev.node_stats for m in node.memory if 'GPU' in m.allocator_name]
+    return max(peaks) / 1024.0 / 1024.0 if peaks else None
+
+
+def probe(args, batch, steps=5, warmup=2):
+    """
+    Run `warmup` + `steps` training steps at `batch`. Expected to run in a fresh process.
+    Returns:
+        dict with 'step_ms', 'images_per_sec', 'peak_mb' and 'device' (gpu or cpu),
+        or 'error' ('oom' when out of memory).
+    """
+    from tensorpack.tfutils.tower import TowerContext
+    from run_vinmec import Model, tf
+    model = Model(args=args)
+    image = tf.placeholder(tf.float32, [batch, args.shape, args.shape, 1], 'image')
+    label = tf.placeholder(tf.float32, [batch, args.types], 'label')
+    inputs = [image, label]
+    if args.teacher_cache:
+        inputs.append(tf.placeholder(tf.float32, [batch, args.types], 'soft_label'))
+    if args.accum > 1:
+        inputs.append(tf.placeholder(tf.float32, [2, args.types], 'label_counts'))
+    with TowerContext('', is_training=True):
+        cost = model.build_graph(*inputs)
+    train_op = model.optimizer().minimize(cost)
+    feed = {image: np.random.uniform(0, 255, image.shape.as_list()).astype(np.float32),
+            label: np.random.randint(0, 2, label.shape.as_list()).astype(np.float32)}
+    if args.teacher_cache:
+        feed[inputs[2]] = np.random.uniform(0, 1, label.shape.as_list()).astype(np.float32)
+    if args.accum > 1:
+        feed[inputs[-1]] = np.stack([np.sum(1. - feed[label], axis=0), np.sum(feed[label], axis=0)])
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    try:
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(warmup):
+                sess.run(train_op, feed_dict=feed)
+            latency = []
+            for _ in range(steps):
+                start = time.time()
+                sess.run(train_op, feed_dict=feed)
+                latency.append(time.time() - start)
+            run_metadata = tf.RunMetadata()
+            sess.run(train_op, feed_dict=feed, run_metadata=run_metadata,
+                     options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+    except tf.errors.ResourceExhaustedError:
+        return {'error': 'oom'}
+    step = float(np.median(latency))
+    peak = peak_device_mb(run_metadata)
+    return {
+        'step_ms': step * 1000.0,
+        'images_per_sec': batch / step,
+        'peak_mb': peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'device': 'gpu' if peak is not None else 'cpu',
+    }
+
+
+def _worker(args, batch, steps, warmup, results):
+    try:
+        results.put(probe(args, batch, steps, warmup))
+    except Exception as e:
+        results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def probe_in_subprocess(args, batch, steps=5, warmup=2):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=_worker, args=(args, batch, steps, warmup, results))
+    proc.start()
+    proc.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        # Killed, typically by the kernel when the host runs out of memory
+        return {'error': 'exit code {}'.format(proc.exitcode)}
+
+
+def fits(result, budget_mb=None):
+    """
+    Whether the probe ran below `budget_mb`, by default 90% of the host memory on CPU,
+    and as long as it does not run out of memory on GPU.
+    """
+    if 'error' in result:
+        return False
+    if budget_mb is None and result['device'] == 'cpu':
+        budget_mb = psutil.virtual_memory().total / 1024.0 / 1024.0 * 0.9
+    return budget_mb is None or result['peak_mb'] <= budget_mb
+
+
+def search(args, budget_mb, min_batch=1, max_batch=1024, steps=5, warmup=2):
+    """
+    Double the batch from `min_batch` until it does not fit, then bisect between the last
+    fitting batch and the first failing one.
+    Returns:
+        dict of batch -> probe result.
+    """
+    results = {}
+
+    def run(batch):
+        results[batch] = probe_in_subprocess(args, batch, steps, warmup)
+        r = results[batch]
+        print('batch {:>4}: {}'.format(batch, r['error'] if 'error' in r else
+                                      '{:.1f}ms/step {:.1f} images/s peak {:.0f}MB{}'.format(
+                                          r['step_ms'], r['images_per_sec'], r['peak_mb'],
+                                          '' if fits(r, budget_mb) else ' over budget')))
+        return fits(r, budget_mb)
+
+    low, high = None, None
+    batch = min_batch
+    while batch <= max_batch:
+        if not run(batch):
+            high = batch
+            break
+        low = batch
+        batch *= 2
+    if low is None or high is None:
+        return results
+    while high - low > 1:
+        batch = (low + high) // 2
+        if run(batch):
+            low = batch
+        else:
+            high = batch
+    return results
+
+
+def recommend(results, budget_mb):
+    """
+    Returns:
+        the fitting batch with the best images/sec, None if none fits.
+    """
+    fitting = [b for b, r in results.items() if fits(r, budget_mb)]
+    if not fitting:
+        return None
+    return max(fitting, key=lambda b: results[b]['images_per_sec'])
+
+
+if __name__ == '__main__':
+    from run_vinmec import get_parser
+    parser = get_parser()
+    parser.add_argument('--memory_budget', type=float, default=None,
+                        help='peak memory allowed in MB, default: 90%% of the host memory on CPU, '
+                             'all of the device memory on GPU')
+    parser.add_argument('--min_batch', type=int, default=1)
+    parser.add_argument('--max_batch', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=5, help='timed steps per batch')
+    parser.add_argument('--warmup', type=int, default=2)
+    args = parser.parse_args()
+    if args.gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus.split(',')[0]
+    output = args.batch_lookup or 'batch_lookup.json'
+
+    budget = args.memory_budget
+    results = search(args, budget, args.min_batch, args.max_batch, args.steps, args.warmup)
+    batch = recommend(results, budget)
+    if batch is None:
+        print('No batch of {} fits in {}'.format(get_lookup_key(args), 'memory' if budget is None else
+                                                 '{:.0f}MB'.format(budget)))
+        sys.exit(1)
+    best = results[batch]
+    max_fit = max(b for b, r in results.items() if fits(r, budget))
+    print('{}: batch {} ({:.1f} images/s, peak {:.0f}MB), largest fitting batch {}'.format(
+        get_lookup_key(args), batch, best['images_per_sec'], best['peak_mb'], max_fit))
+
+    lookup = {}
+    if os.path.isfile(output):
+        with open(output) as f:
+            lookup = json.load(f)
+    lookup[get_lookup_key(args)] = {
+        'batch': batch, 'max_batch': max_fit, 'images_per_sec': best['images_per_sec'],
+        'step_ms': best['step_ms'], 'peak_mb': best['peak_mb'], 'device': best['device'],
+        'memory_budget_mb': budget, 'date': datetime.now().isoformat(),
+        'probes': {str(b): r for b, r in sorted(results.items())}}
+    with open(output, 'w') as f:
+        json.dump(lookup, f, indent=2, sort_keys=True)
+    print('Written to {}'.format(output))
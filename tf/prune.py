@@ -0,0 +1,341 @@
+# coding=utf-8
+"""
+Structured channel pruning of trained ResNet101 and DenseNet checkpoints for CPU inference:
+remove the lowest ranked conv channels up to a target reduction of the multiply-adds, rewrite the
+checkpoint and the channel config, fine-tune for a few epochs and report the latency and metric deltas.
+
+Example:
+    python prune.py --gpus=0 --name=ResNet101 --mode=resnet --shape=256 --types=16 \
+        --load=train_log/ResNet101/All/resnet/256/16/max-valid_roc_auc \
+        --flops_reduction=0.3 --finetune_epochs=5 --output=train_log/pruned/resnet101_30
+    # the report alone, on the CPU
+    python prune.py --gpus= --report_only --name=ResNet101 --mode=resnet --shape=256 --types=16 \
+        --load=train_log/ResNet101/All/resnet/256/16/max-valid_roc_auc --output=train_log/pruned/resnet101_30
+    # the pruned model is then built from its config
+    python run_vinmec.py --pred --name=ResNet101 --mode=resnet --shape=256 --types=16 \
+        --prune_config=train_log/pruned/resnet101_30/prune_config.json \
+        --load=train_log/pruned/resnet101_30/finetune/checkpoint
+
+ResNet101 (preact, resnet and se modes): the conv1 and conv2 channels of every bottleneck, ranked
+by the |gamma| of their BatchNorm. The block outputs, summed with the shortcuts, keep their width.
+DenseNet: the new features of every layer, ranked by their mean |gamma| over the BatchNorms reading
+them (the later layers of the block, and its transition or bnlast). The transitions keep their width.
+Every prunable layer loses the same fraction of its channels, bisected to reach --flops_reduction.
+The optimizer slots are dropped: the fine-tuning starts a new Adam at --finetune_lr.
+"""
+import copy
+import json
+import os
+import re
+
+import numpy as np
+
+from tensorpack import *
+from tensorpack.tfutils.varmanip import get_checkpoint_path, save_chkpt_vars
+from tensorpack.utils import logger
+
+from run_vinmec import Model, PRUNABLE_MODELS, get_parser, get_pathologies, get_eval_dataflow
+from run_vinmec import get_teacher_init, get_train_config, get_train_input, get_trainer, tf
+from report import evaluate_predictor, print_comparison, write_report
+
+RESNET_FEATURES = [64, 128, 256, 512]
+RESNET_BLOCKS = [3, 4, 23, 3]
+DENSENET_BLOCKS = {
+    'DenseNet121': [6, 12, 24, 16],
+    'DenseNet169': [6, 12, 32, 32],
+    'DenseNet201': [6, 12, 48, 32],
+}
+GROWTH_RATE = 32
+BN_VARIABLES = ['gamma', 'beta', 'mean/EMA', 'variance/EMA']
+# Optimizer and training state, and the frozen teacher of a distilled student
+SKIPPED_VARIABLES = re.compile(r'Adam|AccumGrad|beta[12]_power|global_step|learning_rate|loss_scale|good_steps|'
+                               r'^teacher/')
+
+
+def keep_count(width, ratio):
+    return max(1, int(round(width * (1. - ratio))))
+
+
+def conv_size(size, stride):
+    # SAME padding
+    return (size + stride - 1) // stride
+
+
+def resnet_widths(ratio=0.):
+    """
+    Returns:
+        per group, the (conv1, conv2) channels of every bottleneck with `ratio` of them pruned.
+    """
+    return [[[keep_count(features, ratio)] * 2 for _ in range(blocks)]
+            for features, blocks in zip(RESNET_FEATURES, RESNET_BLOCKS)]
+
+
+def resnet_flops(widths, shape, classes):
+    """
+    The multiply-adds of the convolutions and of the linear layer of a ResNet101.
+    """
+    size = conv_size(shape, 2)
+    flops = size * size * 7 * 7 * 64
+    size = conv_size(size, 2)
+    channels = 64
+    for g, (features, blocks) in enumerate(zip(RESNET_FEATURES, widths)):
+        for i, (width1, width2) in enumerate(blocks):
+            out = conv_size(size, 2 if g > 0 and i == 0 else 1)
+            flops += size * size * channels * width1
+            flops += out * out * 3 * 3 * width1 * width2 + out * out * width2 * features * 4
+            if channels != features * 4:
+                flops += out * out * channels * features * 4
+            size, channels = out, features * 4
+    return flops + channels * classes
+
+
+def densenet_widths(name, ratio=0.):
+    """
+    Returns:
+        the new features of every layer per block with `ratio` of them pruned ('growth'), and the
+        output channels of the transitions, those of the unpruned model ('transition').
+    """
+    transition, channels = [], 64
+    for blocks in DENSENET_BLOCKS[name][:3]:
+        channels += GROWTH_RATE * blocks
+        transition.append(channels)
+    return {'growth': [[keep_count(GROWTH_RATE, ratio)] * blocks for blocks in DENSENET_BLOCKS[name]],
+            'transition': transition}
+
+
+def densenet_flops(widths, shape, classes):
+    """
+    The multiply-adds of the convolutions and of the linear layer of a DenseNet.
+    """
+    size = conv_size(shape, 2)
+    flops = size * size * 7 * 7 * 64
+    size = conv_size(size, 2)
+    channels = 64
+    for g, growths in enumerate(widths['growth']):
+        for growth in growths:
+            flops += size * size * 3 * 3 * channels * growth
+            channels += growth
+        if g < 3:
+            flops += size * size * channels * widths['transition'][g]
+            channels = widths['transition'][g]
+            size //= 2
+    return flops + channels * classes
+
+
+def find_ratio(get_widths, get_flops, target, max_ratio=0.8, steps=20):
+    """
+    Bisect the fraction of the channels of every layer to prune for a `target` fraction of the flops.
+    """
+    flops = get_flops(get_widths(0.))
+    low, high = 0., max_ratio
+    if 1. - get_flops(get_widths(high)) / flops < target:
+        logger.warn("Pruning {:.0%} of the channels only removes {:.1%} of the flops".format(
+            high, 1. - get_flops(get_widths(high)) / flops))
+        return high
+    for _ in range(steps):
+        ratio = (low + high) / 2.
+        if 1. - get_flops(get_widths(ratio)) / flops >= target:
+            high = ratio
+        else:
+            low = ratio
+    return high
+
+
+def top_channels(scores, count):
+    # In their original order
+    return np.sort(np.argsort(-scores, kind='stable')[:count])
+
+
+def slice_bn(variables, prefix, keep):
+    for name in BN_VARIABLES:
+        variables[prefix + 'bn/' + name] = variables[prefix + 'bn/' + name][keep]
+
+
+def prune_resnet(variables, widths):
+    """
+    Keep the channels of the conv1 and conv2 of every bottleneck with the largest BatchNorm |gamma|.
+    """
+    for g, blocks in enumerate(widths):
+        for i, (width1, width2) in enumerate(blocks):
+            prefix = 'group{}/block{}/'.format(g, i)
+            keep1 = top_channels(np.abs(variables[prefix + 'conv1/bn/gamma']), width1)
+            keep2 = top_channels(np.abs(variables[prefix + 'conv2/bn/gamma']), width2)
+            slice_bn(variables, prefix + 'conv1/', keep1)
+            slice_bn(variables, prefix + 'conv2/', keep2)
+            variables[prefix + 'conv1/W'] = variables[prefix + 'conv1/W'][:, :, :, keep1]
+            variables[prefix + 'conv2/W'] = variables[prefix + 'conv2/W'][:, :, keep1, :][:, :, :, keep2]
+            variables[prefix + 'conv3/W'] = variables[prefix + 'conv3/W'][:, :, keep2, :]
+
+
+def dense_segments(block_in, count):
+    """
+    The (layer, offset, width) segments of the input of layer `count` of an unpruned block, in the
+    concatenation order (newest first), layer -1 being the block input.
+    """
+    segments, offset = [], 0
+    for j in list(range(count - 1, -1, -1)) + [-1]:
+        width = block_in if j < 0 else GROWTH_RATE
+        segments.append((j, offset, width))
+        offset += width
+    return segments
+
+
+def prune_densenet(variables, widths):
+    """
+    Keep the new features of every layer with the largest mean BatchNorm |gamma| over their readers.
+    """
+    block_in = 64
+    for g, growths in enumerate(widths['growth']):
+        prefix = 'dense_group{}/'.format(g)
+        count = len(growths)
+        # The BatchNorm of the layers, then of the transition or bnlast, reading the block features
+        readers = [prefix + 'block{}/bn_compos/'.format(i) for i in range(count)]
+        readers.append('trans_group{}/bn_compos/'.format(g) if g < 3 else 'bnlast/')
+        keeps = {-1: np.arange(block_in)}
+        for j in range(count):
+            scores = []
+            for i in range(j + 1, count + 1):
+                offset = dict((k, o) for k, o, _ in dense_segments(block_in, i))[j]
+                scores.append(np.abs(variables[readers[i] + 'bn/gamma'][offset:offset + GROWTH_RATE]))
+            keeps[j] = top_channels(np.mean(scores, axis=0), growths[j])
+
+        for i, reader in enumerate(readers):
+            keep_in = np.concatenate([offset + keeps[j] for j, offset, _ in dense_segments(block_in, i)])
+            slice_bn(variables, reader, keep_in)
+            if i < count:
+                name = prefix + 'block{}/conv_compos/W'.format(i)
+                variables[name] = variables[name][:, :, keep_in, :][:, :, :, keeps[i]]
+            elif g < 3:
+                name = 'trans_group{}/conv_compos/W'.format(g)
+                variables[name] = variables[name][:, :, keep_in, :]
+            else:
+                variables['linear/W'] = variables['linear/W'][keep_in, :]
+        if g < 3:
+            block_in = widths['transition'][g]
+
+
+def count_params(variables):
+    return int(sum(np.size(v) for v in variables.values()))
+
+
+def prune(args, variables):
+    """
+    Prune the checkpoint `variables` of --name in place.
+    Returns:
+        the config of the pruned model, read by run_vinmec.py --prune_config.
+    """
+    if args.name == 'ResNet101':
+        get_widths, get_flops = resnet_widths, resnet_flops
+    else:
+        get_widths, get_flops = lambda ratio: densenet_widths(args.name, ratio), densenet_flops
+    ratio = find_ratio(get_widths, lambda widths: get_flops(widths, args.shape, args.types),
+                       args.flops_reduction, args.max_ratio)
+    widths = get_widths(ratio)
+    params = count_params(variables)
+    if args.name == 'ResNet101':
+        prune_resnet(variables, widths)
+    else:
+        prune_densenet(variables, widths)
+    return {
+        'name': args.name, 'mode': args.mode, 'shape': args.shape, 'types': args.types, 'load': args.load,
+        'ratio': ratio, 'widths': widths,
+        'flops': get_flops(get_widths(0.), args.shape, args.types),
+        'pruned_flops': get_flops(widths, args.shape, args.types),
+        'params': params, 'pruned_params': count_params(variables),
+    }
+
+
+def finetune(args, config_file, load, logdir):
+    finetune_args = copy.copy(args)
+    finetune_args.prune_config = config_file
+    logger.set_logger_dir(logdir, 'd')
+    ds_train, steps_per_epoch = get_train_input(finetune_args)
+    config = get_train_config(finetune_args, Model(args=finetune_args), ds_train, max_epoch=args.finetune_epochs,
+                              session_init=get_teacher_init(finetune_args, SmartInit(load)),
+                              steps_per_epoch=steps_per_epoch,
+                              # After the default schedule, so that it replaces its learning rate
+                              extra_callbacks=[ScheduledHyperParamSetter('learning_rate',
+                                                                         [(0, args.finetune_lr)])])
+    launch_train_with_config(config, get_trainer(finetune_args))
+
+
+def compare(args, config, config_file, load, output):
+    """
+    Per-class F1/AUC and latency of the --load and the pruned `load` checkpoints on --eval_csv,
+    and the deltas of the pruned one.
+    """
+    pruned_args = copy.copy(args)
+    pruned_args.prune_config = config_file
+    ds_eval = get_eval_dataflow(args, args.eval_csv, is_train='valid', batch=1)
+    reports = []
+    for title, model_args, model_load in [('original', args, args.load), ('pruned', pruned_args, load)]:
+        predictor = OfflinePredictor(PredictConfig(
+            model=Model(args=model_args),
+            session_init=SmartInit(model_load),
+            input_names=['image'],
+            output_names=['estim']))
+        reports.append((title, evaluate_predictor(predictor, ds_eval, args.types, args.threshold)))
+    print_comparison(reports, get_pathologies(args.types, args.pathology))
+
+    original, pruned = reports[0][1], reports[1][1]
+    deltas = {
+        'flops': config['pruned_flops'] / float(config['flops']) - 1.,
+        'params': config['pruned_params'] / float(config['params']) - 1.,
+        'latency_ms': pruned.get('latency_ms', {}).get('mean', np.nan) -
+                      original.get('latency_ms', {}).get('mean', np.nan),
+        'f1_score_weighted': pruned['f1_score_weighted'] - original['f1_score_weighted'],
+        'roc_auc_mean': float(np.nanmean(pruned['roc_auc']) - np.nanmean(original['roc_auc'])),
+    }
+    print('flops {:+.1%}, params {:+.1%}, latency/image {:+.2f}ms, f1 (weighted) {:+.3f}, mean auc {:+.3f}'.format(
+        deltas['flops'], deltas['params'], deltas['latency_ms'], deltas['f1_score_weighted'], deltas['roc_auc_mean']))
+    report = os.path.join(output, 'report.json')
+    write_report(report, reports, name=args.name, mode=args.mode, shape=args.shape, load=args.load,
+                 pruned=load, eval_csv=args.eval_csv, prune=config, deltas=deltas)
+    logger.info("Report written to {}".format(report))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--flops_reduction', type=float, default=0.3, help='fraction of the multiply-adds to remove')
+    parser.add_argument('--max_ratio', type=float, default=0.8, help='largest fraction of the channels of a layer to remove')
+    parser.add_argument('--finetune_epochs', type=int, default=5, help='0 to only prune')
+    parser.add_argument('--finetune_lr', type=float, default=1e-4)
+    parser.add_argument('--eval_csv', default='valid_v2.csv', help='labelled split used for the report')
+    parser.add_argument('--output', default=None,
+                        help='folder of the pruned checkpoint, its prune_config.json, the fine-tuning and the report')
+    parser.add_argument('--report_only', action='store_true',
+                        help='only compare the --load and the pruned checkpoints of --output, e.g. with --gpus=')
+    args = parser.parse_args()
+    assert args.load, "--load a trained checkpoint to prune"
+    assert args.name in PRUNABLE_MODELS, "--name must be one of {}".format(PRUNABLE_MODELS)
+    # The grouped convolutions of resnext32x4d cannot lose single channels
+    assert args.name != 'ResNet101' or args.mode in ['preact', 'resnet', 'se'], "--mode=resnext32x4d is not supported"
+    assert args.trainer == 'ps' and args.prune_config is None
+    if args.gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
+    output = args.output or os.path.join('train_log', 'pruned', args.name, args.mode, str(args.shape), str(args.types))
+    config_file = os.path.join(output, 'prune_config.json')
+    pruned_file = os.path.join(output, 'pruned')
+    finetune_dir = os.path.join(output, 'finetune')
+
+    if not args.report_only:
+        reader = tf.train.NewCheckpointReader(get_checkpoint_path(args.load))
+        variables = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+                     if not SKIPPED_VARIABLES.search(name)}
+        config = prune(args, variables)
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+        save_chkpt_vars(variables, pruned_file)
+        logger.info("Pruned {:.0%} of the channels of every layer: flops {:.2f}G -> {:.2f}G, params {:.1f}M -> {:.1f}M".format(
+            config['ratio'], config['flops'] / 1e9, config['pruned_flops'] / 1e9,
+            config['params'] / 1e6, config['pruned_params'] / 1e6))
+        if args.finetune_epochs > 0:
+            finetune(args, config_file, pruned_file, finetune_dir)
+            tf.reset_default_graph()
+
+    with open(config_file) as f:
+        config = json.load(f)
+    checkpoint = tf.train.latest_checkpoint(finetune_dir) if os.path.isdir(finetune_dir) else None
+    compare(args, config, config_file, checkpoint or pruned_file, output)
@@ -0,0 +1,150 @@
+# coding=utf-8
+"""
+Multi-resolution store of a dataset: every image decoded once and saved at a pyramid of levels,
+the shorter side of a level being at most its size. Vinmec and Chexpert (pyramid=True) read the
+smallest level at or above their resize shape, so a new --shape never decodes the originals again.
+
+Example:
+    python pyramid.py --data=/u01/data/Vimmec_Data_small --fname=train_v2.csv,valid_v2.csv,test_v2.csv,test.csv
+    python pyramid.py --data=/u01/data/CheXpert-v1.0-small --format=chexpert --fname=train.csv,valid.csv
+    python run_vinmec.py --name=DenseNet121 --shape=320 --types=16 --pyramid
+
+The store lives in <folder>/pyramid/<level>/, with the relative paths of the csv files plus '.png'.
+Images missing from the store, or shapes above the largest level, are read from the originals.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+
+import cv2
+
+import numpy as np
+
+import pandas as pd
+
+
+LEVELS = [256, 320, 512, 1024, 2048]
+
+
+def get_store_dir(folder):
+    return os.path.join(folder, 'pyramid')
+
+
+def build_pyramid(image, levels):
+    """
+    Returns:
+        dict of level -> image whose shorter side is min(level, the original one), from the
+        largest level down, each one resized from the previous.
+    """
+    pyramid = {}
+    for level in sorted(levels, reverse=True):
+        h, w = image.shape[:2]
+        scale = float(level) / min(h, w)
+        if scale < 1:
+            image = cv2.resize(image, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))),
+                               interpolation=cv2.INTER_AREA)
+        pyramid[level] = image
+    return pyramid
+
+
+class PyramidStore(object):
+    """
+    Read access to the levels written by `build`.
+    """
+
+    def __init__(self, folder):
+        self.dirname = get_store_dir(folder)
+        fname = os.path.join(self.dirname, 'levels.json')
+        self.levels = []
+        if os.path.isfile(fname):
+            with open(fname) as f:
+                self.levels = sorted(json.load(f)['levels'])
+
+    def get_level(self, shape):
+        """
+        The smallest level at or above `shape` (int or (h, w)), None if there is none.
+        """
+        size = max(shape) if isinstance(shape, (list, tuple, np.ndarray)) else shape
+        for level in self.levels:
+            if level >= size:
+                return level
+        return None
+
+    def get_path(self, relpath, level, original):
+        """
+        The path of `relpath` at `level`, or `original` when it is not in the store.
+        """
+        if level is None:
+            return original
+        path = os.path.join(self.dirname, str(level), relpath + '.png')
+        return path if os.path.isfile(path) else original
+
+
+def _write_levels(task):
+    src, relpath, dirname, levels = task
+    if all(os.path.isfile(os.path.join(dirname, str(level), relpath + '.png')) for level in levels):
+        return True
+    image = cv2.imdecode(np.fromfile(src, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return False
+    for level, resized in build_pyramid(image, levels).items():
+        path = os.path.join(dirname, str(level), relpath + '.png')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, resized, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return True
+
+
+def list_images(folder, fnames, format='vinmec'):
+    """
+    Returns:
+        list of (original path, path relative to the store) of the images of the csv files.
+    """
+    images = {}
+    for fname in fnames:
+        df = pd.read_csv(os.path.join(folder, fname))
+        if format == 'vinmec':
+            for name in df['Images']:
+                relpath = os.path.join('data', name)
+                images[relpath] = os.path.join(folder, relpath)
+        else:
+            # The Chexpert paths are relative to the parent folder
+            for relpath in df['Path']:
+                images[relpath] = os.path.join(os.path.dirname(folder), relpath)
+    return sorted((src, relpath) for relpath, src in images.items())
+
+
+def build(folder, fnames, levels=LEVELS, format='vinmec', workers=8):
+    """
+    Write the levels of every image of the csv files `fnames`, skipping the ones already written.
+    """
+    dirname = get_store_dir(folder)
+    images = list_images(folder, fnames, format)
+    pool = mp.Pool(workers)
+    tasks = [(src, relpath, dirname, levels) for src, relpath in images]
+    failed = [relpath for (_, relpath), ok in
+              zip(images, pool.imap(_write_levels, tasks, chunksize=16)) if not ok]
+    pool.close()
+    pool.join()
+
+    # Only once the images are written, the readers trust the listed levels
+    fname = os.path.join(dirname, 'levels.json')
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            levels = sorted(set(levels) | set(json.load(f)['levels']))
+    with open(fname, 'w') as f:
+        json.dump({'levels': sorted(levels)}, f)
+    print('{} images written at levels {}, {} unreadable'.format(len(images) - len(failed), levels, len(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True, help='dataset folder, as given to Vinmec/Chexpert')
+    parser.add_argument('--format', default='vinmec', choices=['vinmec', 'chexpert'])
+    parser.add_argument('--fname', default='train.csv,valid.csv,test.csv', help='comma separated csv files')
+    parser.add_argument('--levels', default=','.join(str(l) for l in LEVELS), help='comma separated sizes')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count())
+    args = parser.parse_args()
+    build(args.data, args.fname.split(','), [int(l) for l in args.levels.split(',')], args.format, args.workers)
@@ -0,0 +1,151 @@
+# coding=utf-8
+"""
+Post-training quantization of the tf/models backbones for CPU-only inference.
+
+Example:
+    python quantize.py --name=DenseNet121 --shape=320 --types=16 \
+        --load=train_log/DenseNet121/All/none/320/16/model-178750.index \
+        --quant_precision=int8 --calib=300 --output=densenet121_int8.tflite
+
+The quantized model can then be used by the prediction path:
+    python run_vinmec.py --name=DenseNet121 --shape=320 --pred --load=densenet121_int8.tflite
+"""
+import os
+import time
+
+import numpy as np
+
+import tensorflow as tf
+tf = tf.compat.v1
+
+from tensorpack import *
+from tensorpack.dataflow import FixedSizeData
+from tensorpack.tfutils.export import ModelExporter
+from tensorpack.utils import logger
+
+from run_vinmec import Model, get_parser, get_eval_dataflow
+from report import evaluate_predictor, print_comparison, write_report
+
+
+class TFLitePredictor(object):
+    """
+    Callable with the same convention as OfflinePredictor: takes an image batch, returns [estim].
+    The converted graph has a fixed batch of 1, so the batch is run image by image.
+    """
+
+    def __init__(self, filename):
+        self.interpreter = tf.lite.Interpreter(model_path=filename)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+
+    def __call__(self, image):
+        estims = []
+        for img in image:
+            self.interpreter.set_tensor(self.input_detail['index'],
+                                        img[np.newaxis].astype(self.input_detail['dtype']))
+            self.interpreter.invoke()
+            estims.append(self.interpreter.get_tensor(self.output_detail['index'])[0])
+        return [np.stack(estims)]
+
+
+def pred_tflite(filename, dataflow):
+    """
+    Same as `run_vinmec.pred`, for a .tflite model.
+    """
+    predictor = TFLitePredictor(filename)
+    estims = []
+    for dp in dataflow:
+        image = dp[0]
+        estim = predictor(image)[0]
+        estims.append(estim)
+    return np.squeeze(np.array(estims))
+
+
+def export_frozen_graph(model, load, filename):
+    """
+    Write an inference-only, TOCO-compatible frozen graph with input 'image' and output 'estim'.
+    """
+    config = PredictConfig(
+        model=model,
+        session_init=SmartInit(load),
+        input_names=['image'],
+        output_names=['estim'])
+    ModelExporter(config).export_compact(filename, toco_compatible=True)
+
+
+def convert(frozen_graph, shape, precision, calib_dataflow=None):
+    """
+    Args:
+        frozen_graph (str): path to the frozen graph.
+        shape (int): input resolution.
+        precision (str): 'float16' (weights only) or 'int8' (weights and activations,
+            with activation ranges calibrated on `calib_dataflow`).
+    Returns:
+        the serialized tflite model.
+    """
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        frozen_graph, ['image'], ['estim'],
+        input_shapes={'image': [1, shape, shape, 1]})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif precision == 'int8':
+        assert calib_dataflow is not None, "int8 quantization needs calibration images"
+
+        def representative_dataset():
+            calib_dataflow.reset_state()
+            for dp in calib_dataflow:
+                for img in dp[0]:
+                    yield [img[np.newaxis].astype(np.float32)]
+        # Ops without an int8 kernel fall back to float
+        converter.representative_dataset = representative_dataset
+    else:
+        raise ValueError(precision)
+    return converter.convert()
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--quant_precision', default='int8', choices=['int8', 'float16'])
+    parser.add_argument('--calib', type=int, default=300, help='number of calibration images')
+    parser.add_argument('--calib_csv', default='valid_v2.csv', help='split used for calibration')
+    parser.add_argument('--eval_csv', default='test_v2.csv', help='labelled split used for the report')
+    parser.add_argument('--output', help='output .tflite file')
+    parser.add_argument('--report', help='json file for the accuracy-vs-latency report')
+    args = parser.parse_args()
+    assert args.load, "--load a float checkpoint to quantize"
+
+    # Inference nodes are CPU-only, compare both models there. TFLite expects NHWC.
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    args.data_format = 'channels_last'
+    output = args.output or '{}_{}_{}.tflite'.format(args.name, args.shape, args.quant_precision)
+    report = args.report or os.path.splitext(output)[0] + '.json'
+
+    model = Model(args=args)
+    frozen_graph = os.path.splitext(output)[0] + '.pb'
+    export_frozen_graph(model, args.load, frozen_graph)
+
+    ds_calib = get_eval_dataflow(args, args.calib_csv, is_train='valid', batch=1)
+    ds_calib = FixedSizeData(ds_calib, args.calib)
+    start = time.time()
+    tflite_model = convert(frozen_graph, args.shape, args.quant_precision, ds_calib)
+    with open(output, 'wb') as f:
+        f.write(tflite_model)
+    logger.info("Quantized model written to {} in {:.1f}s ({:.1f} MB)".format(
+        output, time.time() - start, len(tflite_model) / 1024.0 ** 2))
+
+    ds_eval = get_eval_dataflow(args, args.eval_csv, is_train='valid', batch=1)
+    float_predictor = OfflinePredictor(PredictConfig(
+        model=model,
+        session_init=SmartInit(args.load),
+        input_names=['image'],
+        output_names=['estim']))
+    reports = [
+        ('float32', evaluate_predictor(float_predictor, ds_eval, args.types, args.threshold)),
+        (args.quant_precision, evaluate_predictor(TFLitePredictor(output), ds_eval, args.types, args.threshold)),
+    ]
+    print_comparison(reports)
+    write_report(report, reports, name=args.name, mode=args.mode, shape=args.shape,
+                 load=args.load, calib=args.calib, eval_csv=args.eval_csv)
+    logger.info("Report written to {}".format(report))
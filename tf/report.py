@@ -0,0 +1,95 @@
+# coding=utf-8
+"""
+Per-class accuracy and latency reports shared by the deployment tools
+(quantization, distillation, pruning).
+"""
+import json
+import time
+
+import numpy as np
+import sklearn.metrics
+
+
+def evaluate_predictor(predictor, dataflow, types, threshold=0.5, warmup=5):
+    """
+    Run `predictor` over a labelled `dataflow` and collect per-class metrics and latency.
+    Args:
+        predictor: callable taking an image batch and returning [estim].
+        dataflow: yields [image, label] batches.
+        types (int): number of classes.
+        threshold (float): decision threshold applied on the sigmoid outputs.
+        warmup (int): number of leading batches excluded from the latency statistics.
+    Returns:
+        dict with per-class 'f1'/'roc_auc' lists, their weighted averages and latency in ms.
+    """
+    estims, labels, latency = [], [], []
+    dataflow.reset_state()
+    for i, dp in enumerate(dataflow):
+        image, label = dp[0], dp[1]
+        start = time.time()
+        estim = predictor(image)[0]
+        elapsed = (time.time() - start) * 1000.0 / len(image)
+        if i >= warmup:
+            latency.append(elapsed)
+        estims.append(np.reshape(estim, (-1, types)))
+        labels.append(np.reshape(label, (-1, types)))
+    estims = np.concatenate(estims).astype(np.float32)
+    labels = np.concatenate(labels).astype(np.float32)
+    return summarize(estims, labels, threshold=threshold, latency=latency)
+
+
+def summarize(estims, labels, threshold=0.5, latency=None):
+    f1_score, roc_auc = [], []
+    for k in range(labels.shape[1]):
+        f1_score.append(float(sklearn.metrics.f1_score(labels[:, k], estims[:, k] >= threshold)))
+        if len(np.unique(labels[:, k])) < 2:
+            roc_auc.append(float('nan'))  # undefined with a single class present
+        else:
+            roc_auc.append(float(sklearn.metrics.roc_auc_score(labels[:, k], estims[:, k])))
+    result = {
+        'f1_score': f1_score,
+        'roc_auc': roc_auc,
+        'f1_score_weighted': float(sklearn.metrics.f1_score(labels, estims >= threshold, average='weighted')),
+        'samples': int(len(labels)),
+    }
+    if latency:
+        result['latency_ms'] = {
+            'mean': float(np.mean(latency)),
+            'p50': float(np.percentile(latency, 50)),
+            'p90': float(np.percentile(latency, 90)),
+        }
+    return result
+
+
+def print_comparison(reports, names=None):
+    """
+    Print per-class F1/AUC and latency of several models side by side.
+    Args:
+        reports: list of (title, report) as returned by :func:`evaluate_predictor`.
+        names: optional class names.
+    """
+    types = len(reports[0][1]['f1_score'])
+    names = names or ['class{}'.format(k) for k in range(types)]
+    header = '{:<24}'.format('') + ''.join('{:>22}'.format(title) for title, _ in reports)
+    print(header)
+    for k in range(types):
+        row = '{:<24}'.format(names[k][:24])
+        for _, report in reports:
+            row += '{:>22}'.format('f1 {:.3f} auc {:.3f}'.format(report['f1_score'][k], report['roc_auc'][k]))
+        print(row)
+    row = '{:<24}'.format('f1 (weighted)')
+    for _, report in reports:
+        row += '{:>22.3f}'.format(report['f1_score_weighted'])
+    print(row)
+    row = '{:<24}'.format('latency/image (ms)')
+    for _, report in reports:
+        latency = report.get('latency_ms', {}).get('mean', float('nan'))
+        row += '{:>22.2f}'.format(latency)
+    print(row)
+
+
+def write_report(filename, reports, **kwargs):
+    content = dict(kwargs)
+    content['models'] = {title: report for title, report in reports}
+    with open(filename, 'w') as f:
+        json.dump(content, f, indent=2)
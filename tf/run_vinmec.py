@@ -11,11 +11,18 @@ from tensorpack.tfutils.summary import add_moving_summary, add_param_summary
 from tensorpack.tfutils.tower import get_current_tower_context
 from tensorpack.tfutils.scope_utils import under_name_scope
 from tensorpack.predict import FeedfreePredictor, PredictConfig
+from tensorpack.tfutils.sesscreate import NewSessionCreator
+from tensorpack.tfutils.optimizer import AccumGradOptimizer, apply_grad_processors
+from tensorpack.tfutils.gradproc import MapGradient
+from tensorpack.tfutils.varreplace import custom_getter_scope, freeze_variables
 from tensorpack.utils import logger, fix_rng_seed
 from tensorpack.utils.gpu import get_num_gpu
 from tensorpack.utils.stats import BinaryStatistics
 import albumentations as AB
 import argparse
+import contextlib
+import json
+import copy
 import sklearn.metrics 
 import sys
 import os
@@ -25,15 +32,23 @@ import tensorflow as tf
 tf = tf.compat.v1
 # tf.disable_v2_behavior()
 # from tensorlayer.cost import dice_coe
-from vinmec import Vinmec
+from vinmec import Vinmec, get_pathologies
+from callbacks import HostPeakMemoryTracker, IMAGE_SUMMARIES, HISTOGRAM_SUMMARIES, get_summary_callbacks
+from callbacks import DataflowStateSaver, ResumeEpoch, load_dataflow_state
+from callbacks import DataflowStatsMonitor, StepTimeBreakdown
+from dataflow_stats import InstrumentedData, PendingCount
+import dataflow_stats
 from models.inceptionbn import InceptionBN
 from models.shufflenet import ShuffleNet
 from models.densenet import DenseNet121, DenseNet169, DenseNet201
 from models.resnet import ResNet101
 from models.vgg16 import VGG16
+from models.capsnet import CapsNet
+from mixture import MixtureData, get_chexpert_source
+import tfdata
 
 
-def visualize_tensors(name, imgs, scale_func=lambda x: (x + 1.) * 128., max_outputs=1):
+def visualize_tensors(name, imgs, scale_func=lambda x: (x + 1.) * 128., max_outputs=1, collections=None):
     """Generate tensor for TensorBoard (casting, clipping)
     Args:
         name: name for visualization operation
@@ -45,7 +60,7 @@ def visualize_tensors(name, imgs, scale_func=lambda x: (x + 1.) * 128., max_outp
     """
     xy = scale_func(tf.concat(imgs, axis=2))
     xy = tf.cast(tf.clip_by_value(xy, 0, 255), tf.uint8, name='viz')
-    tf.summary.image(name, xy, max_outputs=30)
+    tf.summary.image(name, xy, max_outputs=30, collections=collections)
 
 
 class CustomBinaryStatistics(object):
@@ -75,6 +90,7 @@ class CustomBinaryStatistics(object):
 
         self.total_label = []
         self.total_estim = []
+        self.total_proba = []
 
     def feed(self, estim, label):
         """
@@ -91,6 +107,7 @@ class CustomBinaryStatistics(object):
         # self.corr_neg += ((estim == 0) & (estim == label)).sum()
         # print(estim, label)
         self.total_estim.append(estim >= self.threshold)
+        self.total_proba.append(estim)
         self.total_label.append(label)
 
     @property
@@ -130,6 +147,26 @@ class CustomBinaryStatistics(object):
         np_estim = np.array(self.total_estim).astype(np.float32).reshape(-1, self.types)
         return sklearn.metrics.fbeta_score(np_label, np_estim, beta=2, average='weighted')
 
+    def per_class(self):
+        """
+        Returns:
+            dict of metric name -> list of the metric of every class, the roc_auc from the
+            probabilities and -1 for a class without both labels.
+        """
+        np_label = np.concatenate(self.total_label).astype(np.float32).reshape(-1, self.types)
+        np_estim = np.concatenate(self.total_estim).astype(np.float32).reshape(-1, self.types)
+        np_proba = np.concatenate(self.total_proba).astype(np.float32).reshape(-1, self.types)
+        metrics = {'roc_auc': [], 'f1_score': [], 'f2_score': []}
+        for k in range(self.types):
+            label, estim = np_label[:, k], np_estim[:, k]
+            if label.min() == label.max():
+                metrics['roc_auc'].append(-1)
+            else:
+                metrics['roc_auc'].append(sklearn.metrics.roc_auc_score(label, np_proba[:, k]))
+            metrics['f1_score'].append(sklearn.metrics.f1_score(label, estim))
+            metrics['f2_score'].append(sklearn.metrics.fbeta_score(label, estim, beta=2))
+        return metrics
+
 class CustomBinaryClassificationStats(Inferencer):
     """
     Compute precision / recall in binary classification, given the
@@ -148,7 +185,7 @@ class CustomBinaryClassificationStats(Inferencer):
         self.args = args
 
     def _before_inference(self):
-        self.stat = CustomBinaryStatistics(threshold=args.threshold, types=args.types)
+        self.stat = CustomBinaryStatistics(threshold=get_thresholds(self.args), types=self.args.types)
 
     def _get_fetches(self):
         return [self.pred_tensor_name, self.label_tensor_name]
@@ -158,16 +195,21 @@ class CustomBinaryClassificationStats(Inferencer):
         self.stat.feed(estim, label)
 
     def _after_inference(self):
-        return {self.prefix + '_precision': self.stat.precision,
-                self.prefix + '_recall': self.stat.recall,
-                self.prefix + '_f1_score': self.stat.f1_score,
-                self.prefix + '_f2_score': self.stat.f2_score,
-                # self.prefix + '_auc': self.stat.auc,
-                self.prefix + '_roc_auc': self.stat.roc_auc,
-                }
-
-
-def class_balanced_sigmoid_cross_entropy(logits, label, name='cross_entropy_loss'):
+        results = {self.prefix + '_precision': self.stat.precision,
+                   self.prefix + '_recall': self.stat.recall,
+                   self.prefix + '_f1_score': self.stat.f1_score,
+                   self.prefix + '_f2_score': self.stat.f2_score,
+                   # self.prefix + '_auc': self.stat.auc,
+                   self.prefix + '_roc_auc': self.stat.roc_auc,
+                   }
+        if self.args.multitask:
+            for metric, values in self.stat.per_class().items():
+                for name, value in zip(get_head_names(self.args), values):
+                    results['{}_{}_{}'.format(self.prefix, metric, name)] = value
+        return results
+
+
+def class_balanced_sigmoid_cross_entropy(logits, label, label_counts=None, name='cross_entropy_loss'):
     """
     The class-balanced cross entropy loss,
     as in `Holistically-Nested Edge Detection
@@ -175,14 +217,20 @@ def class_balanced_sigmoid_cross_entropy(logits, label, name='cross_entropy_loss
     Args:
         logits: of shape (b, ...).
         label: of the same shape. the ground truth in {0,1}.
+        label_counts: the (2, classes) negative and positive counts to balance with, by default
+                      those of `label`. With --accum, the counts of the whole accumulated batch.
     Returns:
         class-balanced cross entropy loss.
     """
     with tf.name_scope('class_balanced_sigmoid_cross_entropy'):
         y = tf.cast(label, tf.float32)
 
-        count_neg = tf.reduce_sum(1. - y)
-        count_pos = tf.reduce_sum(y)
+        if label_counts is None:
+            count_neg = tf.reduce_sum(1. - y)
+            count_pos = tf.reduce_sum(y)
+        else:
+            count_neg = tf.reduce_sum(label_counts[0])
+            count_pos = tf.reduce_sum(label_counts[1])
         beta = count_neg / (count_neg + count_pos + 1e-6)
 
         pos_weight = beta / (1 - beta + 1e-6)
@@ -193,38 +241,208 @@ def class_balanced_sigmoid_cross_entropy(logits, label, name='cross_entropy_loss
     return tf.where(zero, 0.0, cost, name=name)
 
 
+def multitask_sigmoid_cross_entropy(logits, label, weights, label_counts=None, name='cross_entropy_loss'):
+    """
+    One class-balanced cross entropy per head (column), each with its own beta, averaged with
+    the head weights. A head without positive labels in the batch does not contribute.
+    Args:
+        logits, label: of shape (b, classes).
+        weights: the loss weight of every head.
+        label_counts: as in class_balanced_sigmoid_cross_entropy.
+    Returns:
+        the weighted loss and the (classes,) loss of every head.
+    """
+    with tf.name_scope('multitask_sigmoid_cross_entropy'):
+        y = tf.cast(label, tf.float32)
+        if label_counts is None:
+            count_neg = tf.reduce_sum(1. - y, axis=0)
+            count_pos = tf.reduce_sum(y, axis=0)
+        else:
+            count_neg, count_pos = label_counts[0], label_counts[1]
+        beta = count_neg / (count_neg + count_pos + 1e-6)
+
+        pos_weight = beta / (1 - beta + 1e-6)
+        cost = tf.nn.weighted_cross_entropy_with_logits(logits=logits, targets=y, pos_weight=pos_weight)
+        cost = cost * (1 - beta)
+        costs = tf.where(tf.equal(count_pos, 0.0), tf.zeros_like(count_pos), tf.reduce_mean(cost, axis=0))
+        weights = tf.constant(weights, tf.float32)
+        loss = tf.divide(tf.reduce_sum(costs * weights), tf.reduce_sum(weights), name=name)
+    return loss, costs
+
+
+def distillation_loss(logits, soft_label, temperature=1.0, name='distillation_loss'):
+    """
+    The sigmoid cross entropy of the student against the teacher, both logits divided by
+    `temperature`, as in `Distilling the Knowledge in a Neural Network
+    <http://arxiv.org/abs/1503.02531>`_, one binary distribution per class.
+    Args:
+        logits: the student logits, of shape (b, classes).
+        soft_label: the teacher probabilities, of the same shape.
+    Returns:
+        the loss, scaled by temperature^2 to keep the gradients of the hard labels' magnitude.
+    """
+    with tf.name_scope('distillation_loss'):
+        soft_label = tf.clip_by_value(soft_label, 1e-6, 1. - 1e-6)
+        target = tf.sigmoid((tf.log(soft_label) - tf.log(1. - soft_label)) / temperature)
+        cost = tf.nn.sigmoid_cross_entropy_with_logits(labels=target, logits=logits / temperature)
+    return tf.multiply(tf.reduce_mean(cost), temperature ** 2, name=name)
+
+
+def get_default_data_format():
+    """
+    NCHW is the fast layout for cuDNN convolutions, NHWC is the fast one on CPU.
+    """
+    if tf.config.experimental.list_physical_devices('GPU'):
+        return 'channels_first'
+    return 'channels_last'
+
+
+# The backbones returning their last feature map
+LATENT_MODELS = ['VGG16', 'ResNet101', 'DenseNet121', 'DenseNet169', 'DenseNet201']
+# The backbones whose channels prune.py can remove
+PRUNABLE_MODELS = ['ResNet101', 'DenseNet121', 'DenseNet169', 'DenseNet201']
+
+# Compute dtype of the backbones for --precision
+PRECISIONS = {'fp32': tf.float32, 'fp16': tf.float16, 'bf16': tf.bfloat16}
+
+
+def float32_variable_getter(getter, name, shape=None, dtype=None, trainable=True, *args, **kwargs):
+    """
+    Keep the trainable variables in float32, the master weights Adam updates,
+    and give the layers a copy in their own dtype.
+    """
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, storage_dtype, *args, trainable=trainable, **kwargs)
+    if trainable and dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
 class Model(ModelDesc):
     def __init__(self, args):
         super(Model, self).__init__()
         self.args = args
+        self.data_format = getattr(args, 'data_format', None) or get_default_data_format()
+        logger.info("Using data format {}".format(self.data_format))
+        # The channels of a checkpoint pruned by prune.py
+        self.widths = None
+        if getattr(args, 'prune_config', None):
+            with open(args.prune_config) as f:
+                config = json.load(f)
+            assert (config['name'], config['mode']) == (args.name, args.mode), \
+                "{} is a pruned {} --mode={}".format(args.prune_config, config['name'], config['mode'])
+            self.widths = config['widths']
 
     def inputs(self):
-        return [tf.TensorSpec([None, self.args.shape, self.args.shape, 1], tf.float32, 'image'),
-                tf.TensorSpec([None, self.args.types], tf.float32, 'label')
-                ]
-
-    def build_graph(self, image, label):
+        inputs = [tf.TensorSpec([None, self.args.shape, self.args.shape, 1], tf.float32, 'image'),
+                  tf.TensorSpec([None, self.args.types], tf.float32, 'label')
+                  ]
+        if self.args.teacher_cache:
+            # The cached teacher probabilities of every image, see write_teacher_cache
+            inputs.append(tf.TensorSpec([None, self.args.types], tf.float32, 'soft_label'))
+        if self.args.accum > 1:
+            # The label counts of the accumulated batch, see LabelCountsData
+            inputs.append(tf.TensorSpec([2, self.args.types], tf.float32, 'label_counts'))
+        return inputs
+
+    def backbone(self, feature, name, mode='none', widths=None):
+        """
+        Args:
+            widths: the channels of a pruned ResNet101 or DenseNet, see prune.py.
+        Returns:
+            the logits of the convolutional backbone `name` and its last feature map (None without one).
+        """
+        assert widths is None or name in PRUNABLE_MODELS, name
+        if name == 'VGG16':
+            return VGG16(feature, classes=self.args.types, data_format=self.data_format)
+        elif name == 'ShuffleNet':
+            return ShuffleNet(feature, classes=self.args.types, data_format=self.data_format), None
+        elif name == 'ResNet101':
+            return ResNet101(feature, mode=mode, classes=self.args.types, data_format=self.data_format,
+                             widths=widths)
+        elif name == 'DenseNet121':
+            return DenseNet121(feature, classes=self.args.types, data_format=self.data_format,
+                               efficient=self.args.memory_efficient, widths=widths)
+        elif name == 'DenseNet169':
+            return DenseNet169(feature, classes=self.args.types, data_format=self.data_format,
+                               efficient=self.args.memory_efficient, widths=widths)
+        elif name == 'DenseNet201':
+            return DenseNet201(feature, classes=self.args.types, data_format=self.data_format,
+                               efficient=self.args.memory_efficient, widths=widths)
+        elif name == 'InceptionBN':
+            return InceptionBN(feature, classes=self.args.types, data_format=self.data_format), None
+        raise ValueError(name)
+
+    def teacher_logits(self, feature):
+        """
+        The logits of the frozen --teacher backbone: its variables are under 'teacher/', out of the
+        trainable ones, and its BatchNorms and Dropouts run in inference mode.
+        """
+        with tf.variable_scope('teacher'), freeze_variables(stop_gradient=False, skip_collection=True), \
+                argscope(BatchNorm, training=False), argscope(Dropout, training=False):
+            logit, _ = self.backbone(feature, self.args.teacher_name, self.args.teacher_mode)
+        return tf.stop_gradient(tf.cast(logit, tf.float32))
+
+    def build_graph(self, image, label, *extra):
+        # The optional inputs, in the order of self.inputs()
+        extra = list(extra)
+        soft_label = extra.pop(0) if self.args.teacher_cache else None
+        label_counts = extra.pop(0) if self.args.accum > 1 else None
+        if not get_current_tower_context().is_training:
+            soft_label = None
         image = image / 128.0 - 1.0
-
-        if self.args.name == 'VGG16':
-            logit, recon = VGG16(image, classes=self.args.types)
-        elif self.args.name == 'ShuffleNet':
-            logit = ShuffleNet(image, classes=self.args.types)
-        elif self.args.name == 'ResNet101':
-            logit, recon = ResNet101(image, mode=self.args.mode, classes=self.args.types)
-        elif self.args.name == 'DenseNet121':
-            logit, recon = DenseNet121(image, classes=self.args.types) 
-        elif self.args.name == 'DenseNet169':
-            logit, recon = DenseNet169(image, classes=self.args.types)
-        elif self.args.name == 'DenseNet201':
-            logit, recon = DenseNet201(image, classes=self.args.types)
-        elif self.args.name == 'InceptionBN':
-            logit = InceptionBN(image, classes=self.args.types)
+        # The input has a single channel, so NHWC -> NCHW is a reshape that moves no data.
+        # Every backbone then works in self.data_format without further transposes.
+        if self.data_format == 'channels_first':
+            feature = tf.reshape(image, [-1, 1, self.args.shape, self.args.shape])
         else:
-            pass
-
-        estim = tf.sigmoid(logit, name='estim')
-        loss_xent = class_balanced_sigmoid_cross_entropy(logit, label, name='loss_xent')
+            feature = image
+        if self.args.teacher and not self.args.teacher_cache and get_current_tower_context().is_training:
+            # The soft targets of the frozen teacher, on the float32 input
+            soft_label = tf.sigmoid(self.teacher_logits(feature))
+        getter_scope = contextlib.suppress()
+        if self.args.precision != 'fp32':
+            assert self.args.name != 'CapsNet', "--precision only applies to the convolutional backbones"
+            # The BatchNorms keep float32 parameters and statistics for 16-bit inputs
+            feature = tf.cast(feature, PRECISIONS[self.args.precision])
+            getter_scope = custom_getter_scope(float32_variable_getter)
+        with getter_scope:
+            if self.args.name == 'CapsNet':
+                # NHWC only, the capsule lengths are the class probabilities and the
+                # margin + reconstruction loss replaces the cross entropy
+                caps_proba, caps_loss = CapsNet(image, label, classes=self.args.types,
+                                                routing_iters=self.args.routing_iters,
+                                                share_weights=not self.args.unshared_caps_weights,
+                                                decoder=self.args.caps_decoder,
+                                                recon_shape=self.args.recon_shape,
+                                                caps_grid=self.args.caps_grid)
+            else:
+                logit, recon = self.backbone(feature, self.args.name, self.args.mode, self.widths)
+
+        if self.args.name in LATENT_MODELS:
+            # The last feature map and its global average, read by feature_cache.py
+            latent = tf.cast(recon, tf.float32, name='latent')
+            tf.reduce_mean(latent, axis=[2, 3] if self.data_format == 'channels_first' else [1, 2],
+                           name='latent_pooled')
+
+        if self.args.name == 'CapsNet':
+            estim = tf.identity(caps_proba, name='estim')
+            loss_xent = tf.identity(caps_loss, name='loss_xent')
+        else:
+            # The sigmoid and the cross entropy in float32
+            logit = tf.cast(logit, tf.float32)
+            estim = tf.sigmoid(logit, name='estim')
+            if label_counts is not None and self.args.trainer == 'horovod' and get_current_tower_context().is_training:
+                # Each worker accumulates its own micro-batches, the update is over all of them
+                import horovod.tensorflow as hvd
+                label_counts = hvd.allreduce(label_counts, average=False)
+            if self.args.multitask:
+                loss_xent, loss_heads = multitask_sigmoid_cross_entropy(logit, label, get_head_weights(self.args),
+                                                                        label_counts, name='loss_xent')
+                add_moving_summary([tf.identity(loss_heads[k], name='loss_xent_{}'.format(head))
+                                    for k, head in enumerate(get_head_names(self.args))])
+            else:
+                loss_xent = class_balanced_sigmoid_cross_entropy(logit, label, label_counts, name='loss_xent')
         # loss_dice = tf.identity(1.0 - dice_coe(estim, label, axis=[0,1], loss_type='jaccard'), 
         #                          name='loss_dice') 
         # # Reconstruction
@@ -241,16 +459,25 @@ class Model(ModelDesc):
         #              .Conv2D('recon', 1, 7, padding='VALID', activation=tf.tanh, use_bias=True)())
         #     recon = tf.transpose(recon, [0, 2, 3, 1])
         # loss_mae = tf.reduce_mean(tf.abs(recon-image), name='loss_mae')
-        # Visualization
-        visualize_tensors('image', [image], scale_func=lambda x: x * 128.0 + 128.0, 
-                          max_outputs=max(64, self.args.batch))
+        # Visualization, in their own collections so that get_summary_callbacks can throttle them
+        ctx = get_current_tower_context()
+        if not self.args.no_image_hist_summaries and ctx.is_main_training_tower:
+            visualize_tensors('image', [image], scale_func=lambda x: x * 128.0 + 128.0, 
+                              max_outputs=max(64, self.args.batch), collections=[IMAGE_SUMMARIES])
+            add_param_summary((self.args.histogram_regex, ['histogram']),   # monitor W
+                              collections=[HISTOGRAM_SUMMARIES])
         # Regularize the weight of model 
         wd_w = tf.train.exponential_decay(2e-4, get_global_step_var(),
                                           80000, 0.7, True)
         wd_cost = tf.multiply(wd_w, regularize_cost('.*/W', tf.nn.l2_loss), name='wd_cost')
 
-        add_param_summary(('.*/W', ['histogram']))   # monitor W
-        cost = tf.add_n([loss_xent, wd_cost], name='cost')
+        losses = [loss_xent]
+        if soft_label is not None:
+            assert self.args.name != 'CapsNet', "--teacher needs a student with logits"
+            loss_distill = distillation_loss(logit, soft_label, self.args.distill_temperature, name='loss_distill')
+            add_moving_summary(loss_distill)
+            losses = [(1. - self.args.distill_alpha) * loss_xent, self.args.distill_alpha * loss_distill]
+        cost = tf.add_n(losses + [wd_cost], name='cost')
         add_moving_summary(loss_xent)
         add_moving_summary(wd_cost)
         add_moving_summary(cost)
@@ -260,6 +487,13 @@ class Model(ModelDesc):
         lrate = tf.get_variable('learning_rate', initializer=0.01, trainable=False)
         add_moving_summary(lrate)
         optim = tf.train.AdamOptimizer(lrate, beta1=0.5, epsilon=1e-3)
+        if self.args.precision != 'fp32':
+            # Scale the loss up until the gradients overflow, skip those steps and halve the scale
+            optim = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optim, loss_scale='dynamic')
+        if self.args.accum > 1:
+            # Adam steps every --accum steps, on the mean of the micro-batch gradients
+            optim = apply_grad_processors(optim, [MapGradient(lambda grad: grad / self.args.accum)])
+            optim = AccumGradOptimizer(optim, self.args.accum)
         return optim
 
 
@@ -314,7 +548,29 @@ def pred(model, sessinit, dataflow):
 
     return np.squeeze(np.array(estims))
 
-if __name__ == '__main__':
+
+def distill_report(args, model, dataflow):
+    """
+    Compare the per-class F1/AUC and the latency of the --teacher and of the distilled --load student.
+    """
+    from report import evaluate_predictor, print_comparison, write_report
+    reports = []
+    for title, m, load in [('teacher ' + args.teacher_name, Model(args=get_teacher_args(args)), args.teacher),
+                           ('student ' + args.name, model, args.load)]:
+        predictor = OfflinePredictor(PredictConfig(
+            model=m,
+            session_init=SmartInit(load),
+            input_names=['image'],
+            output_names=['estim']))
+        reports.append((title, evaluate_predictor(predictor, dataflow, args.types, args.threshold)))
+    print_comparison(reports, get_pathologies(args.types, args.pathology))
+    if args.distill_report:
+        write_report(args.distill_report, reports, name=args.name, teacher_name=args.teacher_name,
+                     shape=args.shape, load=args.load, teacher=args.teacher)
+        logger.info("Report written to {}".format(args.distill_report))
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpus', default='0', help='comma separated list of GPU(s) to use.')
     parser.add_argument('--name', help='Model name', default='DenseNet121')
@@ -331,7 +587,481 @@ if __name__ == '__main__':
     parser.add_argument('--pathology', default='All')
     parser.add_argument('--batch', type=int, default=64)
     parser.add_argument('--shape', type=int, default=256)
+    parser.add_argument('--num_proc', type=int, default=2, help='processes of the training dataflow')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='read the images from the multi-resolution store written by pyramid.py')
+    parser.add_argument('--mix_chexpert', default=None,
+                        help='CheXpert folder to mix into the training set, e.g. /u01/data/CXR/CheXpert-v1.0-small')
+    parser.add_argument('--mix_weights', default='0.5,0.5', help='sampling weights of vinmec,chexpert')
+    parser.add_argument('--input_mode', default='dataflow', choices=['dataflow', 'tfdata'],
+                        help='training and validation input: tensorpack dataflows, or a tf.data pipeline (tfdata.py)')
+    parser.add_argument('--data_format', default=None, choices=['channels_first', 'channels_last'],
+                        help='layout of every backbone, default: channels_first on GPU, channels_last on CPU')
+    parser.add_argument('--memory_efficient', action='store_true',
+                        help='recompute DenseNet BN-ReLU(-bottleneck) intermediates during backprop')
+    parser.add_argument('--routing_iters', '--routing-iters', type=int, default=2,
+                        help='number of CapsNet routing-by-agreement rounds')
+    parser.add_argument('--unshared_caps_weights', action='store_true',
+                        help='one CapsNet transformation matrix per primary capsule instead of per capsule map')
+    parser.add_argument('--caps_grid', type=int, default=16,
+                        help='side of the CapsNet primary capsule grid')
+    parser.add_argument('--caps_decoder', default='dense', choices=['dense', 'conv'],
+                        help='CapsNet reconstruction decoder')
+    parser.add_argument('--recon_shape', type=int, default=None,
+                        help='CapsNet reconstruction resolution, default: --shape for dense, 64 for conv')
+    parser.add_argument('--image_summary_period', type=int, default=0,
+                        help='steps between image summaries, 0: end of epoch only')
+    parser.add_argument('--histogram_summary_period', type=int, default=0,
+                        help='steps between weight histograms, 0: end of epoch only')
+    parser.add_argument('--histogram_regex', default='.*/W', help='weights to summarize as histograms')
+    parser.add_argument('--no_image_hist_summaries', action='store_true',
+                        help='disable the image and histogram summaries')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='only write checkpoints, the evaluation runs in evaluator.py')
+    parser.add_argument('--max_to_keep', type=int, default=10,
+                        help='checkpoints kept by ModelSaver, raise it when evaluator.py lags behind')
+    parser.add_argument('--checkpoint_steps', type=int, default=0,
+                        help='also checkpoint the model and the dataflow position every N steps')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the newest checkpoint of the run, at the next unseen sample')
+    parser.add_argument('--dataflow_stats', action='store_true',
+                        help='time every stage of the training dataflow, see dataflow_stats.py')
+    parser.add_argument('--step_breakdown', action='store_true',
+                        help='split the step time into input wait, graph run and callbacks')
+    parser.add_argument('--trace_every', type=int, default=100,
+                        help='steps between two traced steps of --step_breakdown')
+    parser.add_argument('--input_wait_warn', type=float, default=0.2,
+                        help='fraction of input wait over which --step_breakdown warns')
+    parser.add_argument('--progressive', default=None,
+                        help='progressive resizing, comma separated epoch:shape:batch stages from their first epoch, '
+                             'e.g. 1:128:128,81:224:96,161:320:64')
+    parser.add_argument('--trainer', default='ps', choices=['ps', 'horovod'],
+                        help='ps: one process, one tower per GPU; horovod: one process per horovodrun worker, '
+                             'each on its own shard of the training set, see launch_cpu.py')
+    parser.add_argument('--intra_op_threads', type=int, default=0,
+                        help='TF intra-op threads of this process, 0: TF default (all cores)')
+    parser.add_argument('--max_epoch', type=int, default=250)
+    parser.add_argument('--steps_per_epoch', type=int, default=0,
+                        help='steps of an epoch, 0: one pass over the training set')
+    parser.add_argument('--accum', type=int, default=1,
+                        help='micro-batches of --batch whose gradients are accumulated into one Adam update, '
+                             'the class balance being computed over all of them')
+    parser.add_argument('--precision', default='fp32', choices=sorted(PRECISIONS),
+                        help='compute dtype of the backbone, with float32 master weights and dynamic loss scaling; '
+                             'bf16 on CPU needs a oneDNN (MKL) build of TensorFlow')
+    parser.add_argument('--multitask', action='store_true',
+                        help='one backbone for every pathology of --types: a class balance, a loss weight, '
+                             'a threshold, metrics and a best checkpoint per head')
+    parser.add_argument('--head_weights', default=None, help='comma separated loss weights of the heads, default 1')
+    parser.add_argument('--thresholds', default=None,
+                        help='comma separated decision thresholds of the heads, default --threshold')
+    parser.add_argument('--best_metric', default='roc_auc', choices=['roc_auc', 'f1_score', 'f2_score'],
+                        help='per-head validation metric whose best checkpoint --multitask keeps')
+    parser.add_argument('--batch_lookup', default=None,
+                        help='json written by probe_batch.py, its batch for --name/--mode/--shape/--types '
+                             'replaces --batch')
+    parser.add_argument('--teacher', default=None,
+                        help='checkpoint of a trained --teacher_name to distill into --name, its sigmoid outputs '
+                             'are soft targets alongside the labels')
+    parser.add_argument('--teacher_name', default='DenseNet201', help='backbone of the --teacher checkpoint')
+    parser.add_argument('--teacher_mode', default='none', help='--mode of the --teacher checkpoint')
+    parser.add_argument('--teacher_cache', default=None,
+                        help='npy of the teacher outputs on the training set, computed once if missing, '
+                             'default: the teacher runs in the training graph')
+    parser.add_argument('--distill_alpha', type=float, default=0.5,
+                        help='weight of the distillation loss, the label loss has 1 - alpha')
+    parser.add_argument('--distill_temperature', type=float, default=2.0)
+    parser.add_argument('--distill_report', default=None,
+                        help='with --eval and --teacher, json of the teacher vs student metrics and latency')
+    parser.add_argument('--prune_config', default=None,
+                        help='json written by prune.py, the channels of the pruned --name to build')
+    return parser
+
+
+def get_head_names(args):
+    """
+    The heads of --multitask, one per label column, usable in file names.
+    """
+    return [name.replace('/', '_') for name in get_pathologies(args.types, args.pathology)]
+
+
+def get_head_weights(args):
+    if args.head_weights is None:
+        return [1.0] * args.types
+    weights = [float(w) for w in args.head_weights.split(',')]
+    assert len(weights) == args.types, "--head_weights needs {} values".format(args.types)
+    return weights
 
+
+def get_thresholds(args):
+    """
+    The threshold of every class, --thresholds or --threshold.
+    """
+    if args.thresholds is None:
+        return args.threshold
+    thresholds = np.array([float(t) for t in args.thresholds.split(',')], dtype=np.float32)
+    assert len(thresholds) == args.types, "--thresholds needs {} values".format(args.types)
+    return thresholds
+
+
+def get_logdir(args):
+    return os.path.join(args.save, args.name, args.pathology, args.mode, str(args.shape), str(args.types))
+
+
+# The backbones ending in a global average pooling, whose weights do not depend on the input shape
+PROGRESSIVE_MODELS = ['ShuffleNet', 'ResNet101', 'DenseNet121', 'DenseNet169', 'DenseNet201']
+
+
+def get_progressive_schedule(spec, max_epoch):
+    """
+    Parse the --progressive stages.
+    Returns:
+        list of (starting_epoch, max_epoch, shape, batch), the epochs being 1-based and inclusive.
+    """
+    steps = sorted(tuple(int(v) for v in stage.split(':')) for stage in spec.split(','))
+    assert steps[0][0] <= 1, "The first stage of --progressive must start at epoch 1"
+    stages = []
+    for k, (epoch, shape, batch) in enumerate(steps):
+        end = steps[k + 1][0] - 1 if k + 1 < len(steps) else max_epoch
+        stages.append((max(epoch, 1), end, shape, batch))
+    return stages
+
+
+def get_train_dataset(args, fname='train_v2.csv', seed=None, shard=None):
+    return Vinmec(folder=args.data,
+                  is_train='train',
+                  fname=fname,
+                  types=args.types,
+                  pathology=args.pathology,
+                  resize=int(args.shape),
+                  seed=seed,
+                  pyramid=args.pyramid,
+                  shard=shard,
+                  soft_labels=np.load(args.teacher_cache) if args.teacher_cache else None)
+
+
+def get_teacher_args(args):
+    """
+    The arguments of the --teacher model, trained on the same --types/--pathology as the student.
+    """
+    teacher_args = copy.copy(args)
+    teacher_args.name = args.teacher_name
+    teacher_args.mode = args.teacher_mode
+    teacher_args.teacher = teacher_args.teacher_cache = teacher_args.prune_config = None
+    teacher_args.precision = 'fp32'
+    teacher_args.accum = 1
+    return teacher_args
+
+
+def write_teacher_cache(args, fname='train_v2.csv'):
+    """
+    Write the --teacher probabilities of every row of `fname` to --teacher_cache, on the deterministic
+    evaluation augmentors: the soft targets do not follow the training augmentations.
+    """
+    ds = Vinmec(folder=args.data, is_train='test', fname=fname, types=args.types, pathology=args.pathology,
+                resize=int(args.shape), pyramid=args.pyramid)
+    ds.reset_state()
+    # A row per image of the csv, the last batch included
+    ds = BatchData(AugmentImageComponent(ds, get_eval_augmentors(), 0), args.batch, remainder=True)
+    predictor = OfflinePredictor(PredictConfig(
+        model=Model(args=get_teacher_args(args)),
+        session_init=SmartInit(args.teacher),
+        input_names=['image'],
+        output_names=['estim']))
+    estims = np.concatenate([predictor(dp[0])[0] for dp in ds]).astype(np.float32)
+    np.save(args.teacher_cache, estims)
+    logger.info("Teacher outputs of {} images written to {}".format(len(estims), args.teacher_cache))
+
+
+def get_teacher_init(args, session_init):
+    """
+    Chain the restore of the --teacher checkpoint under 'teacher/' when the teacher runs in the graph.
+    """
+    if not args.teacher or args.teacher_cache:
+        return session_init
+    return SmartInit([session_init, SaverRestore(args.teacher, prefix='teacher')])
+
+
+def get_train_augmentors(args):
+    return [
+        # imgaug.Flip(horiz=True, vert=False, prob=0.5),
+        imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
+        imgaug.RotationAndCropValid(max_deg=25),
+        imgaug.GoogleNetRandomCropAndResize(crop_area_fraction=(0.8, 1.0),
+                                            aspect_ratio_range=(0.8, 1.2),
+                                            interp=cv2.INTER_LINEAR, target_shape=args.shape),
+        imgaug.RandomOrderAug(
+            [imgaug.BrightnessScale((0.6, 1.4), clip=False),
+             imgaug.Contrast((0.6, 1.4), clip=False),
+             imgaug.Saturation(0.4, rgb=False),
+             # rgb-bgr conversion for the constants copied from
+             # fb.resnet.torch
+             imgaug.Lighting(0.1,
+                             eigval=np.asarray(
+                                 [0.2175, 0.0188, 0.0045][::-1]) * 255.0,
+                             eigvec=np.array(
+                                 [[-0.5675, 0.7192, 0.4009],
+                                  [-0.5808, -0.0045, -0.8140],
+                                  [-0.5836, -0.6948, 0.4203]],
+                                 dtype='float32')[::-1, ::-1]
+                             )]),
+        imgaug.Albumentations(AB.CLAHE(p=0.5)),
+        imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
+        imgaug.ToFloat32(),
+    ]
+
+
+class LabelCountsData(ProxyDataFlow):
+    """
+    Append to every [image, label] batch the (2, classes) negative and positive label counts of its
+    group of `group` consecutive batches, the ones accumulated into a single update.
+    The last incomplete group of every pass is dropped.
+    """
+
+    def __init__(self, ds, group):
+        super(LabelCountsData, self).__init__(ds)
+        self.group = group
+
+    def __len__(self):
+        return len(self.ds) // self.group * self.group
+
+    def __iter__(self):
+        batches = []
+        for dp in self.ds:
+            batches.append(dp)
+            if len(batches) == self.group:
+                label = np.concatenate([batch[1] for batch in batches]).astype(np.float32)
+                counts = np.stack([np.sum(1. - label, axis=0), np.sum(label, axis=0)]).astype(np.float32)
+                for batch in batches:
+                    yield list(batch) + [counts]
+                batches = []
+
+
+def get_accum_group(args):
+    """
+    Consecutive training batches of one update: --accum micro-batches of every tower. The horovod
+    workers read their own dataflows, their label counts are summed in the graph.
+    """
+    if args.trainer == 'horovod':
+        return args.accum
+    return args.accum * max(get_num_gpu(), 1)
+
+
+def get_train_dataflow(args, fname='train_v2.csv', ds_train=None, shard=None):
+    # Setup the dataset for training
+    if ds_train is None:
+        ds_train = get_train_dataset(args, fname, shard=shard)
+    # A seeded dataset is resumable: keep a single producer so that batches arrive in the saved order
+    num_proc = args.num_proc if ds_train.seed is None else 1
+    ag_train = get_train_augmentors(args)
+    ag_label = [ # Label smoothing
+        imgaug.BrightnessScale((0.8, 1.2), clip=False),
+    ]
+    ds_train.reset_state()
+    # ds_train = FixedSizeData(ds_train, 128)
+    if args.mix_chexpert:
+        # One worker pool per source, the samples are mixed then batched in this process
+        assert ds_train.seed is None, "--mix_chexpert does not support --resume/--checkpoint_steps"
+        assert not args.teacher_cache, "--mix_chexpert has no --teacher_cache for CheXpert, run the teacher in the graph"
+        ds_chexpert = get_chexpert_source(args.mix_chexpert, args.types, args.pathology, int(args.shape))
+        sources = {
+            'vinmec': MultiProcessRunnerZMQ(AugmentImageComponent(ds_train, ag_train, 0), num_proc=num_proc),
+            'chexpert': MultiProcessRunnerZMQ(AugmentImageComponent(ds_chexpert, ag_train, 0), num_proc=num_proc),
+        }
+        weights = dict(zip(['vinmec', 'chexpert'], [float(w) for w in args.mix_weights.split(',')]))
+        ds_train = MixtureData(sources, weights, size=len(ds_train))
+        ds_train = BatchData(ds_train, args.batch)
+    elif args.dataflow_stats:
+        # One stage per augmentor, so that each of them is timed
+        ds_train = InstrumentedData(ds_train, 'vinmec')
+        for k, aug in enumerate(ag_train):
+            ds_train = InstrumentedData(AugmentImageComponent(ds_train, [aug], 0, copy=(k == 0)),
+                                        'aug{}_{}'.format(k, type(aug).__name__))
+        ds_train = InstrumentedData(BatchData(ds_train, args.batch), 'batch')
+        # The batches produced by the workers and not read yet, sitting in the ZMQ queues
+        pending = PendingCount()
+        runner = MultiProcessRunnerZMQ(pending.producer(ds_train), num_proc=num_proc)
+        ds_train = InstrumentedData(pending.consumer(runner), 'runner', queue_size=pending)
+    else:
+        ds_train = AugmentImageComponent(ds_train, ag_train, 0)
+        # ds_train = AugmentImageComponent(ds_train, ag_label, 1)
+        ds_train = BatchData(ds_train, args.batch)
+        ds_train = MultiProcessRunnerZMQ(ds_train, num_proc=num_proc)
+    if args.accum > 1:
+        ds_train = LabelCountsData(ds_train, get_accum_group(args))
+    ds_train = PrintData(ds_train)
+    return ds_train
+
+
+def get_eval_augmentors():
+    return [
+        imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
+        imgaug.Albumentations(AB.CLAHE(p=1)),
+        imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
+        imgaug.ToFloat32(),
+    ]
+
+
+def get_train_input(args, shard=None):
+    """
+    Args:
+        shard: (index, count) of this worker with --trainer=horovod, None for the whole training set.
+    Returns:
+        the training DataFlow or InputSource of --input_mode, and its steps per epoch
+        (None for a DataFlow, which has a length).
+    """
+    if args.input_mode == 'tfdata':
+        assert not args.mix_chexpert, "--mix_chexpert needs --input_mode=dataflow"
+        assert not args.teacher_cache, "--teacher_cache needs --input_mode=dataflow"
+        return tfdata.get_train_input(args, get_train_augmentors(args), shard=shard,
+                                      label_counts=get_accum_group(args) if args.accum > 1 else 0)
+    return get_train_dataflow(args, shard=shard), None
+
+
+def get_eval_input(args, fname, is_train='valid', batch=None):
+    if args.input_mode == 'tfdata':
+        assert not args.teacher_cache, "--teacher_cache needs --input_mode=dataflow"
+        return tfdata.get_eval_input(args, fname, get_eval_augmentors(), is_train, batch,
+                                     label_counts=1 if args.accum > 1 else 0)
+    return get_eval_dataflow(args, fname, is_train, batch)
+
+
+def get_eval_dataflow(args, fname, is_train='valid', batch=None):
+    """
+    Setup the dataset for validating, testing or predicting.
+    Every split goes through the same deterministic augmentors (CLAHE only).
+    """
+    ds_eval = Vinmec(folder=args.data,
+                     is_train=is_train,
+                     fname=fname,
+                     types=args.types,
+                     pathology=args.pathology,
+                     resize=int(args.shape),
+                     pyramid=args.pyramid)
+
+    ag_eval = get_eval_augmentors()
+    ds_eval.reset_state()
+    # ds_eval = FixedSizeData(ds_eval, 128)
+    ds_eval = AugmentImageComponent(ds_eval, ag_eval, 0)
+    ds_eval = BatchData(ds_eval, args.batch if batch is None else batch)
+    if args.teacher_cache and is_train != 'test':
+        # The model has a soft_label input, only the training towers read it
+        ds_eval = MapData(ds_eval, lambda dp: [dp[0], dp[1], np.zeros_like(dp[1])])
+    if args.accum > 1 and is_train != 'test':
+        # The model has a label_counts input, the eval loss is balanced per batch
+        ds_eval = LabelCountsData(ds_eval, 1)
+    # ds_eval = MultiProcessRunnerZMQ(ds_eval, num_proc=1)
+    ds_eval = PrintData(ds_eval)
+    return ds_eval
+
+
+def get_trainer(args):
+    """
+    With --trainer=horovod, every process is a worker of horovodrun, the gradients being averaged
+    by allreduce (MPI or Gloo on CPU, NCCL on GPU).
+    """
+    if args.trainer == 'horovod':
+        return HorovodTrainer(average=True)
+    return SyncMultiGPUTrainerParameterServer(max(get_num_gpu(), 1))
+
+
+def get_session_creator(args):
+    """
+    None for the default session. HorovodTrainer sets the inter-op threads to cores / local workers.
+    """
+    if args.intra_op_threads <= 0:
+        return None
+    config = get_default_sess_config()
+    config.intra_op_parallelism_threads = args.intra_op_threads
+    return NewSessionCreator(config=config)
+
+
+def get_train_config(args, model, ds_train, starting_epoch=1, max_epoch=250, session_init=None,
+                     extra_callbacks=(), steps_per_epoch=None, samples_per_step=None, is_chief=True):
+    # Peak memory per batch of this configuration (--name/--shape/--batch/--memory_efficient)
+    memory_trackers = [HostPeakMemoryTracker()]
+    if get_num_gpu() > 0:
+        memory_trackers.append(GPUMemoryTracker(list(range(get_num_gpu()))))
+    if args.dataflow_stats:
+        memory_trackers.append(DataflowStatsMonitor())
+
+    # With --async_eval, the valid/test2 scores come from evaluator.py watching the checkpoints,
+    # with --trainer=horovod only the chief evaluates
+    if args.async_eval or not is_chief:
+        inference_runners = []
+    else:
+        ds_valid = get_eval_input(args, 'valid_v2.csv', is_train='valid')
+        ds_test2 = get_eval_input(args, 'test_v2.csv', is_train='valid')
+        inference_runners = [
+            InferenceRunner(ds_valid, [CustomBinaryClassificationStats('estim', 'label', args, prefix='valid'),
+                                       ScalarStats(['loss_xent', 'cost'], prefix='valid'),
+                                       ], tower_name='ValidTower'),
+            InferenceRunner(ds_test2, [CustomBinaryClassificationStats('estim', 'label', args, prefix='test2'),
+                                       ScalarStats(['loss_xent', 'cost'], prefix='test2'),
+                                       ], tower_name='Test2Tower'),
+        ]
+        if args.multitask:
+            # The checkpoint of the best epoch of every head, max-valid_<metric>_<head>
+            inference_runners += [MaxSaver('valid_{}_{}'.format(args.best_metric, head))
+                                  for head in get_head_names(args)]
+
+    # First, to wrap the session run as tightly as possible
+    step_breakdown = []
+    if args.step_breakdown:
+        step_breakdown.append(StepTimeBreakdown(args.trace_every, args.input_wait_warn))
+    if samples_per_step is not None:
+        # Read by launch_cpu.py to compute the scaling efficiency
+        memory_trackers.append(ThroughputTracker(samples_per_step))
+
+    # Setup the config
+    is_input_source = isinstance(ds_train, InputSource)
+    return TrainConfig(
+        model=model,
+        dataflow=None if is_input_source else ds_train,
+        data=ds_train if is_input_source else None,
+        steps_per_epoch=args.steps_per_epoch or steps_per_epoch,
+        callbacks=step_breakdown + memory_trackers + get_summary_callbacks(args) + [
+            PeriodicTrigger(ModelSaver(max_to_keep=args.max_to_keep),
+                            every_k_steps=args.checkpoint_steps or None, every_k_epochs=1),
+            MinSaver('cost'),
+            ScheduledHyperParamSetter('learning_rate',
+                                      [(0, 1e-2), (50, 1e-3), (100, 1e-4), (150, 1e-5), (200, 1e-6)]),
+        ] + inference_runners + list(extra_callbacks),
+        max_epoch=max_epoch,
+        starting_epoch=starting_epoch,
+        session_init=session_init,
+        session_creator=get_session_creator(args),
+    )
+
+
+def train_progressive(args, logdir, max_epoch=250):
+    """
+    Train through the --progressive stages, one graph per (shape, batch). Every stage starts from
+    the last checkpoint of the previous one, including the global step and the learning rate.
+    """
+    assert args.name in PROGRESSIVE_MODELS, \
+        "--progressive needs a backbone ending in global average pooling: {}".format(PROGRESSIVE_MODELS)
+    assert not args.resume and args.checkpoint_steps == 0, "--progressive does not support --resume"
+    assert args.trainer == 'ps', "--progressive does not support --trainer=horovod"
+    # The cache is at a single shape, the teacher in the graph follows the stages
+    assert not args.teacher_cache, "--progressive does not support --teacher_cache"
+    session_init = get_teacher_init(args, SmartInit(args.load))
+    for starting_epoch, last_epoch, shape, batch in get_progressive_schedule(args.progressive, max_epoch):
+        logger.info("Progressive resizing: epochs {}-{} at shape {}, batch {}".format(
+            starting_epoch, last_epoch, shape, batch))
+        stage_args = copy.copy(args)
+        stage_args.shape = shape
+        stage_args.batch = batch
+        tf.reset_default_graph()
+        ds_train, steps_per_epoch = get_train_input(stage_args)
+        config = get_train_config(stage_args, Model(args=stage_args), ds_train, starting_epoch=starting_epoch,
+                                  max_epoch=last_epoch, session_init=session_init, steps_per_epoch=steps_per_epoch)
+        launch_train_with_config(config, SyncMultiGPUTrainerParameterServer(max(get_num_gpu(), 1)))
+        session_init = SmartInit(tf.train.latest_checkpoint(logdir))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
 
     if args.seed:
@@ -345,50 +1075,35 @@ if __name__ == '__main__':
         # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
 
+    if args.batch_lookup:
+        from probe_batch import lookup_batch
+        batch = lookup_batch(args.batch_lookup, args)
+        if batch is None:
+            logger.warn("{} has no batch for this configuration, run probe_batch.py".format(args.batch_lookup))
+        else:
+            logger.info("Batch {} from {}".format(batch, args.batch_lookup))
+            args.batch = batch
+
     model = Model(args=args)
 
     if args.eval:
-        ds_valid = Vinmec(folder=args.data,
-                          is_train='valid',
-                          fname='valid.csv',
-                          types=args.types,
-                          pathology=args.pathology,
-                          resize=int(args.shape))
-
-        ag_valid = [
-            imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
-            imgaug.Albumentations(AB.CLAHE(p=1)),
-            imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
-            imgaug.ToFloat32(),
-        ]
-        ds_valid.reset_state()
-        ds_valid = AugmentImageComponent(ds_valid, ag_valid, 0)
-        ds_valid = BatchData(ds_valid, 1)
-        ds_valid = PrintData(ds_valid)
+        ds_valid = get_eval_dataflow(args, 'valid.csv', is_train='valid', batch=1)
 
-        eval(model, SmartInit(args.load), ds_valid)
+        if args.teacher:
+            distill_report(args, model, ds_valid)
+        else:
+            eval(model, SmartInit(args.load), ds_valid)
         sys.exit(0)
 
     elif args.pred:
-        ds_test3 = Vinmec(folder=args.data,
-                          is_train='test',
-                          fname='test.csv',
-                          types=args.types,
-                          pathology=args.pathology,
-                          resize=int(args.shape))
-
-        ag_test3 = [
-            imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
-            imgaug.Albumentations(AB.CLAHE(p=1)),
-            imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
-            imgaug.ToFloat32(),
-        ]
-        ds_test3.reset_state()
-        ds_test3 = AugmentImageComponent(ds_test3, ag_test3, 0)
-        ds_test3 = BatchData(ds_test3, 1)
-        ds_test3 = PrintData(ds_test3)
+        ds_test3 = get_eval_dataflow(args, 'test.csv', is_train='test', batch=1)
 
-        estims = pred(model, SmartInit(args.load), ds_test3)
+        if args.load.endswith('.tflite'):
+            # Quantized model produced by quantize.py
+            from quantize import pred_tflite
+            estims = pred_tflite(args.load, ds_test3)
+        else:
+            estims = pred(model, SmartInit(args.load), ds_test3)
 
         # Read and write new csv
         fname = 'test.csv'
@@ -412,122 +1127,77 @@ if __name__ == '__main__':
         sys.exit(0)
 
     else:
-        logger.set_logger_dir(os.path.join(
-            args.save, args.name, args.pathology, args.mode, str(args.shape), str(args.types), ), 'd')
-
-        # Setup the dataset for training
-        ds_train = Vinmec(folder=args.data,
-                          is_train='train',
-                          fname='train_v2.csv',
-                          types=args.types,
-                          pathology=args.pathology,
-                          resize=int(args.shape))
-        # ds_chexpert = Vinmec(folder='/u01/data/CXR/CheXpert-v1.0-small/',         
-        #                   is_train='train',         #                  
-        #                   fname='train_valid_chexpert_remove_uncertainty_vinmec_format.csv',    
-        #                   types=args.types,        
-        #                   pathology=args.pathology,   
-        #                   resize=int(args.shape))     
-
-        # ds_train = ConcatData([ds_chexpert, ds_vinmec])
-        ag_train = [
-            # imgaug.Flip(horiz=True, vert=False, prob=0.5),
-            imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
-            imgaug.RotationAndCropValid(max_deg=25),
-            imgaug.GoogleNetRandomCropAndResize(crop_area_fraction=(0.8, 1.0),
-                                                aspect_ratio_range=(0.8, 1.2),
-                                                interp=cv2.INTER_LINEAR, target_shape=args.shape),
-            imgaug.RandomOrderAug(
-                [imgaug.BrightnessScale((0.6, 1.4), clip=False),
-                 imgaug.Contrast((0.6, 1.4), clip=False),
-                 imgaug.Saturation(0.4, rgb=False),
-                 # rgb-bgr conversion for the constants copied from
-                 # fb.resnet.torch
-                 imgaug.Lighting(0.1,
-                                 eigval=np.asarray(
-                                     [0.2175, 0.0188, 0.0045][::-1]) * 255.0,
-                                 eigvec=np.array(
-                                     [[-0.5675, 0.7192, 0.4009],
-                                      [-0.5808, -0.0045, -0.8140],
-                                      [-0.5836, -0.6948, 0.4203]],
-                                     dtype='float32')[::-1, ::-1]
-                                 )]),
-            imgaug.Albumentations(AB.CLAHE(p=0.5)),
-            imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
-            imgaug.ToFloat32(),
-        ]
-        ag_label = [ # Label smoothing
-            imgaug.BrightnessScale((0.8, 1.2), clip=False),
-        ]
-        ds_train.reset_state()
-        # ds_train = FixedSizeData(ds_train, 128)
-        ds_train = AugmentImageComponent(ds_train, ag_train, 0)
-        # ds_train = AugmentImageComponent(ds_train, ag_label, 1)
-        ds_train = BatchData(ds_train, args.batch)
-        ds_train = MultiProcessRunnerZMQ(ds_train, num_proc=2)
-        ds_train = PrintData(ds_train)
-
-        # Setup the dataset for validating
-        ds_valid = Vinmec(folder=args.data,
-                          is_train='valid',
-                          fname='valid_v2.csv',
-                          types=args.types,
-                          pathology=args.pathology,
-                          resize=int(args.shape))
-
-        ag_valid = [
-            imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
-            imgaug.Albumentations(AB.CLAHE(p=1)),
-            imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
-            imgaug.ToFloat32(),
-        ]
-        ds_valid.reset_state()
-        # ds_valid = FixedSizeData(ds_valid, 128)
-        ds_valid = AugmentImageComponent(ds_valid, ag_valid, 0)
-        ds_valid = BatchData(ds_valid, args.batch)
-        # ds_valid = MultiProcessRunnerZMQ(ds_valid, num_proc=1)
-        ds_valid = PrintData(ds_valid)
-
-        # Setup the dataset for validating
-        ds_test2 = Vinmec(folder=args.data,
-                          is_train='valid',
-                          fname='test_v2.csv',
-                          types=args.types,
-                          pathology=args.pathology,
-                          resize=int(args.shape))
-
-        ag_test2 = [
-            imgaug.ColorSpace(mode=cv2.COLOR_GRAY2RGB),
-            imgaug.Albumentations(AB.CLAHE(p=1)),
-            imgaug.ColorSpace(mode=cv2.COLOR_RGB2GRAY),
-            imgaug.ToFloat32(),
-        ]
-        ds_test2.reset_state()
-        ds_test2 = AugmentImageComponent(ds_test2, ag_test2, 0)
-        ds_test2 = BatchData(ds_test2, args.batch)
-        ds_test2 = PrintData(ds_test2)
-
-        # Setup the config
-        config = TrainConfig(
-            model=model,
-            dataflow=ds_train,
-            callbacks=[
-                ModelSaver(),
-                MinSaver('cost'),
-                ScheduledHyperParamSetter('learning_rate',
-                                          [(0, 1e-2), (50, 1e-3), (100, 1e-4), (150, 1e-5), (200, 1e-6)]),
-                InferenceRunner(ds_valid, [CustomBinaryClassificationStats('estim', 'label', args, prefix='valid'),
-                                           ScalarStats(['loss_xent', 'cost'], prefix='valid'),
-                                           ], tower_name='ValidTower'),
-                InferenceRunner(ds_test2, [CustomBinaryClassificationStats('estim', 'label', args, prefix='test2'),
-                                           ScalarStats(['loss_xent', 'cost'], prefix='test2'),
-                                           ], tower_name='Test2Tower'),
-            ],
-            max_epoch=250,
-            session_init=SmartInit(args.load),
-        )
-
-
-        trainer = SyncMultiGPUTrainerParameterServer(max(get_num_gpu(), 1))
-
-        launch_train_with_config(config, trainer)
\ No newline at end of file
+        logdir = get_logdir(args)
+        # HorovodTrainer initializes horovod, the rank is needed to shard the training set
+        trainer = get_trainer(args)
+        if args.trainer == 'horovod':
+            # Every worker reads its own shard, the effective batch is the sum of the workers' batches
+            shard = (trainer.hvd.rank(), trainer.hvd.size())
+            num_towers = trainer.hvd.size()
+        else:
+            shard = None
+            num_towers = max(get_num_gpu(), 1)
+        if trainer.is_chief:
+            logger.set_logger_dir(logdir, 'k' if args.resume else 'd')
+        if args.dataflow_stats:
+            # Before the dataflow workers are forked
+            dataflow_stats.enable(os.path.join(logdir, 'dataflow_stats'))
+        if args.teacher_cache:
+            # Before the cache is written, a whole pass of the teacher over the training set
+            assert not args.progressive, "--progressive does not support --teacher_cache"
+            assert args.input_mode == 'dataflow', "--teacher_cache needs --input_mode=dataflow"
+            assert not args.mix_chexpert, \
+                "--mix_chexpert has no --teacher_cache for CheXpert, run the teacher in the graph"
+        if args.teacher_cache and not os.path.isfile(args.teacher_cache):
+            assert args.teacher, "--teacher_cache {} does not exist, --teacher writes it".format(args.teacher_cache)
+            assert args.trainer == 'ps', "Write the --teacher_cache with a single process first"
+            write_teacher_cache(args)
+        if args.progressive:
+            train_progressive(args, logdir, max_epoch=args.max_epoch)
+            sys.exit(0)
+
+        # Resumable training: the order of every epoch is a function of (seed, epoch), and the
+        # position of the next unseen sample is saved with the step-level checkpoints
+        session_init = SmartInit(args.load)
+        starting_epoch = 1
+        resume_callbacks = []
+        steps_per_epoch = None
+        if args.resume or args.checkpoint_steps > 0:
+            assert args.input_mode == 'dataflow', "--resume/--checkpoint_steps need --input_mode=dataflow"
+            assert args.trainer == 'ps', "--resume/--checkpoint_steps do not support --trainer=horovod"
+            # The accumulation groups would not line up with the optimizer's counter after a restart
+            assert args.accum == 1, "--resume/--checkpoint_steps do not support --accum"
+            # Every tower reads its own batch, the saved position counts one batch per step
+            assert num_towers == 1, "--resume/--checkpoint_steps need a single GPU"
+            ds_dataset = get_train_dataset(args, seed=args.seed)
+            steps_per_epoch = len(ds_dataset) // args.batch
+            position = (0, 0)
+            checkpoint = tf.train.latest_checkpoint(logdir) if args.resume else None
+            if checkpoint is not None:
+                global_step = int(checkpoint.rsplit('-', 1)[1])
+                state = load_dataflow_state(logdir, global_step)
+                if state is not None:
+                    assert state['seed'] == args.seed and state['batch'] == args.batch, \
+                        "Resume with the --seed and --batch of the interrupted run"
+                    position = (state['epoch'], state['offset'])
+                else:  # an epoch checkpoint from ModelSaver, the epochs have all been full
+                    position = (global_step // steps_per_epoch, global_step % steps_per_epoch * args.batch)
+                session_init = SmartInit(checkpoint)
+                logger.info("Resuming from {} at sample {} of epoch {}".format(
+                    checkpoint, position[1], position[0] + 1))
+            ds_dataset.set_position(*position)
+            starting_epoch = position[0] + 1
+            resume_callbacks.append(PeriodicTrigger(
+                DataflowStateSaver(ds_dataset, args.batch, position, max_to_keep=args.max_to_keep),
+                every_k_steps=args.checkpoint_steps or None, every_k_epochs=1))
+            if position[1] > 0:
+                resume_callbacks.append(ResumeEpoch(steps_per_epoch - position[1] // args.batch))
+            ds_train = get_train_dataflow(args, ds_train=ds_dataset)
+        else:
+            ds_train, steps_per_epoch = get_train_input(args, shard=shard)
+
+        config = get_train_config(args, model, ds_train, starting_epoch=starting_epoch, max_epoch=args.max_epoch,
+                                  session_init=get_teacher_init(args, session_init), extra_callbacks=resume_callbacks,
+                                  steps_per_epoch=steps_per_epoch, samples_per_step=args.batch * num_towers,
+                                  is_chief=trainer.is_chief)
+        launch_train_with_config(config, trainer)
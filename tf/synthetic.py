@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Write a synthetic chest X-ray dataset in the layouts read by Vinmec and Chexpert, to test
+the input pipeline and the training speed without the private data.
+
+Example:
+    python synthetic.py --output=/tmp/synthetic --format=vinmec --num=100000 --workers=8
+    python run_vinmec.py --data=/tmp/synthetic --name=DenseNet121 --shape=256 --types=16
+    python synthetic.py --output=/tmp/synthetic_cxr --format=chexpert --num=10000
+    python chexpert.py --data=/tmp/synthetic_cxr/CheXpert-v1.0-small
+
+Every image only depends on (seed, index), so the output is the same whatever the number of workers,
+and the existing images are kept when the generation is resumed.
+The labels are 1, 0, -1 (uncertain) or empty (NaN) with the frequencies of --positive, --uncertain, --missing.
+"""
+import argparse
+import multiprocessing as mp
+import os
+
+import cv2
+
+import numpy as np
+
+import pandas as pd
+
+
+VINMEC_PATHOLOGIES = ['Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Pleural Effusion',
+                      'Pneumothorax', 'Pleural Other', 'Lung Lesion', 'Airspace Opacity', 'Pneumonia/infection',
+                      'Cavitation', 'Fibrosis', 'Widening Mediastinum', 'Medical device', 'Fracture', 'No Finding']
+CHEXPERT_PATHOLOGIES = ['No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Opacity',
+                        'Lung Lesion', 'Edema', 'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax',
+                        'Pleural Effusion', 'Pleural Other', 'Fracture', 'Support Devices']
+CHEXPERT_FOLDER = 'CheXpert-v1.0-small'
+SPLITS = [('train', 0.8), ('valid', 0.1), ('test', 0.1)]
+
+
+def synthesize(rng, height, width, bits=8):
+    """
+    A grayscale image looking vaguely like a chest X-ray: two dark lungs in a bright body,
+    a spine and some noise. Drawn at low resolution and upsampled, so that a 3000x3000 image
+    costs about as much as its PNG encoding.
+    """
+    h, w = 64, int(round(64.0 * width / height))
+    image = np.full((h, w), 0.15, np.float32)
+    cv2.ellipse(image, (w // 2, h // 2), (int(w * 0.45), int(h * 0.48)), 0, 0, 360, 0.75, -1)
+    for side in [-1, 1]:
+        center = (int(w / 2 + side * w * rng.uniform(0.18, 0.24)), int(h * rng.uniform(0.45, 0.52)))
+        axes = (int(w * rng.uniform(0.12, 0.17)), int(h * rng.uniform(0.28, 0.36)))
+        cv2.ellipse(image, center, axes, side * rng.uniform(0, 10), 0, 360, rng.uniform(0.25, 0.4), -1)
+    cv2.rectangle(image, (int(w * 0.47), 0), (int(w * 0.53), h), 0.85, -1)
+    for _ in range(rng.randint(0, 4)):  # opacities
+        center = (rng.randint(w // 4, 3 * w // 4), rng.randint(h // 4, 3 * h // 4))
+        cv2.circle(image, center, rng.randint(2, 6), rng.uniform(0.5, 0.9), -1)
+    image += rng.normal(0, 0.03, image.shape).astype(np.float32)
+    image = cv2.GaussianBlur(image, (3, 3), 0)
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    # Full resolution grain, from a small tile to stay fast
+    tile = rng.normal(0, 0.02, (256, 256)).astype(np.float32)
+    image += np.tile(tile, (height // 256 + 1, width // 256 + 1))[:height, :width]
+    scale = 255 if bits == 8 else 65535
+    return (np.clip(image, 0, 1) * scale).astype(np.uint8 if bits == 8 else np.uint16)
+
+
+def get_labels(rng, pathologies, positive=0.1, uncertain=0.05, missing=0.3):
+    values = rng.choice([1.0, -1.0, np.nan, 0.0], size=len(pathologies),
+                        p=[positive, uncertain, missing, 1 - positive - uncertain - missing])
+    return dict(zip(pathologies, values))
+
+
+def get_size(rng, args):
+    height = rng.randint(args.min_size, args.max_size + 1)
+    width = int(height * rng.uniform(0.8, 1.2))
+    bits = 16 if rng.uniform() < args.fraction_16bit else 8
+    return height, width, bits
+
+
+def vinmec_row(args, index):
+    rng = np.random.RandomState([args.seed, index])
+    height, width, bits = get_size(rng, args)
+    fname = '{:08d}.png'.format(index)
+    row = {'Images': fname}
+    # Before the image, so that skipping an existing image keeps the labels
+    row.update(get_labels(rng, VINMEC_PATHOLOGIES, args.positive, args.uncertain, args.missing))
+    path = os.path.join(args.output, 'data', fname)
+    if not os.path.isfile(path):
+        cv2.imwrite(path, synthesize(rng, height, width, bits), [cv2.IMWRITE_PNG_COMPRESSION, args.compression])
+    return row
+
+
+def chexpert_row(args, index, split):
+    rng = np.random.RandomState([args.seed, index])
+    height, width, _ = get_size(rng, args)
+    frontal = rng.uniform() < 0.85
+    fname = os.path.join(CHEXPERT_FOLDER, split, 'patient{:05d}'.format(index + 1), 'study1',
+                         'view1_frontal.jpg' if frontal else 'view1_lateral.jpg')
+    row = {'Path': fname,
+           'Sex': rng.choice(['Female', 'Male', 'Unknown'], p=[0.45, 0.5, 0.05]),
+           'Age': rng.randint(18, 91),
+           'Frontal/Lateral': 'Frontal' if frontal else 'Lateral',
+           'AP/PA': rng.choice(['AP', 'PA']) if frontal else np.nan}
+    row.update(get_labels(rng, CHEXPERT_PATHOLOGIES, args.positive, args.uncertain, args.missing))
+    path = os.path.join(args.output, fname)
+    if not os.path.isfile(path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        cv2.imwrite(path, synthesize(rng, height, width, 8), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return row
+
+
+def _write_row(task):
+    args, index, split = task
+    if args.format == 'vinmec':
+        return vinmec_row(args, index)
+    return chexpert_row(args, index, split)
+
+
+def generate(args):
+    """
+    Write the images and the csv files of every split.
+    Returns:
+        dict of split -> number of rows.
+    """
+    if args.format == 'vinmec':
+        folder = args.output
+        columns = ['Images'] + VINMEC_PATHOLOGIES
+        if not os.path.isdir(os.path.join(folder, 'data')):
+            os.makedirs(os.path.join(folder, 'data'))
+    else:
+        folder = os.path.join(args.output, CHEXPERT_FOLDER)
+        columns = ['Path', 'Sex', 'Age', 'Frontal/Lateral', 'AP/PA'] + CHEXPERT_PATHOLOGIES
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    counts = {}
+    start = 0
+    pool = mp.Pool(args.workers)
+    for split, fraction in SPLITS:
+        count = int(round(args.num * fraction))
+        tasks = [(args, index, split) for index in range(start, start + count)]
+        rows = pool.map(_write_row, tasks, chunksize=max(1, min(64, count // (4 * args.workers))))
+        df = pd.DataFrame(rows, columns=columns)
+        df.to_csv(os.path.join(folder, '{}.csv'.format(split)), index=False)
+        # run_vinmec.py reads the _v2 lists
+        df.to_csv(os.path.join(folder, '{}_v2.csv'.format(split)), index=False)
+        counts[split] = count
+        start += count
+        print('{}: {} images'.format(split, count))
+    pool.close()
+    pool.join()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--format', default='vinmec', choices=['vinmec', 'chexpert'])
+    parser.add_argument('--num', type=int, default=1000, help='total number of images, split 80/10/10')
+    parser.add_argument('--seed', type=int, default=2222)
+    parser.add_argument('--min_size', type=int, default=2000, help='min image height in pixels')
+    parser.add_argument('--max_size', type=int, default=3000, help='max image height in pixels')
+    parser.add_argument('--fraction_16bit', type=float, default=0.5, help='fraction of 16-bit PNGs (vinmec only)')
+    parser.add_argument('--compression', type=int, default=1, help='PNG compression level, 0-9')
+    parser.add_argument('--positive', type=float, default=0.1, help='frequency of the 1 labels')
+    parser.add_argument('--uncertain', type=float, default=0.05, help='frequency of the -1 labels')
+    parser.add_argument('--missing', type=float, default=0.3, help='frequency of the NaN labels')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count())
+    args = parser.parse_args()
+    generate(args)
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+A tf.data input pipeline over the Vinmec csv files, for TrainConfig and the InferenceRunners
+(run_vinmec.py --input_mode=tfdata), to compare with the Python dataflow path.
+
+The csv is read once into an index of paths and labels. Reading, decoding and resizing are TF ops,
+and the augmentors are the same tensorpack ones as the dataflow path, run by tf.numpy_function
+(OpenCV releases the GIL). All of them are parallel maps with autotuned parallelism, followed by a
+prefetch; on GPU, StagingInput then prefetches the batches to the device.
+
+Differences with Vinmec: 16-bit PNGs are scaled to 8 bits by /257 (OpenCV shifts by 8 bits), and the
+bilinear resize of TF does not round the same way as cv2.resize, so pixels can differ by one level.
+"""
+import os
+
+import numpy as np
+
+import pandas as pd
+
+import tensorflow as tf
+tf = tf.compat.v1
+
+from tensorpack.dataflow import imgaug
+from tensorpack.input_source import StagingInput, TFDatasetInput
+from tensorpack.utils.gpu import get_num_gpu
+
+from pyramid import PyramidStore
+from vinmec import get_pathologies
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def read_index(args, fname, with_label=True):
+    """
+    Returns:
+        the image paths and the (N, types) float32 labels of a Vinmec csv, NaN labels being 0.
+    """
+    df = pd.read_csv(os.path.join(args.data, fname))
+    df.columns = df.columns.str.replace(' ', '_')
+    paths = [os.path.join(args.data, 'data', name) for name in df['Images']]
+    if getattr(args, 'pyramid', False):
+        store = PyramidStore(args.data)
+        level = store.get_level(args.shape)
+        paths = [store.get_path(os.path.join('data', name), level, path) for name, path in zip(df['Images'], paths)]
+    if not with_label:
+        return paths, None
+    columns = get_pathologies(args.types, args.pathology)
+    labels = np.nan_to_num(df[columns].values.astype(np.float32), copy=True, nan=0)
+    return paths, labels
+
+
+def load_image(path, shape):
+    """
+    Read, decode as grayscale and resize to (shape, shape), as Vinmec does.
+    """
+    image = tf.io.decode_image(tf.io.read_file(path), channels=1, dtype=tf.uint16, expand_animations=False)
+    image = tf.cast(image, tf.float32) / 257.0
+    image = tf.image.resize(image, [shape, shape], method=tf.image.ResizeMethod.BILINEAR)
+    return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+
+def augment_fn(augmentors, shape):
+    augs = imgaug.AugmentorList(augmentors)
+    augs.reset_state()
+
+    def augment(image):
+        image = tf.numpy_function(lambda img: augs.augment(img).astype(np.float32), [image], tf.float32)
+        image.set_shape([shape, shape, 1])
+        return image
+    return augment
+
+
+def add_label_counts(ds, group):
+    """
+    Append to every (image, label) batch the (2, classes) negative and positive label counts of
+    its group of `group` consecutive batches, as run_vinmec.LabelCountsData.
+    """
+    def counts(image, label):
+        counts = tf.stack([tf.reduce_sum(1. - label, axis=[0, 1]), tf.reduce_sum(label, axis=[0, 1])])
+        return image, label, tf.tile(counts[None], [group, 1, 1])
+    return ds.batch(group, drop_remainder=True).map(counts).unbatch()
+
+
+def get_dataset(args, fname, augmentors, batch, is_train='train', shard=None, label_counts=0):
+    """
+    Args:
+        shard: (index, count) to only keep every count-th sample from the index-th one.
+        label_counts: if > 0, add the label counts of groups of that many batches (--accum).
+    Returns:
+        a tf.data.Dataset of (image, label) batches, or of (image,) with is_train='test'.
+        The training one is shuffled and infinite, the others make a single pass.
+    """
+    with_label = is_train != 'test'
+    paths, labels = read_index(args, fname, with_label)
+    shape = int(args.shape)
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels) if with_label else (paths,))
+    if shard is not None:
+        ds = ds.shard(shard[1], shard[0])
+        paths = paths[shard[0]::shard[1]]
+    if is_train == 'train':
+        ds = ds.shuffle(len(paths), reshuffle_each_iteration=True).repeat()
+    augment = augment_fn(augmentors, shape)
+    if with_label:
+        ds = ds.map(lambda path, label: (load_image(path, shape), label), num_parallel_calls=AUTOTUNE)
+        ds = ds.map(lambda image, label: (augment(image), label), num_parallel_calls=AUTOTUNE)
+    else:
+        ds = ds.map(lambda path: (augment(load_image(path, shape)),), num_parallel_calls=AUTOTUNE)
+    # BatchData drops the last partial batch too
+    ds = ds.batch(batch, drop_remainder=True)
+    if label_counts > 0 and with_label:
+        ds = add_label_counts(ds, label_counts)
+    return ds.prefetch(AUTOTUNE)
+
+
+def get_train_input(args, augmentors, fname='train_v2.csv', shard=None, label_counts=0):
+    """
+    Returns:
+        the training InputSource and its steps per epoch, the dataset being infinite.
+    """
+    ds = get_dataset(args, fname, augmentors, args.batch, is_train='train', shard=shard, label_counts=label_counts)
+    paths = read_index(args, fname, with_label=False)[0]
+    if shard is not None:
+        paths = paths[shard[0]::shard[1]]
+    steps_per_epoch = len(paths) // args.batch
+    ds = TFDatasetInput(ds)
+    return (StagingInput(ds) if get_num_gpu() > 0 else ds), steps_per_epoch
+
+
+def get_eval_input(args, fname, augmentors, is_train='valid', batch=None, label_counts=0):
+    return TFDatasetInput(get_dataset(args, fname, augmentors, args.batch if batch is None else batch, is_train,
+                                      label_counts=label_counts))
@@ -11,13 +11,37 @@ import tensorpack.dataflow as df
 from tensorpack.utils import get_rng
 from tensorpack.utils.argtools import shape2d
 
+from dataflow_stats import InstrumentedData, collect, enable, get_bottleneck, stage
+from pyramid import PyramidStore
+
+
+# The label columns of each --types, spaces replaced by underscores
+PATHOLOGIES = {
+    5: ['Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Pleural_Effusion'],
+    6: ['Airspace_Opacity', 'Cardiomegaly', 'Fracture', 'Lung_Lesion', 'Pleural_Effusion', 'Pneumothorax'],
+    16: ['Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Pleural_Effusion', 'Pneumothorax',
+         'Pleural_Other', 'Lung_Lesion', 'Airspace_Opacity', 'Pneumonia/infection', 'Cavitation', 'Fibrosis',
+         'Widening_Mediastinum', 'Medical_device', 'Fracture', 'No_Finding'],
+}
+
+
+def get_pathologies(types, pathology=None):
+    """
+    The label columns, in the order of the label vector.
+    """
+    if types == 1:
+        assert pathology is not None
+        return [pathology]
+    return PATHOLOGIES.get(types, [])
+
 
 class Vinmec(df.RNGDataFlow):
     # https://github.com/tensorpack/tensorpack/blob/master/tensorpack/dataflow/image.py
     """ Produce images read from a list of files as (h, w, c) arrays. """
 
     def __init__(self, folder, types=14, is_train='train', channel=1,
-                 resize=None, debug=False, shuffle=False, pathology=None, fname='train.csv'):
+                 resize=None, debug=False, shuffle=False, pathology=None, fname='train.csv', seed=None,
+                 pyramid=False, shard=None, soft_labels=None):
         """[summary]
         [description
         Arguments:
@@ -30,6 +54,14 @@ class Vinmec(df.RNGDataFlow):
             debug {bool} -- [description] (default: {False})
             shuffle {bool} -- [description] (default: {False})
             fname {str} -- [description] (default: {"train.csv"})
+            seed {int} -- makes the training order of every epoch a function of (seed, epoch),
+                          so that an interrupted epoch can be resumed with set_position (default: {None})
+            pyramid {bool} -- read the images from the pyramid.py store at the smallest level
+                              at or above resize (default: {False})
+            shard {tuple} -- (index, count): only keep the rows index::count, the part of one
+                             data-parallel worker (default: {None})
+            soft_labels {array} -- (rows, types) teacher probabilities of the csv rows, yielded
+                                   after the label (default: {None})
         """
         self.version = "1.0.0"
         self.description = "Vinmec is a large dataset of chest X-rays\n",
@@ -53,8 +85,19 @@ class Vinmec(df.RNGDataFlow):
         # Read the csv
         self.df = pd.read_csv(self.csvfile)
         self.df.columns = self.df.columns.str.replace(' ', '_')
+        if soft_labels is not None:
+            assert len(soft_labels) == len(self.df), "{} soft labels for {} rows".format(len(soft_labels), len(self.df))
+        if shard is not None:
+            self.df = self.df.iloc[shard[0]::shard[1]].reset_index(drop=True)
+            soft_labels = None if soft_labels is None else soft_labels[shard[0]::shard[1]]
+        self.soft_labels = soft_labels
         print(self.df.info())
         self.pathology = pathology
+        self.store = PyramidStore(folder) if pyramid else None
+        self.level = self.store.get_level(resize) if pyramid and resize is not None else None
+        self.seed = seed
+        self.epoch = 0
+        self.offset = 0
 
     def reset_state(self):
         self.rng = get_rng(self)
@@ -62,68 +105,60 @@ class Vinmec(df.RNGDataFlow):
     def __len__(self):
         return len(self.df)
 
-    def __iter__(self):
-        indices = list(range(self.__len__()))
+    def get_indices(self, epoch):
+        """
+        The order in which `epoch` visits the rows. With a seed it only depends on (seed, epoch).
+        """
+        indices = np.arange(self.__len__())
         if self.is_train == 'train':
-            self.rng.shuffle(indices)
+            rng = self.rng if self.seed is None else np.random.RandomState([self.seed, epoch])
+            rng.shuffle(indices)
+        return indices
+
+    def set_position(self, epoch, offset):
+        """
+        Start the next iteration at the `offset`-th sample of `epoch`, the skipped samples are not read.
+        """
+        self.epoch = epoch
+        self.offset = offset
+
+    def __iter__(self):
+        indices = self.get_indices(self.epoch)[self.offset:]
+        self.epoch += 1
+        self.offset = 0
 
         for idx in indices:
             fpath = os.path.join(self.folder, 'data') #(os.path.dirname(self.folder), 'data')
             fname = os.path.join(fpath, self.df.iloc[idx]['Images'])
-            image = cv2.imread(fname, self.imread_mode)
+            if self.level is not None:
+                fname = self.store.get_path(os.path.join('data', self.df.iloc[idx]['Images']), self.level, fname)
+            # Read and decode separately, to time them as dataflow_stats stages
+            with stage('read'):
+                buf = np.fromfile(fname, dtype=np.uint8)
+            with stage('decode'):
+                image = cv2.imdecode(buf, self.imread_mode)
             assert image is not None, fname
             # print('File {}, shape {}'.format(fname, image.shape))
             if self.channel == 3:
                 image = image[:, :, ::-1]
             if self.resize is not None:
-                image = cv2.resize(image, tuple(self.resize[::-1]))
+                with stage('resize'):
+                    image = cv2.resize(image, tuple(self.resize[::-1]))
             if self.channel == 1:
                 image = image[:, :, np.newaxis]
 
             # Process the label
             if self.is_train == 'train' or self.is_train == 'valid':
-                label = []
-                if self.types == 5:
-                    label.append(self.df.iloc[idx]['Atelectasis'])
-                    label.append(self.df.iloc[idx]['Cardiomegaly'])
-                    label.append(self.df.iloc[idx]['Consolidation'])
-                    label.append(self.df.iloc[idx]['Edema'])
-                    label.append(self.df.iloc[idx]['Pleural_Effusion'])
-                    # label.append(self.df.iloc[idx]['Pneumonia/infection'])
-                if self.types == 6:
-                    label.append(self.df.iloc[idx]['Airspace_Opacity'])
-                    label.append(self.df.iloc[idx]['Cardiomegaly'])
-                    label.append(self.df.iloc[idx]['Fracture'])
-                    label.append(self.df.iloc[idx]['Lung_Lesion'])
-                    label.append(self.df.iloc[idx]['Pleural_Effusion'])
-                    label.append(self.df.iloc[idx]['Pneumothorax'])
-                if self.types == 16:
-                    label.append(self.df.iloc[idx]['Atelectasis'])
-                    label.append(self.df.iloc[idx]['Cardiomegaly'])
-                    label.append(self.df.iloc[idx]['Consolidation'])
-                    label.append(self.df.iloc[idx]['Edema'])
-                    label.append(self.df.iloc[idx]['Pleural_Effusion'])
-                    label.append(self.df.iloc[idx]['Pneumothorax'])
-                    label.append(self.df.iloc[idx]['Pleural_Other'])
-                    label.append(self.df.iloc[idx]['Lung_Lesion'])
-                    label.append(self.df.iloc[idx]['Airspace_Opacity'])
-                    label.append(self.df.iloc[idx]['Pneumonia/infection'])
-                    label.append(self.df.iloc[idx]['Cavitation'])
-                    label.append(self.df.iloc[idx]['Fibrosis'])
-                    label.append(self.df.iloc[idx]['Widening_Mediastinum'])
-                    label.append(self.df.iloc[idx]['Medical_device'])
-                    label.append(self.df.iloc[idx]['Fracture'])
-                    label.append(self.df.iloc[idx]['No_Finding'])
-                elif self.types == 1:
-                    assert self.pathology is not None
-                    label.append(self.df.iloc[idx][self.pathology])
-                else:
-                    pass
+                row = self.df.iloc[idx]
+                label = [row[name] for name in get_pathologies(self.types, self.pathology)]
                 # Try catch exception
                 label = np.nan_to_num(label, copy=True, nan=0)
                 label = np.array(label, dtype=np.float32)
                 types = label.copy()
-                yield [image, types]
+                if self.soft_labels is not None:
+                    yield [image, types, self.soft_labels[idx].astype(np.float32)]
+                else:
+                    yield [image, types]
             elif self.is_train == 'test':
                 yield [image]  # , np.array([-1, -1, -1, -1, -1])
             else:
@@ -131,11 +166,32 @@ class Vinmec(df.RNGDataFlow):
 
 
 if __name__ == '__main__':
-    ds = Vinmec(folder='/u01/data/Vimmec_Data_small/',
-                train_or_valid='train',
-                resize=256)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default='/u01/data/Vimmec_Data_small/')
+    parser.add_argument('--fname', default='train.csv')
+    parser.add_argument('--types', type=int, default=16)
+    parser.add_argument('--shape', type=int, default=256)
+    parser.add_argument('--num_proc', type=int, default=0, help='MultiProcessRunnerZMQ workers, 0: none')
+    parser.add_argument('--size', type=int, default=100, help='number of batches to time')
+    parser.add_argument('--pyramid', action='store_true', help='read from the pyramid.py store')
+    args = parser.parse_args()
+
+    enable('dataflow_stats')
+    ds = Vinmec(folder=args.data,
+                is_train='train',
+                fname=args.fname,
+                types=args.types,
+                resize=args.shape,
+                pyramid=args.pyramid)
     ds.reset_state()
-    # ds = df.MultiProcessRunnerZMQ(ds, num_proc=8)
-    ds = df.BatchData(ds, 32)
-    # ds = df.PrintData(ds)
-    df.TestDataSpeed(ds).start()
+    ds = InstrumentedData(ds, 'vinmec')
+    ds = InstrumentedData(df.BatchData(ds, 32), 'batch')
+    if args.num_proc > 0:
+        ds = InstrumentedData(df.MultiProcessRunnerZMQ(ds, num_proc=args.num_proc), 'runner')
+    df.TestDataSpeed(ds, size=args.size).start()
+    report = collect()
+    for name, s in sorted(report.items()):
+        print('{:<12} {:>9.1f} items/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms'.format(
+            name, s['items_per_sec'], s['latency_ms']['p50'], s['latency_ms']['p99']))
+    print('Bottleneck: {}'.format(get_bottleneck(report)))